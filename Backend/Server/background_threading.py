@@ -1,67 +1,78 @@
-import threading
-import time
+"""
+Background Jobs
+
+This module defines the periodic work of the server and registers it on the job scheduler: the reconciliation of
+stale balances, the expiry of subscriptions, the eviction of expired tickers, the refresh of the live PnL stream and
+the heartbeat of the lease coordinator. Pending limit orders are not polled here: the work per account, i.e. the
+limit order reconciliation and the take-profit/stop-loss trigger engine, runs in the process that holds the lease of
+the account's bucket (see lease_coordinator), and the order reconciler checks the orders on the schedule of its poll
+planner. Jobs that call exchanges or write shared rows only run in the server process that holds their lease; the
+live PnL stream works on the memory of each process and runs in all, while the prices it applies are fetched by the
+holder of the "pnl_prices" lease.
+"""
+import asyncio
+import os
+from datetime import date
 from database import SessionLocal
-from trade_service import TradeService
-from fastapi import HTTPException
+from models import Subscription
+from balance_ledger import balance_ledger
+from job_scheduler import job_scheduler
+from lease_coordinator import lease_coordinator
+from pnl_stream import pnl_stream, PNL_STREAM_SECONDS
+from ticker_cache import ticker_cache, TICKER_CACHE_EVICT_SECONDS
 import logging
 
 logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
 
+SUBSCRIPTION_EXPIRY_SECONDS = float(os.getenv("SUBSCRIPTION_EXPIRY_SECONDS", "3600"))
+# a run that takes longer than this is cancelled, so one slow exchange cannot hold a worker forever
+JOB_DEADLINE_SECONDS = float(os.getenv("JOB_DEADLINE_SECONDS", "120"))
 
-class background_threads:
-    """
-    A class to handle background tasks related to trade services.
-        Attributes:
-            authorization (str): Authorization token for accessing trade services.
-            running (bool): A flag to indicate whether the background tasks are running.
-    """
-
-    def __init__(self):
-        """
-        Initializes the background_threads class with default values.
-        """
-        self.authorization = None
-        self.running = False
 
-    def set_authorization(self, authorization: str):
-        """
-        Sets the authorization token for the trade services.
-            Args:
-                authorization (str): The authorization token to be set.
+def _expire_subscriptions():
+    """
+        Marks the expired subscriptions in a new session; blocking, runs in a worker thread.
         """
-        self.authorization = authorization
+    db = SessionLocal()
+    try:
+        expired = db.query(Subscription).filter(Subscription.date_end < date.today(),
+                                                Subscription.abo_status.in_(("Active", "active"))).update(
+            {"abo_status": "expired"}, synchronize_session=False)
+        db.commit()
+        return expired
+    finally:
+        db.close()
 
-    def start_background_tasks(self):
-        """
-        Starts the background task in a separate thread.
-        """
-        self.running = True
-        threading.Thread(target=self.run_background_task).start()
 
-    def run_background_task(self):
-        """
-        The main method that runs in the background to check and update limit orders.
+async def expire_subscriptions():
+    """
+        Marks active subscriptions whose end date has passed as expired.
 
-        Raises:
-        HTTPException: If the authorization token is not set.
+        Returns:
+            int: Number of expired subscriptions.
         """
-        if not self.authorization:
-            raise HTTPException(status_code=403, detail='Authorization Token is not set.')
-        db = SessionLocal()
+    return await asyncio.to_thread(_expire_subscriptions)
 
-        trade_service = TradeService(db, self.authorization)
 
-        try:
-            while self.running:
-                trade_service.check_and_update_limit_orders()
-                time.sleep(1000)
+async def evict_tickers():
+    """
+        Drops the expired entries of the ticker cache.
+        """
+    return ticker_cache.evict()
 
-        finally:
-            db.close()
 
-    def stop_background_tasks(self):
-        """
-        Stops the background task.
+def register_jobs():
+    """
+        Schedules all periodic work of the server.
         """
-        self.running = False
+    job_scheduler.schedule("balance_ledger", lease_coordinator.leased("balance_ledger", balance_ledger.reconcile_stale),
+                           min(balance_ledger.reconcile_seconds, 10), deadline=JOB_DEADLINE_SECONDS)
+    job_scheduler.schedule("subscription_expiry", lease_coordinator.leased("subscription_expiry", expire_subscriptions),
+                           SUBSCRIPTION_EXPIRY_SECONDS)
+    job_scheduler.schedule("ticker_cache", evict_tickers, TICKER_CACHE_EVICT_SECONDS)
+    job_scheduler.schedule("pnl_stream", pnl_stream.run_once, PNL_STREAM_SECONDS, deadline=JOB_DEADLINE_SECONDS)
+    job_scheduler.schedule("pnl_prices", lease_coordinator.leased("pnl_prices", pnl_stream.fetch_wanted_prices),
+                           PNL_STREAM_SECONDS, deadline=JOB_DEADLINE_SECONDS)
+    job_scheduler.schedule("leases", lease_coordinator.run_once, lease_coordinator.heartbeat_seconds,
+                           deadline=lease_coordinator.heartbeat_seconds)
@@ -0,0 +1,303 @@
+"""
+Balance Ledger
+
+This module keeps a copy of the free balances of every API key that places orders in the database, so all server
+processes reserve against the same numbers. The copy is seeded once from `fetch_balance`, reduced by a reservation
+before an order is submitted and debited when the exchange accepts it; orders that fill at once also credit the bought
+currency. A reservation is taken with one conditional insert, so two processes cannot both spend the last of a
+balance. Pre-trade checks therefore run against the database instead of costing an exchange round-trip per order.
+
+The copy is reconciled with the exchange periodically and after fills by the server process that holds the ledger's
+lease; the same pass drops reservations whose order was never finished, e.g. because its process stopped, and
+accounts that stopped placing orders. The database calls run in a thread so they do not block the event loop.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import func, literal, or_, select
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from models import Api, BalanceReservation, LedgerAccount, LedgerBalance
+from exchange_pool import exchange_pool, CLIENT_MAX_IDLE_SECONDS
+from request_scheduler import request_scheduler, Priority
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+BALANCE_RECONCILE_SECONDS = float(os.getenv("BALANCE_RECONCILE_SECONDS", "60"))
+# an order is submitted within seconds; older reservations belong to requests that never finished
+BALANCE_RESERVATION_SECONDS = float(os.getenv("BALANCE_RESERVATION_SECONDS", "300"))
+
+
+class BalanceLedger:
+    """
+        Free balances per API key with reservations for orders in flight, stored in the database.
+
+        Attributes:
+            reconcile_seconds (float): Age after which a seeded balance is reconciled with the exchange.
+            max_idle_seconds (float): Seconds without orders after which an account is dropped from the ledger.
+            reservation_seconds (float): Age after which an unfinished reservation is dropped.
+        """
+
+    def __init__(self, session_factory=SessionLocal, reconcile_seconds: float = BALANCE_RECONCILE_SECONDS,
+                 max_idle_seconds: float = CLIENT_MAX_IDLE_SECONDS,
+                 reservation_seconds: float = BALANCE_RESERVATION_SECONDS, clock=datetime.utcnow):
+        """
+                Initializes a BalanceLedger.
+
+                Args:
+                    session_factory (callable): Creates the database sessions of the ledger.
+                    reconcile_seconds (float): Age after which a seeded balance is reconciled.
+                    max_idle_seconds (float): Seconds without orders after which an account is dropped.
+                    reservation_seconds (float): Age after which an unfinished reservation is dropped.
+                    clock (callable): Returns the current UTC time.
+                """
+        self.session_factory = session_factory
+        self.reconcile_seconds = reconcile_seconds
+        self.max_idle_seconds = max_idle_seconds
+        self.reservation_seconds = reservation_seconds
+        self.clock = clock
+        self._in_flight = {}
+
+    def _run(self, work):
+        """
+                Runs a function with a new session, commits and closes the session.
+
+                Args:
+                    work (callable): Receives the session and returns the result.
+
+                Returns:
+                    The result of `work`.
+                """
+        db = self.session_factory()
+        try:
+            result = work(db)
+            db.commit()
+            return result
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def ensure_seeded(self, api_id: int, exchange):
+        """
+                Seeds the balance of an API key from the exchange unless it is already known.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                    exchange (ccxt.async_support.Exchange): The pooled client of the API entry.
+                """
+        now = self.clock()
+        touched = await asyncio.to_thread(self._run, lambda db: db.query(LedgerAccount).filter(
+            LedgerAccount.api_id == api_id).update({"last_used": now}, synchronize_session=False))
+        if not touched:
+            await self.reconcile(api_id, exchange, Priority.ORDER)
+
+    async def reconcile(self, api_id: int, exchange, priority: Priority = Priority.POLLING):
+        """
+                Replaces the stored free balances with the exchange's values; open reservations are kept.
+
+                Concurrent reconciliations of the same API key in this process share one `fetch_balance` call.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                    exchange (ccxt.async_support.Exchange): The pooled client of the API entry.
+                    priority (Priority): Scheduling priority of the balance request.
+                """
+        task = self._in_flight.get(api_id)
+        if task is None:
+            task = asyncio.ensure_future(self._reconcile(api_id, exchange, priority))
+            self._in_flight[api_id] = task
+        await asyncio.shield(task)
+
+    async def _reconcile(self, api_id: int, exchange, priority: Priority):
+        try:
+            balance = await request_scheduler.call(priority, exchange.fetch_balance)
+        finally:
+            self._in_flight.pop(api_id, None)
+        free = {currency: amount for currency, amount in balance['free'].items() if amount}
+        await asyncio.to_thread(self._run, lambda db: self._store_balance(db, api_id, free))
+
+    def _store_balance(self, db, api_id: int, free: dict):
+        now = self.clock()
+        db.query(LedgerBalance).filter(LedgerBalance.api_id == api_id).delete(synchronize_session=False)
+        db.add_all([LedgerBalance(api_id, currency, amount) for currency, amount in free.items()])
+        statement = insert(LedgerAccount).values(api_id=api_id, reconciled_at=now, last_used=now)
+        db.execute(statement.on_conflict_do_update(index_elements=[LedgerAccount.api_id],
+                                                   set_={"reconciled_at": now}))
+
+    async def mark_stale(self, api_id: int):
+        """
+                Forces a reconciliation of an API key on the next ledger pass, e.g. after a fill or a cancel.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                """
+        await asyncio.to_thread(self._run, lambda db: self._mark_stale(db, api_id))
+
+    @staticmethod
+    def _mark_stale(db, api_id: int):
+        db.query(LedgerAccount).filter(LedgerAccount.api_id == api_id).update({"reconciled_at": None},
+                                                                               synchronize_session=False)
+
+    @staticmethod
+    def _available_expression(api_id: int, currency: str):
+        """
+                Builds the SQL expression of the free balance of a currency minus its open reservations.
+                """
+        free = select(LedgerBalance.free).where(LedgerBalance.api_id == api_id,
+                                                LedgerBalance.currency == currency).scalar_subquery()
+        reserved = select(func.sum(BalanceReservation.amount)).where(
+            BalanceReservation.api_id == api_id, BalanceReservation.currency == currency).scalar_subquery()
+        return func.coalesce(free, 0.0) - func.coalesce(reserved, 0.0)
+
+    async def available(self, api_id: int, currency: str) -> float:
+        """
+                Returns the free balance of a currency minus the open reservations.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                    currency (str): The currency code.
+
+                Returns:
+                    float: The amount that can still be reserved.
+                """
+        expression = self._available_expression(api_id, currency)
+        return await asyncio.to_thread(self._run, lambda db: db.execute(select(expression)).scalar())
+
+    async def reserve(self, api_id: int, currency: str, amount: float):
+        """
+                Reserves an amount for an order that is about to be submitted.
+
+                The check and the reservation are one statement, so concurrent reservations of all server processes
+                never overdraw the stored balance together.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                    currency (str): The currency the order spends.
+                    amount (float): The amount the order spends.
+
+                Returns:
+                    str or None: The reservation ID, or None if the order would overdraw the balance.
+                """
+        reservation_id = uuid.uuid4().hex
+        source = select(literal(reservation_id), literal(api_id), literal(currency), literal(amount),
+                        literal(self.clock())).where(self._available_expression(api_id, currency) >= amount)
+        statement = insert(BalanceReservation).from_select(
+            ["reservation_id", "api_id", "currency", "amount", "created_at"], source)
+        inserted = await asyncio.to_thread(self._run, lambda db: db.execute(statement).rowcount)
+        return reservation_id if inserted else None
+
+    async def commit(self, api_id: int, reservation_id: str, order: dict = None):
+        """
+                Debits a reservation after the exchange accepted the order.
+
+                If the returned order is already (partly) filled, the bought currency is credited and a closed order
+                debits its actual cost instead of the estimate. Fees are only known to the exchange, so a filled
+                order also marks the balance stale.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                    reservation_id (str): The ID returned by `reserve`.
+                    order (dict, optional): The order returned by the exchange.
+                """
+        await asyncio.to_thread(self._run, lambda db: self._commit(db, api_id, reservation_id, order or {}))
+
+    def _commit(self, db, api_id: int, reservation_id: str, order: dict):
+        reservation = db.get(BalanceReservation, reservation_id)
+        if reservation is None:
+            return
+        currency, amount = reservation.currency, reservation.amount
+        db.delete(reservation)
+        filled = order.get('filled') or 0
+        if filled:
+            base, quote = order['symbol'].split(':')[0].split('/')
+            cost = order.get('cost') or filled * (order.get('average') or order.get('price') or 0)
+            buy = order.get('side') == 'buy'
+            if order.get('status') == 'closed':
+                amount = cost if buy else filled
+            received_currency, received = (base, filled) if buy else (quote, cost)
+            self._credit(db, api_id, received_currency, received)
+        self._credit(db, api_id, currency, -amount)
+        if filled or order.get('status') == 'closed':
+            self._mark_stale(db, api_id)
+
+    @staticmethod
+    def _credit(db, api_id: int, currency: str, amount: float):
+        statement = insert(LedgerBalance).values(api_id=api_id, currency=currency, free=amount)
+        db.execute(statement.on_conflict_do_update(index_elements=[LedgerBalance.api_id, LedgerBalance.currency],
+                                                   set_={"free": LedgerBalance.free + amount}))
+
+    async def release(self, api_id: int, reservation_id: str):
+        """
+                Drops a reservation whose order was not submitted.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                    reservation_id (str): The ID returned by `reserve`.
+                """
+        await asyncio.to_thread(self._run, lambda db: db.query(BalanceReservation).filter(
+            BalanceReservation.reservation_id == reservation_id).delete(synchronize_session=False))
+
+    def _prune_and_find_stale(self, db):
+        """
+                Drops expired reservations and idle accounts and loads the API entries of the stale accounts.
+
+                Returns:
+                    list: The API entries whose balance is older than `reconcile_seconds` or marked stale.
+                """
+        now = self.clock()
+        db.query(BalanceReservation).filter(
+            BalanceReservation.created_at < now - timedelta(seconds=self.reservation_seconds)).delete(
+            synchronize_session=False)
+        reserved = select(BalanceReservation.api_id)
+        idle = [api_id for (api_id,) in db.query(LedgerAccount.api_id).filter(
+            LedgerAccount.last_used < now - timedelta(seconds=self.max_idle_seconds),
+            LedgerAccount.api_id.notin_(reserved))]
+        if idle:
+            db.query(LedgerBalance).filter(LedgerBalance.api_id.in_(idle)).delete(synchronize_session=False)
+            db.query(LedgerAccount).filter(LedgerAccount.api_id.in_(idle)).delete(synchronize_session=False)
+        stale = db.query(Api).join(LedgerAccount, LedgerAccount.api_id == Api.api_id).filter(
+            or_(LedgerAccount.reconciled_at.is_(None),
+                LedgerAccount.reconciled_at < now - timedelta(seconds=self.reconcile_seconds))).all()
+        # the entries outlive the session, so they must not be expired by its commit
+        db.expunge_all()
+        return stale
+
+    async def reconcile_stale(self):
+        """
+                Reconciles all accounts whose balance is older than `reconcile_seconds` and drops expired
+                reservations and idle accounts.
+
+                Returns:
+                    int: Number of reconciled accounts.
+                """
+        stale = await asyncio.to_thread(self._run, self._prune_and_find_stale)
+        results = await asyncio.gather(*(self.reconcile(api.api_id, exchange_pool.get(api)) for api in stale),
+                                       return_exceptions=True)
+        for api, result in zip(stale, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Error reconciling balance of API {api.api_id}: {str(result)}")
+        return len(stale)
+
+    def stats(self):
+        """
+                Returns the size of the ledger.
+
+                Returns:
+                    dict: Number of tracked accounts and open reservations.
+                """
+        db = self.session_factory()
+        try:
+            return {
+                "accounts": db.query(LedgerAccount).count(),
+                "reservations": db.query(BalanceReservation).count()
+            }
+        finally:
+            db.close()
+
+
+balance_ledger = BalanceLedger()
@@ -7,7 +7,7 @@ Details:
 - Disables both autocommit and autoflush to give more control over transactions.
 """
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker
 from models import Base
 import logging
@@ -28,6 +28,27 @@ def init_db():
        It uses the `Base.metadata.create_all()` method to create the tables and binds them to the database engine.
        """
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+
+
+def add_missing_columns(bind):
+    """
+       Adds nullable columns that were added to a model after its table was created.
+
+       `create_all` only creates missing tables, so databases created by an older version would otherwise lack new
+       columns such as the exchange order IDs of trades.
+
+       Args:
+           bind (Engine): The engine of the database to update.
+       """
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
 
 
 def get_db():
@@ -0,0 +1,195 @@
+"""
+Exchange Client Pool
+
+This module keeps one long-lived ccxt.async_support client per stored API credential so that loaded markets and
+the underlying aiohttp keep-alive session survive between requests. Clients are keyed by `api_id`, replaced when the
+credentials behind an `api_id` change and dropped after they have been idle for a while.
+"""
+import asyncio
+import threading
+import time
+import ccxt.async_support as ccxt
+from market_cache import market_cache
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+CLIENT_MAX_IDLE_SECONDS = 30 * 60
+
+
+class ExchangePool:
+    """
+        Process-wide registry of warm ccxt exchange clients.
+
+        Attributes:
+            max_idle_seconds (float): Seconds a client may stay unused before it is evicted.
+            clock (callable): Monotonic time source, replaceable for tests.
+        """
+
+    def __init__(self, max_idle_seconds: float = CLIENT_MAX_IDLE_SECONDS, clock=time.monotonic):
+        """
+                Initializes an empty ExchangePool.
+
+                Args:
+                    max_idle_seconds (float): Seconds a client may stay unused before it is evicted.
+                    clock (callable): Monotonic time source.
+                """
+        self.max_idle_seconds = max_idle_seconds
+        self.clock = clock
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fingerprint(api):
+        """
+                Builds the value used to detect rotated credentials for an API entry.
+
+                Args:
+                    api: The Api object (or any object with the same credential attributes).
+
+                Returns:
+                    tuple: Exchange name and credentials of the API entry.
+                """
+        return api.exchange_name, api.key, api.secret_Key, api.passphrase
+
+    @staticmethod
+    def build_client(api):
+        """
+                Creates a new, unpooled ccxt client for the given API entry.
+
+                Used directly only for credentials that are not stored yet and therefore have no `api_id`.
+
+                Args:
+                    api: The Api object (or any object with the same credential attributes).
+
+                Returns:
+                    ccxt.async_support.Exchange: A freshly configured exchange instance.
+                """
+        exchange_class = getattr(ccxt, api.exchange_name)
+        exchange_args = {
+            'apiKey': api.key,
+            'secret': api.secret_Key,
+            # ccxt refuses account-wide open order requests on some exchanges (e.g. binance) to warn about their
+            # rate weight, but the order reconciler relies on them: one weighted request is still far cheaper than one
+            # request per symbol
+            'options': {'warnOnFetchOpenOrdersWithoutSymbol': False}
+        }
+        if api.passphrase:
+            exchange_args['password'] = api.passphrase
+        return exchange_class(exchange_args)
+
+    @staticmethod
+    async def _close(client):
+        """
+                Closes the aiohttp session held by a client that left the pool.
+
+                Args:
+                    client (ccxt.async_support.Exchange): The evicted exchange instance.
+                """
+        try:
+            await client.close()
+        except Exception as e:
+            logger.warning(f"Error closing exchange session: {str(e)}")
+
+    def _dispose(self, client):
+        """
+                Schedules the closing of an evicted client on the running event loop.
+
+                Clients that never opened a session need no cleanup and are simply dropped.
+
+                Args:
+                    client (ccxt.async_support.Exchange): The evicted exchange instance.
+                """
+        if client.session is None:
+            return
+        try:
+            asyncio.get_running_loop().create_task(self._close(client))
+        except RuntimeError:
+            logger.warning(f"Exchange client {client.id} evicted outside of an event loop; session left open")
+
+    def get(self, api):
+        """
+                Returns the pooled client for an API entry, creating it if needed.
+
+                A cached client is replaced when the stored credentials no longer match the API entry. New clients
+                receive the shared market metadata of their exchange if it is already cached.
+
+                Args:
+                    api: The Api object containing `api_id`, exchange name and credentials.
+
+                Returns:
+                    ccxt.async_support.Exchange: A warm exchange instance for the API entry.
+                """
+        fingerprint = self._fingerprint(api)
+        now = self.clock()
+        stale = []
+        with self._lock:
+            entry = self._clients.get(api.api_id)
+            if entry is not None and entry['fingerprint'] != fingerprint:
+                stale.append(entry['client'])
+                entry = None
+            if entry is None:
+                client = self.build_client(api)
+                if not market_cache.apply(client):
+                    market_cache.request(client.id)
+                entry = {'client': client, 'fingerprint': fingerprint}
+                self._clients[api.api_id] = entry
+            entry['last_used'] = now
+            stale.extend(self._pop_idle(now))
+        for client in stale:
+            self._dispose(client)
+        return entry['client']
+
+    def _pop_idle(self, now):
+        """
+                Removes clients that have not been used within `max_idle_seconds`. Caller must hold the lock.
+
+                Args:
+                    now (float): The current clock value.
+
+                Returns:
+                    list: The removed exchange instances.
+                """
+        idle_ids = [api_id for api_id, entry in self._clients.items()
+                    if now - entry['last_used'] > self.max_idle_seconds]
+        return [self._clients.pop(api_id)['client'] for api_id in idle_ids]
+
+    async def evict_idle(self):
+        """
+                Evicts all clients that have been idle for longer than `max_idle_seconds`.
+
+                Returns:
+                    int: Number of evicted clients.
+                """
+        with self._lock:
+            stale = self._pop_idle(self.clock())
+        await asyncio.gather(*(self._close(client) for client in stale))
+        return len(stale)
+
+    async def invalidate(self, api_id: int):
+        """
+                Drops the client of an API entry, e.g. after its credentials were deleted.
+
+                Args:
+                    api_id (int): The ID of the API entry.
+                """
+        with self._lock:
+            entry = self._clients.pop(api_id, None)
+        if entry is not None:
+            await self._close(entry['client'])
+
+    async def close_all(self):
+        """
+                Evicts every pooled client and waits until their sessions are closed.
+                """
+        with self._lock:
+            entries = list(self._clients.values())
+            self._clients.clear()
+        await asyncio.gather(*(self._close(entry['client']) for entry in entries))
+
+    def __len__(self):
+        return len(self._clients)
+
+
+exchange_pool = ExchangePool()
@@ -0,0 +1,265 @@
+"""
+Job Queue
+
+This module executes slow side effects, such as placing bracket orders, outside the request path. A route writes a
+job into the `queued_job` table in the same transaction as the data it belongs to and returns; a fixed pool of
+workers claims due jobs with a conditional update, so a job runs in only one server process, and calls the handler
+registered for its kind. Blocking handlers and the queue's own database calls run in a thread. Failed jobs are
+retried with exponential backoff and moved to the `dead_letter_job` table after their last attempt. A job with an
+idempotency key is only queued once, and a job whose worker died is claimed again when its lock expires.
+"""
+import asyncio
+import inspect
+import json
+import os
+import random
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import and_, event, or_
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from models import QueuedJob, DeadLetterJob
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE_WORKERS = int(os.getenv("JOB_QUEUE_WORKERS", "4"))
+JOB_QUEUE_POLL_SECONDS = float(os.getenv("JOB_QUEUE_POLL_SECONDS", "1"))
+JOB_QUEUE_MAX_ATTEMPTS = int(os.getenv("JOB_QUEUE_MAX_ATTEMPTS", "5"))
+JOB_QUEUE_BACKOFF_SECONDS = float(os.getenv("JOB_QUEUE_BACKOFF_SECONDS", "5"))
+JOB_QUEUE_MAX_BACKOFF_SECONDS = float(os.getenv("JOB_QUEUE_MAX_BACKOFF_SECONDS", "600"))
+# a job that is still locked after this long is assumed to belong to a dead worker and is claimed again
+JOB_QUEUE_LOCK_SECONDS = float(os.getenv("JOB_QUEUE_LOCK_SECONDS", "300"))
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+DEAD = 'dead'
+
+
+class JobQueue:
+    """
+        A persistent queue of side effects with a pool of workers.
+
+        Attributes:
+            workers (int): Number of jobs that run at the same time.
+            poll_seconds (float): Seconds an idle worker waits before it looks for due jobs again.
+            worker_id (str): The ID of this process, stored with claimed jobs.
+        """
+
+    def __init__(self, session_factory=SessionLocal, workers: int = JOB_QUEUE_WORKERS,
+                 poll_seconds: float = JOB_QUEUE_POLL_SECONDS, clock=datetime.utcnow):
+        """
+                Initializes a stopped JobQueue without handlers.
+
+                Args:
+                    session_factory (callable): Creates the database sessions of the workers.
+                    workers (int): Number of jobs that run at the same time.
+                    poll_seconds (float): Seconds an idle worker waits before it looks for due jobs again.
+                    clock (callable): Returns the current UTC time.
+                """
+        self.session_factory = session_factory
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.clock = clock
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.succeeded = 0
+        self.retried = 0
+        self.dead = 0
+        self._handlers = {}
+        self._loop = None
+        self._wake = None
+        self._tasks = []
+
+    def handler(self, kind: str):
+        """
+                Registers the handler of a job kind; used as decorator.
+
+                The handler is called with the payload dict. Coroutine functions run on the event loop, other functions
+                in a thread.
+
+                Args:
+                    kind (str): The job kind.
+                """
+        def register(func):
+            self._handlers[kind] = func
+            return func
+
+        return register
+
+    def enqueue(self, db, kind: str, payload: dict, idempotency_key: str = None,
+                max_attempts: int = JOB_QUEUE_MAX_ATTEMPTS, delay: float = 0):
+        """
+                Adds a job to the session of the caller, which commits it together with its own changes.
+
+                Args:
+                    db (Session): Database session.
+                    kind (str): The job kind.
+                    payload (dict): JSON-serializable arguments of the handler.
+                    idempotency_key (str, optional): A job with the same key is only queued once.
+                    max_attempts (int): Attempts before the job is moved to the dead letters.
+                    delay (float): Seconds until the job is due.
+                """
+        statement = insert(QueuedJob).values(kind=kind, payload=json.dumps(payload), idempotency_key=idempotency_key,
+                                             status=PENDING, attempts=0, max_attempts=max_attempts,
+                                             run_at=self.clock() + timedelta(seconds=delay),
+                                             created_at=self.clock())
+        db.execute(statement.on_conflict_do_nothing(index_elements=[QueuedJob.idempotency_key]))
+        # the workers are woken once the job is visible to them
+        event.listen(db, "after_commit", self._after_commit, once=True)
+
+    @staticmethod
+    def discard(db, idempotency_key: str):
+        """
+                Removes a job that is waiting for its next attempt in the session of the caller, e.g. because the row
+                it works on is deleted in the same transaction.
+
+                Args:
+                    db (Session): Database session.
+                    idempotency_key (str): The key the job was queued with.
+                """
+        db.query(QueuedJob).filter(QueuedJob.idempotency_key == idempotency_key,
+                                   QueuedJob.status == PENDING).delete(synchronize_session=False)
+
+    def _after_commit(self, session):
+        # synchronous routes commit in worker threads, so the event is set through the loop
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _claim(self):
+        """
+                Claims the next due job for this process; blocking, called in a thread.
+
+                Returns:
+                    QueuedJob: The claimed job, detached from its session, or None if no job is due.
+                """
+        db = self.session_factory()
+        try:
+            now = self.clock()
+            due = or_(and_(QueuedJob.status == PENDING, QueuedJob.run_at <= now),
+                      and_(QueuedJob.status == RUNNING, QueuedJob.locked_until < now))
+            for (job_id,) in db.query(QueuedJob.job_id).filter(due).order_by(QueuedJob.run_at).limit(self.workers):
+                claimed = db.query(QueuedJob).filter(QueuedJob.job_id == job_id, due).update({
+                    "status": RUNNING,
+                    "locked_by": self.worker_id,
+                    "locked_until": now + timedelta(seconds=JOB_QUEUE_LOCK_SECONDS),
+                    "attempts": QueuedJob.attempts + 1}, synchronize_session=False)
+                db.commit()
+                if claimed:
+                    return db.query(QueuedJob).filter(QueuedJob.job_id == job_id).one()
+            return None
+        finally:
+            db.close()
+
+    async def _execute(self, job):
+        handler = self._handlers.get(job.kind)
+        if handler is None:
+            raise LookupError(f"No handler for job kind '{job.kind}'")
+        payload = json.loads(job.payload)
+        if inspect.iscoroutinefunction(handler):
+            return await handler(payload)
+        return await asyncio.to_thread(handler, payload)
+
+    def _finish(self, job_id: int, error: Exception = None):
+        """
+                Marks a job as done, schedules its retry or moves it to the dead letters; blocking, called in a thread.
+                """
+        db = self.session_factory()
+        try:
+            job = db.query(QueuedJob).filter(QueuedJob.job_id == job_id).one()
+            now = self.clock()
+            job.locked_by = None
+            job.locked_until = None
+            if error is None:
+                job.status = DONE
+                job.finished_at = now
+                self.succeeded += 1
+                db.commit()
+                return
+
+            # HTTPExceptions carry their message in the detail
+            job.last_error = str(getattr(error, 'detail', None) or repr(error))
+            if job.attempts >= job.max_attempts:
+                job.status = DEAD
+                job.finished_at = now
+                db.add(DeadLetterJob(job_id=job.job_id, kind=job.kind, payload=job.payload, attempts=job.attempts,
+                                     last_error=job.last_error))
+                self.dead += 1
+                logger.warning(f"Job {job.job_id} ({job.kind}) failed {job.attempts} times: {job.last_error}")
+            else:
+                backoff = min(JOB_QUEUE_BACKOFF_SECONDS * 2 ** (job.attempts - 1), JOB_QUEUE_MAX_BACKOFF_SECONDS)
+                job.status = PENDING
+                job.run_at = now + timedelta(seconds=backoff * random.uniform(0.5, 1))
+                self.retried += 1
+            db.commit()
+        finally:
+            db.close()
+
+    async def run_next(self):
+        """
+                Claims and executes one due job.
+
+                Returns:
+                    bool: Whether a job was executed.
+                """
+        job = await asyncio.to_thread(self._claim)
+        if job is None:
+            return False
+        try:
+            await self._execute(job)
+        except Exception as e:
+            await asyncio.to_thread(self._finish, job.job_id, e)
+        else:
+            await asyncio.to_thread(self._finish, job.job_id)
+        return True
+
+    async def _work(self):
+        while True:
+            try:
+                executed = await self.run_next()
+            except Exception as e:
+                logger.warning(f"Error in job queue worker: {str(e)}")
+                executed = False
+            if not executed:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self):
+        """
+                Starts the workers on the running event loop.
+                """
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """
+                Cancels the workers and waits until they finished; interrupted jobs are claimed again later.
+                """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._loop = None
+        self._wake = None
+
+    def stats(self):
+        """
+                Returns the queue counters of this process.
+
+                Returns:
+                    dict: Number of workers, succeeded, retried and dead-lettered jobs.
+                """
+        return {
+            "workers": self.workers,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "dead": self.dead
+        }
+
+
+job_queue = JobQueue()
@@ -0,0 +1,308 @@
+"""
+Job Scheduler
+
+This module runs all periodic work of the server on the application's event loop. Jobs are kept in one heap ordered
+by their next due time, so scheduling and cancelling a job costs O(log n) and the dispatcher only ever looks at the
+earliest job. Cancelled jobs stay in the heap, marked as dead, until they reach the top or the heap is compacted. Due
+jobs are executed by a fixed number of workers; every run is limited by the job's deadline and is accounted for its
+lateness (start time minus due time) and for overruns (runs that took longer than the job's interval). The next run
+of a job is scheduled after the current one finished, with a random jitter so jobs of the same interval spread out.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+
+
+class Job:
+    """
+        A periodic job and its run statistics.
+
+        Attributes:
+            name (str): The unique name of the job.
+            func (callable): Coroutine function without arguments.
+            interval (float): Seconds between the end of a run and the next due time.
+            jitter (float): Fraction of the interval by which the next due time is randomly moved.
+            deadline (float): Seconds after which a run is cancelled, or None.
+            due (float): The next due time.
+        """
+    __slots__ = ("name", "func", "interval", "jitter", "deadline", "due", "active", "running", "runs", "errors",
+                 "timeouts", "overruns", "last_duration", "last_lateness", "max_lateness", "_entry")
+
+    def __init__(self, name: str, func, interval: float, jitter: float, deadline: float):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.deadline = deadline
+        self.due = None
+        self.active = True
+        self.running = False
+        self.runs = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.overruns = 0
+        self.last_duration = None
+        self.last_lateness = None
+        self.max_lateness = 0.0
+        self._entry = None
+
+    def describe(self, now: float):
+        """
+                Returns the state of the job.
+
+                Args:
+                    now (float): The current time of the scheduler clock.
+
+                Returns:
+                    dict: Name, interval, seconds until due, whether it runs and its run statistics.
+                """
+        return {
+            "name": self.name,
+            "interval": self.interval,
+            "due_in": None if self.running else self.due - now,
+            "running": self.running,
+            "runs": self.runs,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "overruns": self.overruns,
+            "last_duration": self.last_duration,
+            "last_lateness": self.last_lateness,
+            "max_lateness": self.max_lateness
+        }
+
+
+class JobScheduler:
+    """
+        Runs named periodic jobs on a bounded pool of workers.
+
+        Attributes:
+            workers (int): Number of jobs that run at the same time.
+            loop (asyncio.AbstractEventLoop): The event loop the scheduler runs on, set by `start`.
+        """
+
+    def __init__(self, workers: int = JOB_WORKERS, clock=time.monotonic):
+        """
+                Initializes a stopped JobScheduler.
+
+                Args:
+                    workers (int): Number of jobs that run at the same time.
+                    clock (callable): Returns the current time in seconds.
+                """
+        self.workers = workers
+        self.clock = clock
+        self.loop = None
+        self.running = 0
+        self.runs = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.overruns = 0
+        self.max_lateness = 0.0
+        self._jobs = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._queue = asyncio.Queue()
+        self._wake = asyncio.Event()
+        self._tasks = []
+
+    def _call(self, callback, *args):
+        """
+                Runs a callback on the scheduler's loop, directly if called from it.
+                """
+        if self.loop is not None:
+            try:
+                running_loop = asyncio.get_running_loop()
+            except RuntimeError:
+                running_loop = None
+            if running_loop is not self.loop:
+                self.loop.call_soon_threadsafe(callback, *args)
+                return
+        callback(*args)
+
+    def schedule(self, name: str, func, interval: float, jitter: float = 0.1, deadline: float = None,
+                 delay: float = None, replace: bool = True):
+        """
+                Schedules a periodic job.
+
+                May be called from any thread, e.g. from the worker threads of synchronous endpoints.
+
+                Args:
+                    name (str): The unique name of the job.
+                    func (callable): Coroutine function without arguments.
+                    interval (float): Seconds between the end of a run and the next due time.
+                    jitter (float): Fraction of the interval by which the next due time is randomly moved.
+                    deadline (float, optional): Seconds after which a run is cancelled.
+                    delay (float, optional): Seconds until the first run; a random part of the jitter by default.
+                    replace (bool): Whether a job of the same name is replaced or kept.
+                """
+        job = Job(name, func, interval, jitter, deadline)
+        if delay is None:
+            delay = random.uniform(0, interval * jitter)
+        self._call(self._add, job, delay, replace)
+
+    def _add(self, job, delay: float, replace: bool):
+        previous = self._jobs.get(job.name)
+        if previous is not None:
+            if not replace:
+                return
+            del self._jobs[job.name]
+            self._remove(previous)
+        self._jobs[job.name] = job
+        self._push(job, self.clock() + delay)
+
+    def _push(self, job, due: float):
+        job.due = due
+        job._entry = [due, next(self._sequence), job]
+        heapq.heappush(self._heap, job._entry)
+        if self._heap[0] is job._entry:
+            self._wake.set()
+
+    def _remove(self, job):
+        job.active = False
+        if job._entry is not None:
+            job._entry[2] = None
+            job._entry = None
+            if len(self._heap) > 2 * len(self._jobs) + 64:
+                self._heap = [entry for entry in self._heap if entry[2] is not None]
+                heapq.heapify(self._heap)
+
+    def cancel(self, name: str):
+        """
+                Cancels a job; a run in progress is finished but not rescheduled.
+
+                May be called from any thread.
+
+                Args:
+                    name (str): The name of the job.
+                """
+        self._call(self._cancel, name)
+
+    def _cancel(self, name: str):
+        job = self._jobs.pop(name, None)
+        if job is not None:
+            self._remove(job)
+
+    def has(self, name: str):
+        """
+                Returns whether a job of this name is scheduled.
+                """
+        return name in self._jobs
+
+    def start(self):
+        """
+                Starts the dispatcher and the workers on the running event loop.
+                """
+        self.loop = asyncio.get_running_loop()
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks.extend(asyncio.create_task(self._work()) for _ in range(self.workers))
+
+    async def _dispatch(self):
+        """
+                Hands due jobs to the workers, sleeping until the earliest job is due.
+                """
+        while True:
+            now = self.clock()
+            while self._heap and (self._heap[0][2] is None or self._heap[0][0] <= now):
+                _, _, job = heapq.heappop(self._heap)
+                if job is not None:
+                    job._entry = None
+                    self._queue.put_nowait(job)
+            self._wake.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self):
+        """
+                Runs queued jobs one after another and reschedules each after it finished.
+                """
+        while True:
+            job = await self._queue.get()
+            if not job.active:
+                continue
+            job.running = True
+            self.running += 1
+            started = self.clock()
+            job.last_lateness = max(0.0, started - job.due)
+            job.max_lateness = max(job.max_lateness, job.last_lateness)
+            self.max_lateness = max(self.max_lateness, job.last_lateness)
+            try:
+                await asyncio.wait_for(job.func(), job.deadline)
+            except asyncio.TimeoutError:
+                job.timeouts += 1
+                self.timeouts += 1
+                logger.warning(f"Job {job.name} exceeded its deadline of {job.deadline}s")
+            except Exception as e:
+                job.errors += 1
+                self.errors += 1
+                logger.warning(f"Error in job {job.name}: {str(e)}")
+            finally:
+                finished = self.clock()
+                job.running = False
+                self.running -= 1
+                job.runs += 1
+                self.runs += 1
+                job.last_duration = finished - started
+                if job.last_duration > job.interval:
+                    job.overruns += 1
+                    self.overruns += 1
+                if job.active:
+                    self._push(job, finished + job.interval * (1 + random.uniform(-job.jitter, job.jitter)))
+
+    async def stop(self):
+        """
+                Cancels the dispatcher and the workers and waits until they finished.
+                """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.loop = None
+
+    def jobs(self, limit: int = 100):
+        """
+                Returns the running jobs and the pending jobs that are due next.
+
+                Args:
+                    limit (int): Maximum number of pending jobs.
+
+                Returns:
+                    list: The state of each job, running jobs first, then by due time.
+                """
+        now = self.clock()
+        running = [job.describe(now) for job in self._jobs.values() if job.running] if self.running else []
+        pending = heapq.nsmallest(limit, (entry for entry in self._heap if entry[2] is not None))
+        return running + [entry[2].describe(now) for entry in pending]
+
+    def stats(self):
+        """
+                Returns the scheduler counters.
+
+                Returns:
+                    dict: Number of jobs, queued and running jobs, workers, runs, failures, timeouts and overruns,
+                    and the largest lateness of any run.
+                """
+        return {
+            "jobs": len(self._jobs),
+            "queued": self._queue.qsize(),
+            "running": self.running,
+            "workers": self.workers,
+            "runs": self.runs,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "overruns": self.overruns,
+            "max_lateness": self.max_lateness
+        }
+
+
+job_scheduler = JobScheduler()
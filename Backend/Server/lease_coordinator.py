@@ -0,0 +1,242 @@
+"""
+Lease Coordinator
+
+This module lets several server processes (e.g. `uvicorn --workers N`) share the background jobs without running them
+twice. Every process registers the keys it could run jobs for (a bucket of accounts, or a global job such as the
+balance ledger) and takes part in a heartbeat: it records itself in the `worker_heartbeat` table, renews the leases it
+holds in the `job_lease` table and rebalances, i.e. releases leases above its fair share of the keys and acquires
+free or expired ones up to it. A lease is taken with one conditional upsert, so SQLite decides atomically which
+process wins. Jobs wrapped with `leased` only run in the process that holds their key; when a process stops, its
+leases expire and are picked up by the others.
+
+Per-account work, i.e. the limit order reconciliation and the take-profit/stop-loss trigger engine, is sharded: every
+account belongs to one of LEASE_ACCOUNT_BUCKETS buckets (its ID modulo the bucket count), each bucket is a lease key of
+its own, and a process only works on the accounts of the buckets it holds. The accounts are thereby spread over all
+processes instead of one process working on all of them.
+"""
+import asyncio
+import math
+import os
+import socket
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from models import Api, JobLease, WorkerHeartbeat
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "30"))
+LEASE_ACCOUNT_BUCKETS = int(os.getenv("LEASE_ACCOUNT_BUCKETS", "16"))
+ACCOUNT_KEY_PREFIX = "accounts:"
+
+
+class LeaseCoordinator:
+    """
+        Holds the job leases of this process.
+
+        Attributes:
+            worker_id (str): The unique ID of this process.
+            ttl (float): Seconds a lease or heartbeat stays valid without renewal.
+            heartbeat_seconds (float): Interval at which the heartbeat should run.
+            account_buckets (int): Number of lease keys the accounts are spread over.
+        """
+
+    def __init__(self, session_factory=SessionLocal, worker_id: str = None, ttl: float = LEASE_TTL_SECONDS,
+                 clock=datetime.utcnow, account_buckets: int = LEASE_ACCOUNT_BUCKETS):
+        """
+                Initializes a LeaseCoordinator without keys.
+
+                Args:
+                    session_factory (callable): Creates the database sessions of the heartbeat.
+                    worker_id (str, optional): The unique ID of this process; host name and process ID by default.
+                    ttl (float): Seconds a lease or heartbeat stays valid without renewal.
+                    clock (callable): Returns the current UTC time.
+                    account_buckets (int): Number of lease keys the accounts are spread over.
+                """
+        self.session_factory = session_factory
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.heartbeat_seconds = ttl / 3
+        self.clock = clock
+        self.account_buckets = account_buckets
+        self.acquired = 0
+        self.released = 0
+        self._keys = set()
+        self._owned = set()
+
+    def want(self, key: str):
+        """
+                Registers a key this process can run jobs for.
+
+                Args:
+                    key (str): The lease key, e.g. "accounts:3".
+                """
+        self._keys.add(key)
+
+    def owns(self, key: str):
+        """
+                Returns whether this process holds the lease of a key.
+                """
+        return key in self._owned
+
+    def want_accounts(self):
+        """
+                Registers the keys of all account buckets, so this process takes its share of the accounts.
+                """
+        for bucket in range(self.account_buckets):
+            self.want(f"{ACCOUNT_KEY_PREFIX}{bucket}")
+
+    def owned_buckets(self):
+        """
+                Returns the account buckets whose lease this process holds.
+
+                Returns:
+                    list: The bucket numbers.
+                """
+        return sorted(int(key[len(ACCOUNT_KEY_PREFIX):]) for key in self._owned if key.startswith(ACCOUNT_KEY_PREFIX))
+
+    def owns_account(self, account_id: int):
+        """
+                Returns whether this process holds the lease of the bucket of an account.
+                """
+        return f"{ACCOUNT_KEY_PREFIX}{account_id % self.account_buckets}" in self._owned
+
+    def accounts_filter(self):
+        """
+                Returns the query filter of the API entries whose account is in a bucket this process holds.
+
+                Returns:
+                    The SQL expression, to be used with e.g. `Trade.api.has(...)`.
+                """
+        return (Api.accountID % self.account_buckets).in_(self.owned_buckets())
+
+    def leased(self, key: str, func):
+        """
+                Wraps a job so it only runs while this process holds the lease of a key.
+
+                Args:
+                    key (str): The lease key.
+                    func (callable): Coroutine function without arguments.
+
+                Returns:
+                    callable: Coroutine function without arguments.
+                """
+        self.want(key)
+
+        async def run_if_owned():
+            if key in self._owned:
+                return await func()
+
+        return run_if_owned
+
+    def _acquire(self, db, key: str, now: datetime):
+        """
+                Takes the lease of a key if it is free, expired or already ours.
+
+                Returns:
+                    bool: Whether this process holds the lease now.
+                """
+        statement = insert(JobLease).values(lease_key=key, owner=self.worker_id,
+                                            expires_at=now + timedelta(seconds=self.ttl))
+        statement = statement.on_conflict_do_update(
+            index_elements=[JobLease.lease_key],
+            set_={"owner": statement.excluded.owner, "expires_at": statement.excluded.expires_at},
+            where=or_(JobLease.owner == self.worker_id, JobLease.expires_at < now))
+        return db.execute(statement).rowcount == 1
+
+    def heartbeat(self, db):
+        """
+                Records this process, renews its leases and rebalances the keys, then commits.
+
+                Args:
+                    db (Session): Database session.
+
+                Returns:
+                    set: The keys held afterwards.
+                """
+        now = self.clock()
+        expires_at = now + timedelta(seconds=self.ttl)
+        db.execute(insert(WorkerHeartbeat).values(worker_id=self.worker_id, heartbeat_at=now).on_conflict_do_update(
+            index_elements=[WorkerHeartbeat.worker_id], set_={"heartbeat_at": now}))
+        db.query(WorkerHeartbeat).filter(WorkerHeartbeat.heartbeat_at < now - timedelta(seconds=10 * self.ttl)).delete(
+            synchronize_session=False)
+        db.query(JobLease).filter(JobLease.owner == self.worker_id).update({"expires_at": expires_at},
+                                                                            synchronize_session=False)
+        # leases can be lost, e.g. after a pause longer than the ttl, so ownership is read back
+        owned = {key for (key,) in db.query(JobLease.lease_key).filter(JobLease.owner == self.worker_id)}
+
+        workers = db.query(WorkerHeartbeat).filter(
+            WorkerHeartbeat.heartbeat_at >= now - timedelta(seconds=self.ttl)).count()
+        share = math.ceil(len(self._keys) / max(workers, 1))
+        surplus = sorted(owned - self._keys) + sorted(owned & self._keys)[share:]
+        if surplus:
+            db.query(JobLease).filter(JobLease.owner == self.worker_id, JobLease.lease_key.in_(surplus)).delete(
+                synchronize_session=False)
+            owned.difference_update(surplus)
+            self.released += len(surplus)
+
+        taken = {key for (key,) in db.query(JobLease.lease_key).filter(JobLease.expires_at >= now)}
+        for key in sorted(self._keys - owned - taken):
+            if len(owned) >= share:
+                break
+            if self._acquire(db, key, now):
+                owned.add(key)
+                self.acquired += 1
+        db.commit()
+        self._owned = owned
+        return owned
+
+    def _heartbeat_detached(self):
+        """
+                Runs one heartbeat in a new session; blocking, runs in a worker thread.
+                """
+        db = self.session_factory()
+        try:
+            return self.heartbeat(db)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def run_once(self):
+        """
+                Runs one heartbeat in a worker thread, so it does not block the event loop; registered as a periodic
+                job.
+                """
+        await asyncio.to_thread(self._heartbeat_detached)
+
+    def release_all(self):
+        """
+                Gives up all leases and the heartbeat of this process, e.g. on shutdown.
+                """
+        db = self.session_factory()
+        try:
+            db.query(JobLease).filter(JobLease.owner == self.worker_id).delete(synchronize_session=False)
+            db.query(WorkerHeartbeat).filter(WorkerHeartbeat.worker_id == self.worker_id).delete(
+                synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+        self._owned = set()
+
+    def stats(self):
+        """
+                Returns the coordinator counters.
+
+                Returns:
+                    dict: Worker ID, number of registered and held keys, acquired and released leases.
+                """
+        return {
+            "worker_id": self.worker_id,
+            "keys": len(self._keys),
+            "owned": len(self._owned),
+            "acquired": self.acquired,
+            "released": self.released
+        }
+
+
+lease_coordinator = LeaseCoordinator()
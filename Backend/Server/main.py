@@ -5,11 +5,15 @@ This script serves as the entry point for running the FastAPI application.
 It imports the FastAPI instance 'app' from the 'routes' module and uses the Uvicorn server to run the application.
 
 Usage:
-    Run this script to start the FastAPI application.
+    Run this script to start the FastAPI application. Set UVICORN_WORKERS to run several server processes; they
+    share the background jobs through the lease coordinator.
 """
 
+import os
 import uvicorn
 from routes import app
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="127.0.0.1", port=8001)
+    workers = int(os.getenv("UVICORN_WORKERS", "1"))
+    # several workers need the application as import string, so every process can import it itself
+    uvicorn.run("routes:app" if workers > 1 else app, host="127.0.0.1", port=8001, workers=workers)
@@ -0,0 +1,217 @@
+"""
+Market Metadata Cache
+
+This module keeps the market and currency metadata of every exchange in use in memory and on disk, so that
+`load_markets` runs at most once per exchange and refresh interval instead of once per client. The metadata is
+loaded in the background at startup and handed to new clients by reference; clients of the same exchange share one
+read-only copy.
+"""
+import asyncio
+import json
+import os
+import time
+import ccxt.async_support as ccxt
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+MARKET_CACHE_DIR = os.getenv("MARKET_CACHE_DIR", os.path.join(os.path.dirname(__file__), "market_cache"))
+MARKET_CACHE_REFRESH_SECONDS = float(os.getenv("MARKET_CACHE_REFRESH_SECONDS", str(6 * 60 * 60)))
+
+SHARED_ATTRIBUTES = ('markets', 'markets_by_id', 'symbols', 'ids', 'currencies', 'currencies_by_id', 'codes')
+
+
+class MarketCache:
+    """
+        Caches loaded markets per exchange in memory and as JSON files.
+
+        Attributes:
+            directory (str): Directory holding one `<exchange_id>.json` file per exchange.
+            refresh_seconds (float): Age after which cached metadata is reloaded from the exchange.
+            clock (callable): Wall-clock time source, replaceable for tests.
+        """
+
+    def __init__(self, directory: str = MARKET_CACHE_DIR, refresh_seconds: float = MARKET_CACHE_REFRESH_SECONDS,
+                 clock=time.time):
+        """
+                Initializes an empty MarketCache.
+
+                Args:
+                    directory (str): Directory for the cache files.
+                    refresh_seconds (float): Age after which cached metadata is reloaded.
+                    clock (callable): Wall-clock time source.
+                """
+        self.directory = directory
+        self.refresh_seconds = refresh_seconds
+        self.clock = clock
+        self._templates = {}
+        self._loaded_at = {}
+        self._in_flight = {}
+
+    def _path(self, exchange_id: str):
+        return os.path.join(self.directory, f"{exchange_id}.json")
+
+    def _build_template(self, exchange_id: str, markets: dict, currencies: dict):
+        """
+                Indexes raw metadata once on an unauthenticated client whose attributes are then shared.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+                    markets (dict): Markets by symbol, as returned by `load_markets`.
+                    currencies (dict): Currencies by code.
+
+                Returns:
+                    ccxt.async_support.Exchange: The client holding the indexed metadata.
+                """
+        template = getattr(ccxt, exchange_id)()
+        template.set_markets(list(markets.values()), currencies)
+        return template
+
+    def _store(self, exchange_id: str, template, loaded_at: float):
+        self._templates[exchange_id] = template
+        self._loaded_at[exchange_id] = loaded_at
+
+    def _write_file(self, exchange_id: str, markets: dict, currencies: dict, loaded_at: float):
+        """
+                Writes the metadata of an exchange atomically to its cache file.
+                """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(exchange_id)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({"loaded_at": loaded_at, "markets": markets, "currencies": currencies}, file)
+        os.replace(temporary_path, path)
+
+    def load_from_disk(self, exchange_id: str):
+        """
+                Loads the cache file of an exchange into memory, regardless of its age.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+
+                Returns:
+                    bool: True if a cache file was found and loaded, otherwise False.
+                """
+        path = self._path(exchange_id)
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path) as file:
+                data = json.load(file)
+            template = self._build_template(exchange_id, data["markets"], data["currencies"])
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable market cache {path}: {str(e)}")
+            return False
+        self._store(exchange_id, template, data["loaded_at"])
+        return True
+
+    def is_stale(self, exchange_id: str):
+        """
+                Tells whether the metadata of an exchange is missing or older than `refresh_seconds`.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+
+                Returns:
+                    bool: True if the metadata needs to be (re)loaded.
+                """
+        loaded_at = self._loaded_at.get(exchange_id)
+        return loaded_at is None or self.clock() - loaded_at > self.refresh_seconds
+
+    def apply(self, client):
+        """
+                Hands the cached metadata of the client's exchange to the client by reference.
+
+                Args:
+                    client (ccxt.async_support.Exchange): The client to prepare.
+
+                Returns:
+                    bool: True if metadata was available, otherwise False.
+                """
+        template = self._templates.get(client.id)
+        if template is None:
+            return False
+        for attribute in SHARED_ATTRIBUTES:
+            setattr(client, attribute, getattr(template, attribute))
+        return True
+
+    async def refresh(self, exchange_id: str):
+        """
+                Reloads the metadata of an exchange from the exchange and persists it.
+
+                Concurrent refreshes of the same exchange share one upstream load.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+                """
+        task = self._in_flight.get(exchange_id)
+        if task is None:
+            task = asyncio.ensure_future(self._refresh(exchange_id))
+            self._in_flight[exchange_id] = task
+        await asyncio.shield(task)
+
+    async def _refresh(self, exchange_id: str):
+        client = getattr(ccxt, exchange_id)()
+        try:
+            await client.load_markets(reload=True)
+            loaded_at = self.clock()
+            self._store(exchange_id, client, loaded_at)
+            await asyncio.to_thread(self._write_file, exchange_id, client.markets, client.currencies, loaded_at)
+        finally:
+            self._in_flight.pop(exchange_id, None)
+            # only the HTTP session is released; the indexed metadata stays usable as template
+            await client.close()
+
+    def request(self, exchange_id: str):
+        """
+                Schedules a background load for an exchange that has no cached metadata yet.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+                """
+        if exchange_id in self._in_flight:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.create_task(self._refresh_logged(exchange_id))
+
+    async def _refresh_logged(self, exchange_id: str):
+        try:
+            await self.refresh(exchange_id)
+        except Exception as e:
+            logger.warning(f"Error loading markets of {exchange_id}: {str(e)}")
+
+    async def warmup(self, exchange_ids):
+        """
+                Loads the metadata of the given exchanges at startup and keeps it fresh afterwards.
+
+                Cache files are used immediately, even when stale; stale or missing entries are then reloaded from
+                the exchange. The coroutine runs until it is cancelled.
+
+                Args:
+                    exchange_ids (iterable): The ccxt IDs of the exchanges in use.
+                """
+        exchange_ids = set(exchange_ids)
+        for exchange_id in exchange_ids:
+            await asyncio.to_thread(self.load_from_disk, exchange_id)
+        while True:
+            exchange_ids.update(self._templates)
+            await asyncio.gather(*(self._refresh_logged(exchange_id) for exchange_id in exchange_ids
+                                   if self.is_stale(exchange_id)))
+            await asyncio.sleep(min(self.refresh_seconds, 60))
+
+    def stats(self):
+        """
+                Returns the cached exchanges and the age of their metadata.
+
+                Returns:
+                    dict: Age in seconds per cached exchange ID.
+                """
+        now = self.clock()
+        return {exchange_id: round(now - loaded_at, 1) for exchange_id, loaded_at in self._loaded_at.items()}
+
+
+market_cache = MarketCache()
@@ -0,0 +1,126 @@
+"""
+Metrics Helpers
+
+This module contains small in-process metric containers that components use to report latencies through the
+`/metrics/` endpoint.
+"""
+import time
+from collections import deque
+from contextlib import contextmanager
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats:
+    """
+        Accumulates durations and reports count, mean, percentiles and maximum.
+
+        Percentiles are computed over a bounded window of the most recent samples.
+
+        Attributes:
+            count (int): Number of recorded samples.
+            total (float): Sum of all recorded durations in seconds.
+            max (float): Longest recorded duration in seconds.
+        """
+
+    def __init__(self, window: int = 1024):
+        """
+                Initializes empty LatencyStats.
+
+                Args:
+                    window (int): Number of recent samples kept for percentiles.
+                """
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        """
+                Records one duration.
+
+                Args:
+                    seconds (float): The measured duration in seconds.
+                """
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float:
+        """
+                Returns a percentile of the recent samples.
+
+                Args:
+                    q (float): The percentile between 0 and 100.
+
+                Returns:
+                    float: The duration in seconds, or 0.0 without samples.
+                """
+        if not self._samples:
+            return 0.0
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def snapshot(self):
+        """
+                Returns the current values in milliseconds.
+
+                Returns:
+                    dict: Count, mean, p50, p99 and max.
+                """
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3)
+        }
+
+
+class StageLatency:
+    """
+        Latency statistics of the named stages of a multi-step operation.
+
+        Attributes:
+            stages (dict): LatencyStats by stage name, in pipeline order.
+            clock (callable): Monotonic time source, replaceable for tests.
+        """
+
+    def __init__(self, stages, window: int = 1024, clock=time.perf_counter):
+        """
+                Initializes StageLatency with one empty LatencyStats per stage.
+
+                Args:
+                    stages (iterable): The stage names.
+                    window (int): Number of recent samples kept for percentiles.
+                    clock (callable): Monotonic time source.
+                """
+        self.stages = {stage: LatencyStats(window) for stage in stages}
+        self.clock = clock
+
+    @contextmanager
+    def measure(self, stage: str):
+        """
+                Records the duration of the enclosed block under a stage, also when the block raises.
+
+                Args:
+                    stage (str): The stage name.
+                """
+        started_at = self.clock()
+        try:
+            yield
+        finally:
+            self.stages[stage].record(self.clock() - started_at)
+
+    def snapshot(self):
+        """
+                Returns the current values of all stages in milliseconds.
+
+                Returns:
+                    dict: LatencyStats snapshots by stage name.
+                """
+        return {stage: stats.snapshot() for stage, stats in self.stages.items()}
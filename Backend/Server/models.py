@@ -14,13 +14,23 @@ defined:
 - Membership: Defines different membership types available, detailing features and pricing.
 - Abo: Manages subscription details for accounts including start and end dates and the status of the subscription.
 - Subscription: Represents a subscription in the database, including details like amount, dates, product name, status, currency, and associated account.
+- OrderSyncCursor: Stores per API key the exchange timestamp up to which order updates have been reconciled.
+- Position: Stores per API key and symbol the open quantity, average entry and realized profit/loss of its trades.
+- LedgerAccount: Stores per API key when its balances in the balance ledger were last reconciled and used.
+- LedgerBalance: Stores the free balance of a currency of an API key as known to the balance ledger.
+- BalanceReservation: Stores an amount reserved in the balance ledger for an order that is being submitted.
+- PairPrice: Stores the last price of an (exchange, symbol) pair that a server process streams PnL for.
+- WorkerHeartbeat: Stores the last heartbeat of every server process that takes part in running background jobs.
+- JobLease: Stores which server process runs the background jobs of a key (e.g. an account) until when.
+- QueuedJob: Stores a side effect (e.g. an email) that is executed by the job queue, with its retry state.
+- DeadLetterJob: Stores queued jobs that failed on every attempt, for inspection and manual retry.
 
 Each class maps to a specific table in the database and includes primary keys, foreign keys, and necessary constraints
 to ensure data integrity. Relationships between tables are established through foreign keys, enabling connected data
 operations across the system.
 """
 
-from sqlalchemy import Column, String, Integer, DATE, Float, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, String, Integer, DATE, Float, Boolean, ForeignKey, DateTime, Text
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
 import logging
@@ -171,11 +181,15 @@ class Trade(Base):
     api_id = Column("api_id", Integer, ForeignKey("api.api_id"), nullable=False)
     api = relationship("Api", back_populates="trades")
     stop_loss_price = Column("stop_loss_price", Float, nullable=True)
+    exchange_order_id = Column("exchange_order_id", String(100), nullable=True)
+    stop_loss_order_id = Column("stop_loss_order_id", String(100), nullable=True)
+    # volume already sold by Take-Profit legs; currency_volume is what is left
+    settled_volume = Column("settled_volume", Float, nullable=True)
     take_profits = relationship("TakeProfit", back_populates="trade")
 
     def __init__(self, trade_price, trade_type, currency_name, currency_volume, trade_status, date_create, api_id,
                  stop_loss_price=None, date_bought=None, date_sale=None, purchase_rate=None, selling_rate=None,
-                 comment=None):
+                 comment=None, exchange_order_id=None, stop_loss_order_id=None, settled_volume=None):
         self.trade_price = trade_price
         self.trade_type = trade_type
         self.currency_name = currency_name
@@ -189,6 +203,9 @@ class Trade(Base):
         self.purchase_rate = purchase_rate
         self.selling_rate = selling_rate
         self.comment = comment
+        self.exchange_order_id = exchange_order_id
+        self.stop_loss_order_id = stop_loss_order_id
+        self.settled_volume = settled_volume
 
 
 class TakeProfit(Base):
@@ -199,11 +216,13 @@ class TakeProfit(Base):
     takeprofit_id = Column("takeprofit_id", Integer, primary_key=True, unique=True, autoincrement=True)
     price = Column("price", Float, nullable=False)
     trade_id = Column("trade_id", Integer, ForeignKey("trade.trade_id"), nullable=False)
+    exchange_order_id = Column("exchange_order_id", String(100), nullable=True)
     trade = relationship("Trade", back_populates="take_profits")
 
-    def __init__(self, trade_id, price):
+    def __init__(self, trade_id, price, exchange_order_id=None):
         self.trade_id = trade_id
         self.price = price
+        self.exchange_order_id = exchange_order_id
 
 
 class Membership(Base):
@@ -288,3 +307,192 @@ class Subscription(Base):
         self.currency = currency
         self.account_id = account_id
         self.payment_id = payment_id
+
+
+class OrderSyncCursor(Base):
+    """
+    Stores per API key the exchange timestamp (in milliseconds) up to which closed orders have been reconciled.
+    """
+    __tablename__ = 'order_sync_cursor'
+    api_id = Column("api_id", Integer, ForeignKey("api.api_id"), primary_key=True)
+    since = Column("since", Integer, nullable=False)
+    updated_at = Column("updated_at", DateTime, default=datetime.utcnow, nullable=False)
+
+    def __init__(self, api_id, since):
+        self.api_id = api_id
+        self.since = since
+
+
+class Position(Base):
+    """
+    Stores the net position of an API key in a symbol, maintained incrementally from its trades.
+    """
+    __tablename__ = 'position'
+    api_id = Column("api_id", Integer, ForeignKey("api.api_id"), primary_key=True)
+    symbol = Column("symbol", String(50), primary_key=True)
+    quantity = Column("quantity", Float, nullable=False)
+    cost_basis = Column("cost_basis", Float, nullable=False)
+    average_entry = Column("average_entry", Float, nullable=True)
+    realized_pnl = Column("realized_pnl", Float, nullable=False)
+    open_trades = Column("open_trades", Integer, nullable=False)
+    updated_at = Column("updated_at", DateTime, default=datetime.utcnow, nullable=False)
+
+    def __init__(self, api_id, symbol, quantity=0.0, cost_basis=0.0, average_entry=None, realized_pnl=0.0,
+                 open_trades=0):
+        self.api_id = api_id
+        self.symbol = symbol
+        self.quantity = quantity
+        self.cost_basis = cost_basis
+        self.average_entry = average_entry
+        self.realized_pnl = realized_pnl
+        self.open_trades = open_trades
+
+
+
+class LedgerAccount(Base):
+    """
+    Stores per API key when the balance ledger last reconciled its balances with the exchange (None when stale) and
+    when it last placed an order.
+    """
+    __tablename__ = 'ledger_account'
+    api_id = Column("api_id", Integer, ForeignKey("api.api_id"), primary_key=True)
+    reconciled_at = Column("reconciled_at", DateTime, nullable=True)
+    last_used = Column("last_used", DateTime, nullable=False)
+
+    def __init__(self, api_id, reconciled_at, last_used):
+        self.api_id = api_id
+        self.reconciled_at = reconciled_at
+        self.last_used = last_used
+
+
+class LedgerBalance(Base):
+    """
+    Stores the free balance of a currency of an API key in the balance ledger.
+    """
+    __tablename__ = 'ledger_balance'
+    api_id = Column("api_id", Integer, ForeignKey("api.api_id"), primary_key=True)
+    currency = Column("currency", String(20), primary_key=True)
+    free = Column("free", Float, nullable=False)
+
+    def __init__(self, api_id, currency, free):
+        self.api_id = api_id
+        self.currency = currency
+        self.free = free
+
+
+class BalanceReservation(Base):
+    """
+    Stores an amount of a currency that the balance ledger reserved for an order in flight.
+    """
+    __tablename__ = 'balance_reservation'
+    reservation_id = Column("reservation_id", String(32), primary_key=True)
+    api_id = Column("api_id", Integer, ForeignKey("api.api_id"), nullable=False, index=True)
+    currency = Column("currency", String(20), nullable=False)
+    amount = Column("amount", Float, nullable=False)
+    created_at = Column("created_at", DateTime, nullable=False)
+
+    def __init__(self, reservation_id, api_id, currency, amount, created_at):
+        self.reservation_id = reservation_id
+        self.api_id = api_id
+        self.currency = currency
+        self.amount = amount
+        self.created_at = created_at
+
+
+class PairPrice(Base):
+    """
+    Stores the last price of a pair watched by the live PnL stream of a server process, the API entry whose client
+    fetches it and when a process last asked for it.
+    """
+    __tablename__ = 'pair_price'
+    exchange_id = Column("exchange_id", String(50), primary_key=True)
+    symbol = Column("symbol", String(50), primary_key=True)
+    api_id = Column("api_id", Integer, ForeignKey("api.api_id"), nullable=False)
+    price = Column("price", Float, nullable=True)
+    wanted_at = Column("wanted_at", DateTime, nullable=False)
+    updated_at = Column("updated_at", DateTime, nullable=True)
+
+    def __init__(self, exchange_id, symbol, api_id, wanted_at, price=None, updated_at=None):
+        self.exchange_id = exchange_id
+        self.symbol = symbol
+        self.api_id = api_id
+        self.wanted_at = wanted_at
+        self.price = price
+        self.updated_at = updated_at
+
+class WorkerHeartbeat(Base):
+    """
+    Stores the last heartbeat of a server process that takes part in running background jobs.
+    """
+    __tablename__ = 'worker_heartbeat'
+    worker_id = Column("worker_id", String(100), primary_key=True)
+    heartbeat_at = Column("heartbeat_at", DateTime, nullable=False)
+
+    def __init__(self, worker_id, heartbeat_at):
+        self.worker_id = worker_id
+        self.heartbeat_at = heartbeat_at
+
+
+class JobLease(Base):
+    """
+    Stores which server process owns the background jobs of a key until the lease expires.
+    """
+    __tablename__ = 'job_lease'
+    lease_key = Column("lease_key", String(100), primary_key=True)
+    owner = Column("owner", String(100), nullable=False)
+    expires_at = Column("expires_at", DateTime, nullable=False)
+
+    def __init__(self, lease_key, owner, expires_at):
+        self.lease_key = lease_key
+        self.owner = owner
+        self.expires_at = expires_at
+
+
+class QueuedJob(Base):
+    """
+    Stores a job of the persistent job queue: its kind, JSON payload, optional idempotency key and retry state.
+    """
+    __tablename__ = 'queued_job'
+    job_id = Column("job_id", Integer, primary_key=True, autoincrement=True)
+    kind = Column("kind", String(50), nullable=False)
+    payload = Column("payload", Text, nullable=False)
+    idempotency_key = Column("idempotency_key", String(200), unique=True, nullable=True)
+    status = Column("status", String(20), nullable=False, index=True)
+    attempts = Column("attempts", Integer, nullable=False)
+    max_attempts = Column("max_attempts", Integer, nullable=False)
+    run_at = Column("run_at", DateTime, nullable=False, index=True)
+    locked_by = Column("locked_by", String(100), nullable=True)
+    locked_until = Column("locked_until", DateTime, nullable=True)
+    last_error = Column("last_error", Text, nullable=True)
+    created_at = Column("created_at", DateTime, default=datetime.utcnow, nullable=False)
+    finished_at = Column("finished_at", DateTime, nullable=True)
+
+    def __init__(self, kind, payload, status, attempts, max_attempts, run_at, idempotency_key=None):
+        self.kind = kind
+        self.payload = payload
+        self.status = status
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.run_at = run_at
+        self.idempotency_key = idempotency_key
+
+
+class DeadLetterJob(Base):
+    """
+    Stores a queued job that failed on all of its attempts, together with its last error.
+    """
+    __tablename__ = 'dead_letter_job'
+    dead_letter_id = Column("dead_letter_id", Integer, primary_key=True, autoincrement=True)
+    job_id = Column("job_id", Integer, ForeignKey("queued_job.job_id"), nullable=False)
+    kind = Column("kind", String(50), nullable=False)
+    payload = Column("payload", Text, nullable=False)
+    attempts = Column("attempts", Integer, nullable=False)
+    last_error = Column("last_error", Text, nullable=True)
+    failed_at = Column("failed_at", DateTime, default=datetime.utcnow, nullable=False)
+
+    def __init__(self, job_id, kind, payload, attempts, last_error):
+        self.job_id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.last_error = last_error
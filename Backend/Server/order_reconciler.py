@@ -0,0 +1,529 @@
+"""
+Order Reconciler
+
+This module detects fills and cancellations of pending limit orders in bulk. Each pass asks every API key with
+pending limit trades for its open orders once; only orders that are no longer open are looked up in the closed orders
+since the key's persisted cursor, so the request count follows the number of accounts instead of the number of
+trades. All changed trades are written in one batch.
+
+Background passes only poll the API keys that have an order due for a check. The poll planner gives every pending
+order its own next check time from the distance between its limit price and the last seen price of its pair and from
+the recent volatility of that pair: the check is due once the price could have moved that far, so orders near the
+market are checked every few seconds and orders far away only every few minutes. With several server processes, each
+one only polls the accounts whose lease bucket it holds (see lease_coordinator).
+"""
+import asyncio
+import math
+import os
+import time
+from datetime import datetime
+from ccxt.base.errors import ArgumentsRequired
+from sqlalchemy import or_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import joinedload, selectinload
+from database import SessionLocal
+from models import Api, Trade, OrderSyncCursor
+from exchange_pool import exchange_pool
+from request_scheduler import request_scheduler, Priority
+from balance_ledger import balance_ledger
+from positions import position_store
+from trigger_engine import trigger_engine
+from price_service import price_service
+from metrics import LatencyStats
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+ORDER_SYNC_MIN_SECONDS = float(os.getenv("ORDER_SYNC_MIN_SECONDS", "5"))
+ORDER_SYNC_MAX_SECONDS = float(os.getenv("ORDER_SYNC_MAX_SECONDS", "300"))
+# closed orders are re-read for this long behind the cursor, in case the exchange reports them late
+CURSOR_OVERLAP_MS = 60 * 1000
+CANCELED_STATUSES = ('canceled', 'expired', 'rejected')
+# volatility per square root of a second that is assumed for a pair before its prices were observed
+ORDER_SYNC_DEFAULT_VOLATILITY = float(os.getenv("ORDER_SYNC_DEFAULT_VOLATILITY", "0.0002"))
+ORDER_SYNC_VOLATILITY_HALFLIFE = float(os.getenv("ORDER_SYNC_VOLATILITY_HALFLIFE", "900"))
+# number of standard deviations the price must be away from a limit before its check is put off
+ORDER_SYNC_SAFETY_FACTOR = float(os.getenv("ORDER_SYNC_SAFETY_FACTOR", "3"))
+
+
+class PollPlanner:
+    """
+        Chooses the next check time of every pending limit order.
+
+        The volatility of each pair is an exponentially weighted mean of its squared log returns per second, updated
+        from the prices observed by the reconciliation passes. An order at relative distance d from the price is
+        checked again after (d / (safety_factor * volatility))^2 seconds, bounded by the intervals of the reconciler.
+
+        Attributes:
+            min_interval (float): Shortest delay between two checks of an order.
+            max_interval (float): Longest delay between two checks of an order.
+            detection_latency (LatencyStats): Time between the last check that saw an order open and the check that
+                found it filled or cancelled.
+        """
+
+    def __init__(self, min_interval: float, max_interval: float,
+                 default_volatility: float = ORDER_SYNC_DEFAULT_VOLATILITY,
+                 halflife: float = ORDER_SYNC_VOLATILITY_HALFLIFE,
+                 safety_factor: float = ORDER_SYNC_SAFETY_FACTOR, clock=time.monotonic):
+        """
+                Initializes a PollPlanner without prices.
+
+                Args:
+                    min_interval (float): Shortest delay between two checks of an order.
+                    max_interval (float): Longest delay between two checks of an order.
+                    default_volatility (float): Volatility per square root of a second of unobserved pairs.
+                    halflife (float): Seconds after which an observed return has half its weight.
+                    safety_factor (float): Standard deviations between an order and the price before it is put off.
+                    clock (callable): Monotonic time source.
+                """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.default_volatility = default_volatility
+        self.halflife = halflife
+        self.safety_factor = safety_factor
+        self.clock = clock
+        self.detection_latency = LatencyStats()
+        self._prices = {}
+        self._variances = {}
+        self._checked = {}
+        self._delays = {}
+        self._due = {}
+
+    def observe(self, exchange_id: str, symbol: str, price: float):
+        """
+                Records the price of a pair and updates its volatility.
+                """
+        if not price or price <= 0:
+            return
+        key = (exchange_id, symbol)
+        now = self.clock()
+        previous = self._prices.get(key)
+        self._prices[key] = (now, price)
+        if previous is None or now <= previous[0]:
+            return
+        elapsed = now - previous[0]
+        weight = 1 - math.exp(-elapsed * math.log(2) / self.halflife)
+        variance = self._variances.get(key, self.default_volatility ** 2)
+        self._variances[key] = (1 - weight) * variance + weight * math.log(price / previous[1]) ** 2 / elapsed
+
+    def volatility(self, exchange_id: str, symbol: str) -> float:
+        """
+                Returns the estimated volatility of a pair per square root of a second.
+                """
+        return math.sqrt(self._variances.get((exchange_id, symbol), self.default_volatility ** 2))
+
+    def delay(self, exchange_id: str, symbol: str, limit_price: float) -> float:
+        """
+                Returns the seconds an order can wait between two checks.
+
+                Orders of pairs without an observed price are checked at the shortest interval.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+                    symbol (str): The trading pair symbol.
+                    limit_price (float): The limit price of the order.
+
+                Returns:
+                    float: The delay in seconds.
+                """
+        entry = self._prices.get((exchange_id, symbol))
+        if entry is None or not limit_price or limit_price <= 0:
+            return self.min_interval
+        distance = abs(math.log(limit_price / entry[1]))
+        volatility = self.volatility(exchange_id, symbol)
+        if volatility <= 0:
+            return self.max_interval
+        return min(max((distance / (self.safety_factor * volatility)) ** 2, self.min_interval), self.max_interval)
+
+    def plan(self, trades, exchange_ids):
+        """
+                Updates the due times of the pending orders from the current prices and returns the due ones.
+
+                Orders seen for the first time are due at once. Orders that are no longer pending are forgotten.
+
+                Args:
+                    trades (list): The pending limit trades.
+                    exchange_ids (dict): The ccxt exchange ID by API ID.
+
+                Returns:
+                    list: The trades that are due for a check.
+                """
+        now = self.clock()
+        self._checked = {trade.trade_id: self._checked[trade.trade_id]
+                         for trade in trades if trade.trade_id in self._checked}
+        self._delays = {trade.trade_id: self.delay(exchange_ids[trade.api_id], trade.currency_name, trade.trade_price)
+                        for trade in trades}
+        self._due = {trade_id: self._checked.get(trade_id, now - delay) + delay
+                     for trade_id, delay in self._delays.items()}
+        return [trade for trade in trades if self._due[trade.trade_id] <= now]
+
+    def next_due(self):
+        """
+                Returns the seconds until the next order is due, or None without pending orders.
+                """
+        return min(self._due.values()) - self.clock() if self._due else None
+
+    def checked(self, trades):
+        """
+                Records that orders were seen open at the exchange.
+                """
+        now = self.clock()
+        for trade in trades:
+            self._checked[trade.trade_id] = now
+            self._due[trade.trade_id] = now + self._delays.get(trade.trade_id, self.min_interval)
+
+    def settled(self, trades):
+        """
+                Records the detection latency of orders found filled or cancelled and forgets them.
+                """
+        now = self.clock()
+        for trade in trades:
+            self._due.pop(trade.trade_id, None)
+            checked = self._checked.pop(trade.trade_id, None)
+            if checked is not None:
+                self.detection_latency.record(now - checked)
+
+
+class OrderReconciler:
+    """
+        Reconciles pending limit trades with the exchanges in bulk.
+
+        Attributes:
+            session_factory (callable): Creates the database sessions of the reconciliation passes.
+            min_interval (float): Shortest delay between two checks of an order.
+            max_interval (float): Longest delay between two checks of an order.
+            interval (float): Seconds until the next background pass.
+        """
+
+    def __init__(self, session_factory=SessionLocal, min_interval: float = ORDER_SYNC_MIN_SECONDS,
+                 max_interval: float = ORDER_SYNC_MAX_SECONDS):
+        """
+                Initializes an OrderReconciler.
+
+                Args:
+                    session_factory (callable): Creates the database sessions of the reconciliation passes.
+                    min_interval (float): Shortest delay between two checks of an order.
+                    max_interval (float): Longest delay between two checks of an order.
+                """
+        self.session_factory = session_factory
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.planner = PollPlanner(min_interval, max_interval)
+        self.pending_trades = 0
+        self.passes = 0
+        self.requests = 0
+        self.polled_keys = 0
+        self.skipped_keys = 0
+        self.updated_trades = 0
+        self._wake = None
+
+    async def _call(self, method, *args):
+        self.requests += 1
+        return await request_scheduler.call(Priority.POLLING, method, *args)
+
+    @staticmethod
+    def _pending_trades(db, account_id: int = None, accounts=None):
+        """
+                Loads the limit trades whose entry order is neither filled nor cancelled.
+
+                Trades created before exchange order IDs were stored cannot be matched and are skipped.
+
+                Args:
+                    db (Session): Database session.
+                    account_id (int, optional): Only load the trades of this account.
+                    accounts (optional): Only load the trades whose API entry matches this filter.
+                """
+        query = db.query(Trade).options(joinedload(Trade.api), selectinload(Trade.take_profits)).filter(
+            Trade.trade_type == 'limit',
+            Trade.date_bought.is_(None),
+            Trade.exchange_order_id.isnot(None),
+            or_(Trade.trade_status.is_(None), Trade.trade_status.notin_(CANCELED_STATUSES)))
+        if account_id is not None:
+            query = query.filter(Trade.api.has(Api.accountID == account_id))
+        if accounts is not None:
+            query = query.filter(Trade.api.has(accounts))
+        return query.all()
+
+    async def _fetch_open_ids(self, exchange, symbols):
+        """
+                Returns the IDs of the open orders of a client, with one request if the exchange allows it.
+
+                Returns:
+                    tuple: The open order IDs and the symbols they cover, or None if they cover all symbols.
+                """
+        # the pooled clients are built without ccxt's warning about account-wide requests, see exchange_pool
+        try:
+            orders = await self._call(exchange.fetch_open_orders)
+        except ArgumentsRequired:
+            results = await asyncio.gather(*(self._call(exchange.fetch_open_orders, symbol) for symbol in symbols))
+            return {order['id'] for result in results for order in result}, set(symbols)
+        return {order['id'] for order in orders}, None
+
+    async def _reconcile_api(self, api, trades, since: int, symbols=None):
+        """
+                Finds the pending trades of one API key whose entry order was filled or cancelled.
+
+                Args:
+                    api (Api): The API entry.
+                    trades (list): Its pending limit trades.
+                    since (int): The cursor in milliseconds.
+                    symbols (set, optional): The symbols to check if open orders must be requested per symbol; all
+                        symbols of the trades by default.
+
+                Returns:
+                    tuple: The changed trades as (trade, order) pairs, the new cursor and the trades that were checked.
+                """
+        exchange = exchange_pool.get(api)
+        open_ids, covered = await self._fetch_open_ids(exchange, symbols or {trade.currency_name for trade in trades})
+        if covered is not None:
+            trades = [trade for trade in trades if trade.currency_name in covered]
+        settled = {trade.exchange_order_id: trade for trade in trades if trade.exchange_order_id not in open_ids}
+        if not settled:
+            return [], since, trades
+
+        found = {}
+        newest = since
+        symbols = list({trade.currency_name for trade in settled.values()})
+        results = await asyncio.gather(*(self._call(exchange.fetch_closed_orders, symbol, since)
+                                         for symbol in symbols))
+        for orders in results:
+            for order in orders:
+                newest = max(newest, order.get('lastTradeTimestamp') or order.get('timestamp') or 0)
+                if order['id'] in settled:
+                    found[order['id']] = order
+
+        # cancelled orders are not closed orders on most exchanges, so they are looked up one by one
+        missing = [order_id for order_id in settled if order_id not in found]
+        orders = await asyncio.gather(*(self._call(exchange.fetch_order, order_id, settled[order_id].currency_name)
+                                        for order_id in missing))
+        found.update(zip(missing, orders))
+
+        changed = [(settled[order_id], order) for order_id, order in found.items()
+                   if order['status'] == 'closed' or order['status'] in CANCELED_STATUSES]
+        return changed, max(since, newest - CURSOR_OVERLAP_MS), trades
+
+    @staticmethod
+    async def _refresh_prices(trades, clients):
+        """
+                Refreshes the prices of the pairs of pending trades with one batched request per exchange.
+
+                Prices that are still fresh in the ticker cache are not requested again.
+
+                Args:
+                    trades (list): The pending limit trades.
+                    clients (dict): The pooled client by API ID.
+
+                Returns:
+                    dict: Last price by (exchange ID, symbol); empty if the request failed.
+                """
+        pairs = {(clients[trade.api_id].id, trade.currency_name): clients[trade.api_id] for trade in trades}
+        try:
+            return await price_service.get_prices_for_pairs(
+                [(exchange, symbol) for (_, symbol), exchange in pairs.items()], Priority.POLLING)
+        except Exception as e:
+            logger.warning(f"Error refreshing limit order prices: {str(e)}")
+            return {}
+
+    def _load_pass(self, account_id: int = None, accounts=None):
+        """
+                Loads the pending trades and the cursors of their API keys in a new session; blocking, runs in a worker
+                thread.
+
+                Returns:
+                    tuple: The detached trades and the cursors in milliseconds by API ID.
+                """
+        db = self.session_factory()
+        try:
+            trades = self._pending_trades(db, account_id, accounts)
+            api_ids = list({trade.api_id for trade in trades})
+            cursors = {cursor.api_id: cursor.since
+                       for cursor in db.query(OrderSyncCursor).filter(OrderSyncCursor.api_id.in_(api_ids))}
+            return trades, cursors
+        finally:
+            db.close()
+
+    def _store_pass(self, cursors: dict, updates: list, fills: list):
+        """
+                Writes the new cursors, the changed trades and their positions in one transaction; blocking, runs in a
+                worker thread.
+
+                Args:
+                    cursors (dict): The new cursors in milliseconds by API ID.
+                    updates (list): The changed columns of each changed trade.
+                    fills (list): The position deltas of the filled trades.
+                """
+        db = self.session_factory()
+        try:
+            now = datetime.utcnow()
+            for api_id, since in cursors.items():
+                statement = insert(OrderSyncCursor).values(api_id=api_id, since=since, updated_at=now)
+                db.execute(statement.on_conflict_do_update(index_elements=[OrderSyncCursor.api_id],
+                                                           set_={"since": since, "updated_at": now}))
+            if updates:
+                db.bulk_update_mappings(Trade, updates)
+                position_store.apply(db, fills)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def reconcile(self, account_id: int = None, only_due: bool = False, accounts=None):
+        """
+                Runs one reconciliation pass and writes all changed trades in one transaction.
+
+                The database is read and written in worker threads with sessions of their own, so the pass does not
+                block the event loop.
+
+                Args:
+                    account_id (int, optional): Only reconcile the API keys of this account.
+                    only_due (bool): Only poll the API keys with an order that is due for a check.
+                    accounts (optional): Only reconcile the API entries matching this filter, e.g. the accounts
+                        whose lease bucket this process holds.
+
+                Returns:
+                    int: Number of updated trades.
+                """
+        trades, cursors = await asyncio.to_thread(self._load_pass, account_id, accounts)
+        if account_id is None:
+            self.pending_trades = len(trades)
+        self.passes += 1
+        if not trades:
+            return 0
+
+        by_api = {}
+        for trade in trades:
+            by_api.setdefault(trade.api_id, (trade.api, []))[1].append(trade)
+        symbols = {}
+        if only_due:
+            clients = {api_id: exchange_pool.get(api) for api_id, (api, _) in by_api.items()}
+            for (exchange_id, symbol), price in (await self._refresh_prices(trades, clients)).items():
+                self.planner.observe(exchange_id, symbol, price)
+            due = self.planner.plan(trades, {api_id: client.id for api_id, client in clients.items()})
+            for trade in due:
+                symbols.setdefault(trade.api_id, set()).add(trade.currency_name)
+            self.skipped_keys += len(by_api) - len(symbols)
+            by_api = {api_id: entry for api_id, entry in by_api.items() if api_id in symbols}
+            if not by_api:
+                self._plan_interval()
+                return 0
+        self.polled_keys += len(by_api)
+
+        def initial_cursor(api_trades):
+            first_day = min(trade.date_create for trade in api_trades)
+            return int(datetime.combine(first_day, datetime.min.time()).timestamp() * 1000)
+
+        api_ids = list(by_api)
+        results = await asyncio.gather(*(
+            self._reconcile_api(api, api_trades,
+                                cursors[api_id] if api_id in cursors else initial_cursor(api_trades),
+                                symbols.get(api_id))
+            for api_id, (api, api_trades) in by_api.items()), return_exceptions=True)
+
+        new_cursors = {}
+        updates = []
+        fills = []
+        filled_trades = []
+        settled_api_ids = set()
+        for api_id, result in zip(api_ids, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Error reconciling orders of API {api_id}: {str(result)}")
+                continue
+            changed, since, checked = result
+            self.planner.checked(checked)
+            self.planner.settled([trade for trade, _ in changed])
+            new_cursors[api_id] = since
+            for trade, order in changed:
+                if order['status'] == 'closed':
+                    filled_at = order.get('lastTradeTimestamp') or order.get('timestamp')
+                    date_bought = datetime.fromtimestamp(filled_at / 1000) if filled_at else datetime.now()
+                    updates.append({'trade_id': trade.trade_id, 'date_bought': date_bought.date()})
+                    fills.append(position_store.fill(trade))
+                    # the trade is detached, so it is updated here for the trigger engine
+                    trade.date_bought = date_bought.date()
+                    filled_trades.append(trade)
+                else:
+                    updates.append({'trade_id': trade.trade_id, 'trade_status': order['status']})
+                settled_api_ids.add(api_id)
+
+        await asyncio.to_thread(self._store_pass, new_cursors, updates, fills)
+
+        # the levels of a limit trade are watched from its fill on
+        for trade in filled_trades:
+            trigger_engine.watch(trade, exchange_pool.get(trade.api))
+        for api_id in settled_api_ids:
+            await balance_ledger.mark_stale(api_id)
+        self.updated_trades += len(updates)
+        if only_due:
+            self._plan_interval()
+        return len(updates)
+
+    def _plan_interval(self):
+        """
+                Sets the interval of the background loop to the time until the next order is due.
+                """
+        next_due = self.planner.next_due()
+        self.interval = self.max_interval if next_due is None else min(max(next_due, self.min_interval),
+                                                                       self.max_interval)
+
+    def wake(self):
+        """
+                Starts the next background pass now, e.g. after a limit order was placed.
+                """
+        if self._wake is not None:
+            self._wake.set()
+
+    async def run(self, leases=None):
+        """
+                Runs reconciliation passes until cancelled.
+
+                Each pass polls the API keys with due orders and sleeps until the next order is due, at least
+                `min_interval` and at most `max_interval` seconds; without pending trades it sleeps `max_interval`.
+
+                Args:
+                    leases (LeaseCoordinator, optional): Only the accounts whose lease bucket this process holds are
+                        polled, and passes are skipped while it holds none; all accounts by default.
+                """
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if leases is not None and not leases.owned_buckets():
+                continue
+            try:
+                await self.reconcile(only_due=True, accounts=leases.accounts_filter() if leases is not None else None)
+            except Exception as e:
+                logger.warning(f"Error reconciling orders: {str(e)}")
+                self.interval = self.min_interval
+            if not self.pending_trades:
+                self.interval = self.max_interval
+
+    def stats(self):
+        """
+                Returns the reconciler counters.
+
+                Returns:
+                    dict: Current interval, pending trades, passes, exchange requests, polled and skipped API keys,
+                    the share of skipped API keys, updated trades and the detection latency of fills.
+                """
+        polls = self.polled_keys + self.skipped_keys
+        return {
+            "interval_seconds": self.interval,
+            "pending_trades": self.pending_trades,
+            "passes": self.passes,
+            "requests": self.requests,
+            "polled_keys": self.polled_keys,
+            "skipped_keys": self.skipped_keys,
+            "request_savings": round(self.skipped_keys / polls, 3) if polls else 0.0,
+            "updated_trades": self.updated_trades,
+            "detection_latency": self.planner.detection_latency.snapshot()
+        }
+
+
+order_reconciler = OrderReconciler()
@@ -0,0 +1,435 @@
+"""
+Live PnL Stream
+
+This module pushes the profit/loss of the open trades of subscribed accounts over the websocket. The open trades of
+an account are loaded when it subscribes and indexed by their (exchange, symbol) pair. Every price of a watched pair
+that passes through the ticker cache is applied only to the trades of that pair, and the account totals are adjusted
+by the change of their value, so a tick costs work proportional to the trades in its pair instead of all trades. The
+changed trades and the new totals are sent to the subscribers of every affected account. A periodic job reloads the
+trades of subscribed accounts, so opened and closed trades appear.
+
+The prices of the watched pairs are shared through the `pair_price` table: every server process registers the pairs
+it watches and applies the stored prices, and only the process that holds the "pnl_prices" lease fetches them from
+the exchanges, with one batched request per exchange for the pairs of all processes.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.dialects.sqlite import insert
+from database import SessionLocal
+from models import Api, PairPrice
+from exchange_pool import exchange_pool
+from price_service import price_service
+from request_scheduler import Priority
+from portfolio_pnl import PortfolioPnL
+from web_socket import manager, websocket_action
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+PNL_STREAM_SECONDS = float(os.getenv("PNL_STREAM_SECONDS", "2"))
+PNL_STREAM_RELOAD_SECONDS = float(os.getenv("PNL_STREAM_RELOAD_SECONDS", "30"))
+# pairs that no process asked for within this time are no longer fetched
+PNL_PRICE_WANTED_SECONDS = float(os.getenv("PNL_PRICE_WANTED_SECONDS", "60"))
+
+
+def _percentage(amount: float, cost: float):
+    return amount / cost * 100 if cost else None
+
+
+class PnLStream:
+    """
+        Keeps the profit/loss of the open trades of subscribed accounts up to date.
+
+        Attributes:
+            connections (ConnectionManager): Delivers the updates to the subscribers of an account.
+            ticks (int): Prices that changed the value of watched trades.
+            updated_trades (int): Trade valuations recomputed by ticks.
+        """
+
+    def __init__(self, session_factory=SessionLocal, connections=manager,
+                 reload_seconds: float = PNL_STREAM_RELOAD_SECONDS, wanted_seconds: float = PNL_PRICE_WANTED_SECONDS,
+                 clock=time.monotonic, utc_clock=datetime.utcnow):
+        """
+                Initializes an empty PnLStream.
+
+                Args:
+                    session_factory (callable): Creates the database sessions that load trades and prices.
+                    connections (ConnectionManager): Delivers the updates to the subscribers of an account.
+                    reload_seconds (float): Seconds after which the trades of subscribed accounts are reloaded.
+                    wanted_seconds (float): Seconds after which a pair that no process asked for is not fetched.
+                    clock (callable): Monotonic time source.
+                    utc_clock (callable): Returns the current UTC time of the stored prices.
+                """
+        self.session_factory = session_factory
+        self.connections = connections
+        self.reload_seconds = reload_seconds
+        self.wanted_seconds = wanted_seconds
+        self.clock = clock
+        self.utc_clock = utc_clock
+        self.ticks = 0
+        self.updated_trades = 0
+        # trade ID -> [account ID, volume, entry price, value or None] by (exchange ID, symbol)
+        self._pairs = {}
+        # cost and value of the priced trades and the pairs of each account
+        self._accounts = {}
+        # the client and API ID a pair is priced with, picked from the API entries of its trades
+        self._clients = {}
+        self._api_ids = {}
+        # (API ID, client) by trade ID
+        self._trade_apis = {}
+        self._prices = {}
+        self._loaded_at = {}
+
+    @staticmethod
+    def topic(account_id: int):
+        return "pnl", account_id
+
+    def _load(self, account_id: int):
+        """
+                Loads the open trades and API entries of an account; blocking, runs in a worker thread.
+
+                Returns:
+                    tuple: Rows of (trade ID, API ID, symbol, volume, entry price) and the detached API entries.
+                """
+        db = self.session_factory()
+        try:
+            rows = PortfolioPnL.load(db, account_id)
+            apis = db.query(Api).filter(Api.api_id.in_({row[1] for row in rows})).all() if rows else []
+            for api in apis:
+                db.expunge(api)
+            return rows, apis
+        finally:
+            db.close()
+
+    def _drop(self, account_id: int):
+        """
+                Removes the trades of an account from the index.
+                """
+        account = self._accounts.pop(account_id, None)
+        self._loaded_at.pop(account_id, None)
+        if account is None:
+            return
+        for pair in account["pairs"]:
+            trades = self._pairs.get(pair, {})
+            for trade_id in [trade_id for trade_id, trade in trades.items() if trade[0] == account_id]:
+                del trades[trade_id]
+                self._trade_apis.pop(trade_id, None)
+            if not trades:
+                self._pairs.pop(pair, None)
+                self._clients.pop(pair, None)
+                self._api_ids.pop(pair, None)
+                self._prices.pop(pair, None)
+            elif self._api_ids.get(pair) not in {self._trade_apis[trade_id][0] for trade_id in trades}:
+                # the pair was priced with the API entry of the dropped account
+                self._api_ids[pair], self._clients[pair] = self._trade_apis[next(iter(trades))]
+
+    async def reload(self, account_id: int):
+        """
+                Loads the open trades of an account into the index, replacing the ones loaded before.
+
+                Trades of pairs with a known price are valued at once.
+                """
+        rows, apis = await asyncio.to_thread(self._load, account_id)
+        clients = {api.api_id: exchange_pool.get(api) for api in apis}
+        known_prices = dict(self._prices)
+        self._drop(account_id)
+        account = {"cost": 0.0, "value": 0.0, "pairs": set()}
+        self._accounts[account_id] = account
+        self._loaded_at[account_id] = self.clock()
+        for trade_id, api_id, symbol, volume, entry in rows:
+            if volume is None or entry is None:
+                continue
+            pair = (clients[api_id].id, symbol)
+            self._clients.setdefault(pair, clients[api_id])
+            self._api_ids.setdefault(pair, api_id)
+            self._trade_apis[trade_id] = (api_id, clients[api_id])
+            trade = [account_id, volume, entry, None]
+            self._pairs.setdefault(pair, {})[trade_id] = trade
+            account["pairs"].add(pair)
+            if pair in known_prices:
+                self._prices[pair] = known_prices[pair]
+                self._value(account, trade, known_prices[pair])
+
+    @staticmethod
+    def _value(account: dict, trade: list, price: float):
+        """
+                Values a trade at a price and adjusts the totals of its account by the change.
+                """
+        _, volume, entry, value = trade
+        new_value = volume * price
+        if value is None:
+            account["cost"] += volume * entry
+            account["value"] += new_value
+        else:
+            account["value"] += new_value - value
+        trade[3] = new_value
+
+    def on_ticker(self, exchange_id: str, symbol: str, ticker: dict):
+        """
+                Ticker cache listener that applies the price of a watched pair.
+                """
+        self.apply_price((exchange_id, symbol), ticker.get('last'))
+
+    def apply_price(self, pair: tuple, price: float):
+        """
+                Revalues the trades of a pair and sends the changed trades and totals to each affected account.
+
+                Args:
+                    pair (tuple): The (exchange ID, symbol) pair.
+                    price (float): The last price of the pair.
+                """
+        trades = self._pairs.get(pair)
+        if not trades or price is None or self._prices.get(pair) == price:
+            return
+        self._prices[pair] = price
+        updates = {}
+        for trade_id, trade in trades.items():
+            self._value(self._accounts[trade[0]], trade, price)
+            updates.setdefault(trade[0], []).append(self._describe(trade_id, trade, price))
+        self.ticks += 1
+        self.updated_trades += len(trades)
+
+        exchange_id, symbol = pair
+        for account_id, trade_updates in updates.items():
+            # a newer update of the same pair replaces a pending one, it carries the current state of all its trades
+            self.connections.publish(self.topic(account_id), {
+                "type": "pnl",
+                "exchange": exchange_id,
+                "symbol": symbol,
+                "price": price,
+                "trades": trade_updates,
+                "total": self.totals(account_id)
+            }, key=("pnl", exchange_id, symbol))
+
+    @staticmethod
+    def _describe(trade_id: int, trade: list, price: float):
+        _, volume, entry, value = trade
+        amount = value - volume * entry
+        return {
+            "trade_id": trade_id,
+            "current_price": price,
+            "entry_price": entry,
+            "profit_loss_amount": amount,
+            "profit_loss_percentage": _percentage(amount, volume * entry)
+        }
+
+    def totals(self, account_id: int):
+        """
+                Returns the totals of the priced open trades of an account.
+
+                Returns:
+                    dict: Cost basis, market value, profit/loss amount and percentage.
+                """
+        account = self._accounts.get(account_id)
+        if account is None:
+            return {"cost_basis": 0.0, "market_value": 0.0, "profit_loss_amount": 0.0,
+                    "profit_loss_percentage": None}
+        amount = account["value"] - account["cost"]
+        return {
+            "cost_basis": account["cost"],
+            "market_value": account["value"],
+            "profit_loss_amount": amount,
+            "profit_loss_percentage": _percentage(amount, account["cost"])
+        }
+
+    def snapshot(self, account_id: int):
+        """
+                Returns the priced open trades of an account and its totals.
+                """
+        account = self._accounts.get(account_id)
+        trades = []
+        for pair in (account["pairs"] if account else ()):
+            for trade_id, trade in self._pairs[pair].items():
+                if trade[0] == account_id and trade[3] is not None:
+                    trades.append(dict(self._describe(trade_id, trade, self._prices[pair]),
+                                       exchange=pair[0], symbol=pair[1]))
+        return {"type": "pnl_snapshot", "trades": trades, "total": self.totals(account_id)}
+
+    async def refresh_prices(self, pairs=None):
+        """
+                Fetches the prices of watched pairs with one batched request per exchange and applies them.
+
+                Used for pairs without a stored price yet. Prices that were served from the ticker cache did not pass
+                the listener, so all results are applied.
+
+                Args:
+                    pairs (iterable, optional): The pairs to refresh; all watched pairs by default.
+                """
+        pairs = [pair for pair in (self._pairs if pairs is None else pairs) if pair in self._clients]
+        if not pairs:
+            return
+        prices = await price_service.get_prices_for_pairs([(self._clients[pair], pair[1]) for pair in pairs],
+                                                          Priority.DASHBOARD)
+        for pair, price in prices.items():
+            self.apply_price(pair, price)
+
+    def _sync_prices(self, wanted: dict):
+        """
+                Registers the pairs this process watches and reads their stored prices; blocking, runs in a worker
+                thread.
+
+                Args:
+                    wanted (dict): The API ID whose client can fetch a pair, by (exchange ID, symbol).
+
+                Returns:
+                    dict: The stored prices of the pairs by (exchange ID, symbol).
+                """
+        now = self.utc_clock()
+        db = self.session_factory()
+        try:
+            for (exchange_id, symbol), api_id in wanted.items():
+                statement = insert(PairPrice).values(exchange_id=exchange_id, symbol=symbol, api_id=api_id,
+                                                     wanted_at=now)
+                db.execute(statement.on_conflict_do_update(
+                    index_elements=[PairPrice.exchange_id, PairPrice.symbol], set_={"wanted_at": now}))
+            db.commit()
+            rows = db.query(PairPrice.exchange_id, PairPrice.symbol, PairPrice.price).filter(
+                PairPrice.price.isnot(None))
+            return {(exchange_id, symbol): price for exchange_id, symbol, price in rows
+                    if (exchange_id, symbol) in wanted}
+        finally:
+            db.close()
+
+    async def sync_prices(self, pairs=None):
+        """
+                Registers the watched pairs for the price fetch and applies their stored prices.
+
+                Args:
+                    pairs (iterable, optional): The pairs to sync; all watched pairs by default.
+                """
+        wanted = {pair: self._api_ids[pair] for pair in (self._pairs if pairs is None else pairs)
+                  if pair in self._api_ids}
+        if not wanted:
+            return
+        prices = await asyncio.to_thread(self._sync_prices, wanted)
+        for pair, price in prices.items():
+            self.apply_price(pair, price)
+
+    def _load_wanted(self):
+        """
+                Forgets pairs that no process asked for lately and loads the others with their API entries; blocking,
+                runs in a worker thread.
+
+                Returns:
+                    list: Tuples of ((exchange ID, symbol), detached API entry).
+                """
+        db = self.session_factory()
+        try:
+            db.query(PairPrice).filter(
+                PairPrice.wanted_at < self.utc_clock() - timedelta(seconds=self.wanted_seconds)).delete(
+                synchronize_session=False)
+            db.commit()
+            rows = db.query(PairPrice.exchange_id, PairPrice.symbol, PairPrice.api_id).all()
+            apis = {api.api_id: api for api in db.query(Api).filter(Api.api_id.in_({row[2] for row in rows}))}
+            db.expunge_all()
+            return [((exchange_id, symbol), apis[api_id]) for exchange_id, symbol, api_id in rows if api_id in apis]
+        finally:
+            db.close()
+
+    def _store_prices(self, prices: dict):
+        """
+                Stores fetched prices; blocking, runs in a worker thread.
+                """
+        now = self.utc_clock()
+        db = self.session_factory()
+        try:
+            for (exchange_id, symbol), price in prices.items():
+                db.query(PairPrice).filter(PairPrice.exchange_id == exchange_id, PairPrice.symbol == symbol).update(
+                    {"price": price, "updated_at": now}, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    async def fetch_wanted_prices(self):
+        """
+                Fetches the prices of the pairs watched by any server process and stores them; registered as a
+                periodic job that only runs in the process holding the "pnl_prices" lease.
+
+                Returns:
+                    int: Number of stored prices.
+                """
+        wanted = await asyncio.to_thread(self._load_wanted)
+        if not wanted:
+            return 0
+        prices = await price_service.get_prices_for_pairs([(exchange_pool.get(api), symbol)
+                                                           for (_, symbol), api in wanted], Priority.DASHBOARD)
+        await asyncio.to_thread(self._store_prices, prices)
+        return len(prices)
+
+    async def subscribe(self, websocket, account_id: int):
+        """
+                Subscribes a connection to the PnL updates of an account.
+
+                Returns:
+                    dict: The current snapshot of the account.
+                """
+        self.connections.join(websocket, self.topic(account_id))
+        if account_id not in self._accounts:
+            await self.reload(account_id)
+            pairs = self._accounts[account_id]["pairs"]
+            await self.sync_prices(pairs)
+            # the first snapshot should not wait for the next fetch of the lease holder
+            await self.refresh_prices([pair for pair in pairs if pair not in self._prices])
+        return self.snapshot(account_id)
+
+    async def run_once(self):
+        """
+                Forgets accounts without subscribers, reloads stale accounts and applies the stored prices of the
+                watched pairs; registered as a periodic job of every server process. Reloaded accounts are sent a new
+                snapshot.
+                """
+        for account_id in list(self._accounts):
+            if self.topic(account_id) not in self.connections.topics:
+                self._drop(account_id)
+        now = self.clock()
+        reloaded = []
+        for account_id, loaded_at in list(self._loaded_at.items()):
+            if now - loaded_at >= self.reload_seconds:
+                try:
+                    await self.reload(account_id)
+                    reloaded.append(account_id)
+                except Exception as e:
+                    logger.warning(f"Error reloading trades of account {account_id}: {str(e)}")
+        await self.sync_prices()
+        # opened and closed trades change the set of trades, so the subscribers get a new snapshot
+        for account_id in reloaded:
+            if account_id in self._accounts:
+                self.connections.publish(self.topic(account_id), self.snapshot(account_id), key=("pnl", "snapshot"))
+
+    def stats(self):
+        """
+                Returns the size of the stream.
+
+                Returns:
+                    dict: Number of subscribed accounts, watched pairs and trades, ticks and recomputed trades.
+                """
+        return {
+            "accounts": len(self._accounts),
+            "pairs": len(self._pairs),
+            "trades": sum(len(trades) for trades in self._pairs.values()),
+            "ticks": self.ticks,
+            "updated_trades": self.updated_trades
+        }
+
+
+pnl_stream = PnLStream()
+
+
+@websocket_action("subscribe_pnl")
+async def subscribe_pnl(websocket, user_id: int, request: dict):
+    """
+        Websocket action that subscribes the connection to the live PnL of the user's open trades.
+        """
+    return dict(await pnl_stream.subscribe(websocket, user_id), status="subscribed", channel="pnl")
+
+
+@websocket_action("unsubscribe_pnl")
+async def unsubscribe_pnl(websocket, user_id: int, request: dict):
+    """
+        Websocket action that ends the live PnL updates of the connection.
+        """
+    pnl_stream.connections.unsubscribe(websocket, PnLStream.topic(user_id))
+    return {"status": "unsubscribed", "channel": "pnl"}
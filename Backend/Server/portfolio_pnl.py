@@ -0,0 +1,157 @@
+"""
+Portfolio PnL Engine
+
+This module values all open trades of an account in one pass. The trades are loaded with a single column query
+into NumPy arrays (volume, entry price, index of the (exchange, symbol) pair), the prices of all pairs are fetched
+with one batched ticker request per exchange, and per-trade, per-symbol and total profit/loss are computed with
+vectorized array operations instead of one query and one ticker fetch per trade.
+"""
+import numpy as np
+from fastapi import HTTPException
+from models import Api, Trade
+from exchange_pool import exchange_pool
+from price_service import price_service
+from request_scheduler import Priority
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+
+def compute_pnl(volumes, entries, pair_index, prices):
+    """
+        Computes profit/loss of trades against a price vector.
+
+        Args:
+            volumes (numpy.ndarray): Volume of each trade.
+            entries (numpy.ndarray): Entry price of each trade.
+            pair_index (numpy.ndarray): Index of each trade's (exchange, symbol) pair into `prices`.
+            prices (numpy.ndarray): Current price of each pair.
+
+        Returns:
+            dict: Arrays 'amount' and 'percentage' per trade, 'pair_volume', 'pair_cost', 'pair_value' and
+            'pair_amount' per pair, and the scalars 'total_cost', 'total_value' and 'total_amount'.
+        """
+    current = prices[pair_index]
+    cost = entries * volumes
+    value = current * volumes
+    amount = value - cost
+    with np.errstate(divide='ignore', invalid='ignore'):
+        percentage = np.where(entries != 0, (current - entries) / entries * 100, np.nan)
+    pairs = len(prices)
+    return {
+        "amount": amount,
+        "percentage": percentage,
+        "pair_volume": np.bincount(pair_index, weights=volumes, minlength=pairs),
+        "pair_cost": np.bincount(pair_index, weights=cost, minlength=pairs),
+        "pair_value": np.bincount(pair_index, weights=value, minlength=pairs),
+        "pair_amount": np.bincount(pair_index, weights=amount, minlength=pairs),
+        "total_cost": float(cost.sum()),
+        "total_value": float(value.sum()),
+        "total_amount": float(amount.sum()),
+    }
+
+
+def _percentage(amount: float, cost: float):
+    return amount / cost * 100 if cost else None
+
+
+def _finite(value):
+    return float(value) if np.isfinite(value) else None
+
+
+class PortfolioPnL:
+    """
+        Values the open trades of an account.
+        """
+
+    @staticmethod
+    def load(db, account_id: int):
+        """
+                Loads the open, filled trades of an account as columns.
+
+                The entry price is the purchase rate of market trades and the limit price of filled limit trades.
+
+                Args:
+                    db (Session): Database session.
+                    account_id (int): The account ID.
+
+                Returns:
+                    list: Rows of (trade ID, API ID, symbol, volume, entry price).
+                """
+        rows = db.query(Trade.trade_id, Trade.api_id, Trade.currency_name, Trade.currency_volume,
+                        Trade.purchase_rate, Trade.trade_price).join(Api).filter(
+            Api.accountID == account_id,
+            Trade.date_sale.is_(None),
+            Trade.date_bought.isnot(None) | Trade.purchase_rate.isnot(None)).all()
+        return [(trade_id, api_id, symbol, volume,
+                 purchase_rate if purchase_rate is not None else trade_price)
+                for trade_id, api_id, symbol, volume, purchase_rate, trade_price in rows]
+
+    async def compute(self, db, account_id: int):
+        """
+                Computes the profit/loss of all open trades of an account.
+
+                Args:
+                    db (Session): Database session.
+                    account_id (int): The account ID.
+
+                Raises:
+                    HTTPException: If the prices cannot be fetched.
+
+                Returns:
+                    dict: Per-trade, per-symbol and total profit/loss.
+                """
+        rows = self.load(db, account_id)
+        if not rows:
+            return {"trades": [], "symbols": [],
+                    "total": {"cost_basis": 0.0, "market_value": 0.0, "profit_loss_amount": 0.0,
+                              "profit_loss_percentage": None}}
+
+        clients = {api.api_id: exchange_pool.get(api)
+                   for api in db.query(Api).filter(Api.api_id.in_({row[1] for row in rows}))}
+        pairs = {}
+        pair_index = np.empty(len(rows), dtype=np.intp)
+        for position, (_, api_id, symbol, _, _) in enumerate(rows):
+            key = (clients[api_id].id, symbol)
+            pair_index[position] = pairs.setdefault(key, (len(pairs), clients[api_id]))[0]
+
+        try:
+            prices_by_pair = await price_service.get_prices_for_pairs(
+                ((client, symbol) for (_, symbol), (_, client) in pairs.items()), Priority.VALUATION)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching prices: {str(e)}")
+        prices = np.array([prices_by_pair[key] for key in pairs], dtype=np.float64)
+
+        result = compute_pnl(np.array([row[3] for row in rows], dtype=np.float64),
+                             np.array([row[4] for row in rows], dtype=np.float64),
+                             pair_index, prices)
+
+        return {
+            "trades": [{
+                "trade_id": row[0],
+                "symbol": row[2],
+                "profit_loss_amount": float(amount),
+                "profit_loss_percentage": _finite(percentage)
+            } for row, amount, percentage in zip(rows, result["amount"], result["percentage"])],
+            "symbols": [{
+                "exchange": exchange_id,
+                "symbol": symbol,
+                "volume": float(result["pair_volume"][index]),
+                "price": float(prices[index]),
+                "cost_basis": float(result["pair_cost"][index]),
+                "market_value": float(result["pair_value"][index]),
+                "profit_loss_amount": float(result["pair_amount"][index]),
+                "profit_loss_percentage": _percentage(float(result["pair_amount"][index]),
+                                                      float(result["pair_cost"][index]))
+            } for (exchange_id, symbol), (index, _) in pairs.items()],
+            "total": {
+                "cost_basis": result["total_cost"],
+                "market_value": result["total_value"],
+                "profit_loss_amount": result["total_amount"],
+                "profit_loss_percentage": _percentage(result["total_amount"], result["total_cost"])
+            }
+        }
+
+
+portfolio_pnl = PortfolioPnL()
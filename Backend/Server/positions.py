@@ -0,0 +1,284 @@
+"""
+Position Store
+
+This module maintains the `position` table: per API key and symbol the open quantity, cost basis, average entry and
+realized profit/loss of its trades. Every write of the trade service turns the trades it fills, closes or removes into
+deltas that are applied in the same transaction, so position and exposure queries read one row per symbol instead of
+scanning the trade history. The table can be rebuilt from the trades and checked against them:
+
+    python positions.py rebuild
+    python positions.py check
+"""
+import argparse
+from datetime import datetime
+from sqlalchemy import func, tuple_
+from models import Api, Trade, Position
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+# quantities below this are treated as a closed position, so floating point residue does not leave an average entry
+QUANTITY_EPSILON = 1e-12
+
+
+class PositionStore:
+    """
+        Applies trade deltas to the position table and rebuilds or checks it.
+
+        A delta is a tuple of (API ID, symbol, quantity, cost, realized profit/loss, open trades).
+
+        Attributes:
+            applied (int): Number of deltas applied.
+        """
+
+    def __init__(self):
+        """
+                Initializes a PositionStore.
+                """
+        self.applied = 0
+
+    @staticmethod
+    def entry_price(trade):
+        """
+                Returns the entry price of an open trade: the purchase rate of market trades, the limit price otherwise.
+                """
+        return trade.purchase_rate if trade.purchase_rate is not None else trade.trade_price
+
+    @staticmethod
+    def filled_filter():
+        """
+                Returns the query filter of the trades whose entry order was filled, see `is_filled`.
+                """
+        return Trade.date_bought.isnot(None) | Trade.purchase_rate.isnot(None)
+
+    @staticmethod
+    def is_filled(trade):
+        """
+                Returns whether the entry order of a trade was filled: market trades at once, limit trades once bought.
+                """
+        return trade.date_bought is not None or trade.purchase_rate is not None
+
+    def fill(self, trade, entry: float = None):
+        """
+                Returns the delta of a trade that was filled.
+
+                Args:
+                    trade (Trade): The trade.
+                    entry (float, optional): The entry price, read from the trade if omitted.
+                """
+        entry = self.entry_price(trade) if entry is None else entry
+        return trade.api_id, trade.currency_name, trade.currency_volume, trade.currency_volume * entry, 0.0, 1
+
+    def close(self, trade, entry: float, realized: float = 0.0):
+        """
+                Returns the delta of a filled trade that was sold or removed.
+
+                Args:
+                    trade (Trade): The trade.
+                    entry (float): Its entry price, read before the close overwrites the purchase rate.
+                    realized (float): The realized profit/loss.
+                """
+        return trade.api_id, trade.currency_name, -trade.currency_volume, -trade.currency_volume * entry, realized, -1
+
+    def reduce(self, trade, volume: float, entry: float, realized: float):
+        """
+                Returns the delta of a part of an open trade that was sold, e.g. by one of its Take-Profit legs.
+
+                Args:
+                    trade (Trade): The trade, which stays open.
+                    volume (float): The sold volume.
+                    entry (float): Its entry price.
+                    realized (float): The realized profit/loss of the sold volume.
+                """
+        return trade.api_id, trade.currency_name, -volume, -volume * entry, realized, 0
+
+    def apply(self, db, deltas):
+        """
+                Adds deltas to the positions in the session without committing.
+
+                Args:
+                    db (Session): Database session of the trade write.
+                    deltas (iterable): The deltas.
+                """
+        merged = {}
+        for api_id, symbol, quantity, cost, realized, open_trades in deltas:
+            total = merged.setdefault((api_id, symbol), [0.0, 0.0, 0.0, 0])
+            total[0] += quantity
+            total[1] += cost
+            total[2] += realized
+            total[3] += open_trades
+        if not merged:
+            return
+        positions = {(position.api_id, position.symbol): position for position in
+                     db.query(Position).filter(tuple_(Position.api_id, Position.symbol).in_(list(merged)))}
+        for key, (quantity, cost, realized, open_trades) in merged.items():
+            position = positions.get(key)
+            if position is None:
+                position = Position(api_id=key[0], symbol=key[1])
+                db.add(position)
+            position.quantity += quantity
+            position.cost_basis += cost
+            position.realized_pnl += realized
+            position.open_trades += open_trades
+            self._settle(position)
+            position.updated_at = datetime.utcnow()
+        # the sessions do not autoflush, so a later write in the same transaction would not see new rows otherwise
+        db.flush()
+        self.applied += len(merged)
+
+    @staticmethod
+    def _settle(position):
+        if position.open_trades <= 0 or abs(position.quantity) < QUANTITY_EPSILON:
+            position.quantity = 0.0
+            position.cost_basis = 0.0
+            position.average_entry = None
+        else:
+            position.average_entry = position.cost_basis / position.quantity
+
+    @staticmethod
+    def _compute(db):
+        """
+                Computes all positions from the trades.
+
+                Returns:
+                    dict: Lists of [quantity, cost, realized profit/loss, open trades] by (API ID, symbol).
+                """
+        entry = func.coalesce(Trade.purchase_rate, Trade.trade_price)
+        computed = {}
+        for api_id, symbol, quantity, cost, count in db.query(
+                Trade.api_id, Trade.currency_name, func.sum(Trade.currency_volume),
+                func.sum(Trade.currency_volume * entry), func.count(Trade.trade_id)).filter(
+                Trade.date_sale.is_(None), PositionStore.filled_filter()).group_by(Trade.api_id, Trade.currency_name):
+            computed[(api_id, symbol)] = [quantity, cost, 0.0, count]
+        # open trades hold the profit/loss their Take-Profit legs realized so far
+        for api_id, symbol, realized in db.query(
+                Trade.api_id, Trade.currency_name, func.sum(Trade.selling_rate)).filter(
+                Trade.selling_rate.isnot(None)).group_by(Trade.api_id, Trade.currency_name):
+            computed.setdefault((api_id, symbol), [0.0, 0.0, 0.0, 0])[2] = realized
+        return computed
+
+    def rebuild(self, db):
+        """
+                Replaces the position table with positions computed from the trades and commits.
+
+                Args:
+                    db (Session): Database session.
+
+                Returns:
+                    int: Number of positions written.
+                """
+        computed = self._compute(db)
+        for position in db.query(Position):
+            values = computed.pop((position.api_id, position.symbol), None)
+            if values is None:
+                db.delete(position)
+                continue
+            position.quantity, position.cost_basis, position.realized_pnl, position.open_trades = values
+            self._settle(position)
+            position.updated_at = datetime.utcnow()
+        for (api_id, symbol), (quantity, cost, realized, open_trades) in computed.items():
+            position = Position(api_id=api_id, symbol=symbol, quantity=quantity, cost_basis=cost,
+                                realized_pnl=realized, open_trades=open_trades)
+            self._settle(position)
+            db.add(position)
+        db.commit()
+        return db.query(Position).count()
+
+    def ensure_built(self, db):
+        """
+                Rebuilds the position table if it is empty while trades exist, e.g. after it was added to a database.
+
+                Args:
+                    db (Session): Database session.
+                """
+        if db.query(Position).first() is None and db.query(Trade.trade_id).first() is not None:
+            self.rebuild(db)
+
+    def check(self, db, tolerance: float = 1e-6):
+        """
+                Compares the position table with positions computed from the trades.
+
+                Args:
+                    db (Session): Database session.
+                    tolerance (float): Allowed absolute difference of quantities and amounts.
+
+                Returns:
+                    list: One dict per mismatching (API ID, symbol) with the stored and computed values.
+                """
+        computed = self._compute(db)
+        stored = {(position.api_id, position.symbol): [position.quantity, position.cost_basis,
+                                                        position.realized_pnl, position.open_trades]
+                  for position in db.query(Position)}
+        mismatches = []
+        for key in sorted(set(computed) | set(stored), key=str):
+            expected = computed.get(key, [0.0, 0.0, 0.0, 0])
+            if expected[3] == 0:
+                expected = [0.0, 0.0, expected[2], 0]
+            actual = stored.get(key, [0.0, 0.0, 0.0, 0])
+            if any(abs(a - e) > tolerance for a, e in zip(actual, expected)):
+                mismatches.append({"api_id": key[0], "symbol": key[1],
+                                   "stored": dict(zip(("quantity", "cost_basis", "realized_pnl", "open_trades"),
+                                                      actual)),
+                                   "computed": dict(zip(("quantity", "cost_basis", "realized_pnl", "open_trades"),
+                                                        expected))})
+        return mismatches
+
+    @staticmethod
+    def of_account(db, account_id: int):
+        """
+                Returns the positions of an account.
+
+                Args:
+                    db (Session): Database session.
+                    account_id (int): The account ID.
+
+                Returns:
+                    list: One dict per (exchange, symbol) with quantity, cost basis, average entry and realized
+                    profit/loss.
+                """
+        rows = db.query(Position, Api.exchange_name).join(Api, Api.api_id == Position.api_id).filter(
+            Api.accountID == account_id).all()
+        return [{
+            "exchange_name": exchange_name,
+            "symbol": position.symbol,
+            "quantity": position.quantity,
+            "cost_basis": position.cost_basis,
+            "average_entry": position.average_entry,
+            "realized_pnl": position.realized_pnl,
+            "open_trades": position.open_trades
+        } for position, exchange_name in rows]
+
+    def stats(self):
+        """
+                Returns the store counters.
+
+                Returns:
+                    dict: Number of applied deltas.
+                """
+        return {"applied": self.applied}
+
+
+position_store = PositionStore()
+
+
+if __name__ == "__main__":
+    from database import SessionLocal, init_db
+
+    parser = argparse.ArgumentParser(description="Rebuild or check the position table.")
+    parser.add_argument("command", choices=("rebuild", "check"))
+    arguments = parser.parse_args()
+
+    init_db()
+    session = SessionLocal()
+    try:
+        if arguments.command == "rebuild":
+            print(f"{position_store.rebuild(session)} positions rebuilt")
+        else:
+            mismatches = position_store.check(session)
+            for mismatch in mismatches:
+                print(mismatch)
+            print(f"{len(mismatches)} mismatching positions")
+            raise SystemExit(1 if mismatches else 0)
+    finally:
+        session.close()
@@ -0,0 +1,127 @@
+"""
+Batched Price Service
+
+This module resolves the last prices of many symbols at once. Requested symbols are grouped per exchange; each
+group is served from the ticker cache where possible and otherwise fetched with a single `fetch_tickers` call, or
+with a bounded number of concurrent `fetch_ticker` calls on exchanges that do not support batch tickers.
+"""
+import asyncio
+import os
+from ticker_cache import ticker_cache
+from request_scheduler import request_scheduler, Priority
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+PRICE_FETCH_CONCURRENCY = int(os.getenv("PRICE_FETCH_CONCURRENCY", "8"))
+
+
+class PriceService:
+    """
+        Resolves prices for many symbols with as few exchange round-trips as possible.
+
+        Attributes:
+            cache (TickerCache): Cache that batch results are written to and single fetches go through.
+            max_concurrency (int): Upper bound of concurrent single fetches per exchange.
+            batch_requests (int): Number of `fetch_tickers` calls made.
+            single_requests (int): Number of symbols resolved through single fetches.
+            cached_symbols (int): Number of symbols answered from the cache without a request.
+        """
+
+    def __init__(self, cache=ticker_cache, max_concurrency: int = PRICE_FETCH_CONCURRENCY):
+        """
+                Initializes a PriceService.
+
+                Args:
+                    cache (TickerCache): The shared ticker cache.
+                    max_concurrency (int): Upper bound of concurrent single fetches per exchange.
+                """
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.batch_requests = 0
+        self.single_requests = 0
+        self.cached_symbols = 0
+
+    async def get_prices(self, exchange, symbols, priority: Priority = Priority.VALUATION):
+        """
+                Returns the last prices of several symbols on one exchange.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The client used for upstream fetches.
+                    symbols (iterable): The trading pair symbols.
+                    priority (Priority): Scheduling priority of upstream fetches.
+
+                Returns:
+                    dict: Last price by symbol.
+                """
+        prices = {}
+        missing = []
+        for symbol in dict.fromkeys(symbols):
+            ticker = self.cache.peek(exchange.id, symbol)
+            if ticker is not None:
+                prices[symbol] = ticker['last']
+            else:
+                missing.append(symbol)
+        self.cached_symbols += len(prices)
+
+        if missing and exchange.has.get('fetchTickers'):
+            self.batch_requests += 1
+            tickers = await request_scheduler.call(priority, exchange.fetch_tickers, missing)
+            for symbol, ticker in tickers.items():
+                self.cache.put(exchange.id, symbol, ticker)
+                if symbol in missing:
+                    prices[symbol] = ticker['last']
+            missing = [symbol for symbol in missing if symbol not in prices]
+
+        if missing:
+            self.single_requests += len(missing)
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+
+            async def fetch_one(symbol):
+                async with semaphore:
+                    return await self.cache.get_last_price(exchange, symbol, priority)
+
+            for symbol, price in zip(missing, await asyncio.gather(*(fetch_one(symbol) for symbol in missing))):
+                prices[symbol] = price
+        return prices
+
+    async def get_prices_for_pairs(self, pairs, priority: Priority = Priority.VALUATION):
+        """
+                Returns the last prices of (client, symbol) pairs spanning several exchanges.
+
+                The pairs are grouped per exchange and the groups are resolved concurrently.
+
+                Args:
+                    pairs (iterable): Tuples of (ccxt.async_support.Exchange, symbol).
+                    priority (Priority): Scheduling priority of upstream fetches.
+
+                Returns:
+                    dict: Last price by (exchange ID, symbol).
+                """
+        groups = {}
+        for exchange, symbol in pairs:
+            client, symbols = groups.setdefault(exchange.id, (exchange, []))
+            symbols.append(symbol)
+
+        results = await asyncio.gather(*(self.get_prices(client, symbols, priority)
+                                         for client, symbols in groups.values()))
+        return {(exchange_id, symbol): price
+                for exchange_id, prices in zip(groups, results)
+                for symbol, price in prices.items()}
+
+    def stats(self):
+        """
+                Returns the request counters.
+
+                Returns:
+                    dict: Number of batch requests, single requests and symbols served from the cache.
+                """
+        return {
+            "batch_requests": self.batch_requests,
+            "single_requests": self.single_requests,
+            "cached_symbols": self.cached_symbols
+        }
+
+
+price_service = PriceService()
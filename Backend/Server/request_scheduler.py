@@ -0,0 +1,253 @@
+"""
+Exchange Request Scheduler
+
+This module coordinates the outbound request rate of the whole process. Every exchange call passes through
+`RequestScheduler.call`, which waits for a token from the exchange-wide bucket and from the bucket of the API key
+that makes the call. When tokens run out, waiting calls are released strictly by priority, so order placement and
+cancellation go ahead of valuation, dashboard refreshes and background polling. A call that is still waiting can be
+promoted to a higher priority, e.g. when an order joins a fetch that was started for a valuation.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from enum import IntEnum
+from metrics import LatencyStats
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+KEY_REQUESTS_PER_SECOND = float(os.getenv("EXCHANGE_KEY_REQUESTS_PER_SECOND", "5"))
+BURST_SECONDS = float(os.getenv("EXCHANGE_BURST_SECONDS", "1"))
+
+
+class Priority(IntEnum):
+    """
+        Priority classes of exchange calls; lower values are served first.
+        """
+    ORDER = 0
+    VALUATION = 1
+    DASHBOARD = 2
+    POLLING = 3
+
+
+class TokenBucket:
+    """
+        A token bucket refilled continuously at a fixed rate.
+
+        Attributes:
+            rate (float): Tokens added per second.
+            capacity (float): Maximum number of stored tokens.
+            tokens (float): Currently available tokens.
+        """
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        """
+                Initializes a full TokenBucket.
+
+                Args:
+                    rate (float): Tokens added per second.
+                    capacity (float): Maximum number of stored tokens.
+                    now (float): The current clock value.
+                """
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until_token(self) -> float:
+        return max(0.0, (1.0 - self.tokens) / self.rate)
+
+
+class RequestScheduler:
+    """
+        Rate-limits and prioritises exchange calls per exchange and per API key.
+
+        Attributes:
+            exchange_rates (dict): Requests per second by exchange ID; exchanges not listed use their ccxt `rateLimit`.
+            key_rate (float): Requests per second allowed for a single API key.
+            burst_seconds (float): Bucket capacity expressed in seconds of the refill rate.
+            clock (callable): Monotonic time source, replaceable for tests.
+        """
+
+    def __init__(self, exchange_rates: dict = None, key_rate: float = KEY_REQUESTS_PER_SECOND,
+                 burst_seconds: float = BURST_SECONDS, clock=time.monotonic):
+        """
+                Initializes a RequestScheduler without any buckets.
+
+                Args:
+                    exchange_rates (dict, optional): Requests per second by exchange ID.
+                    key_rate (float): Requests per second allowed for a single API key.
+                    burst_seconds (float): Bucket capacity expressed in seconds of the refill rate.
+                    clock (callable): Monotonic time source.
+                """
+        self.exchange_rates = exchange_rates or {}
+        self.key_rate = key_rate
+        self.burst_seconds = burst_seconds
+        self.clock = clock
+        self._exchange_buckets = {}
+        self._key_buckets = {}
+        self._waiting = {}
+        self._timers = {}
+        # waiting calls by the task that makes them, so they can be promoted
+        self._calls = {}
+        self._sequence = itertools.count()
+        self.wait_times = {priority: LatencyStats() for priority in Priority}
+        self.dispatched = 0
+
+    def _buckets(self, exchange):
+        """
+                Returns the exchange-wide bucket and the API key bucket of a client, creating them on first use.
+                """
+        now = self.clock()
+        exchange_bucket = self._exchange_buckets.get(exchange.id)
+        if exchange_bucket is None:
+            rate = self.exchange_rates.get(exchange.id) or 1000 / max(exchange.rateLimit, 1)
+            exchange_bucket = TokenBucket(rate, rate * self.burst_seconds, now)
+            self._exchange_buckets[exchange.id] = exchange_bucket
+        key = (exchange.id, exchange.apiKey or '')
+        key_bucket = self._key_buckets.get(key)
+        if key_bucket is None:
+            key_bucket = TokenBucket(self.key_rate, self.key_rate * self.burst_seconds, now)
+            self._key_buckets[key] = key_bucket
+        return exchange_bucket, key_bucket
+
+    async def acquire(self, exchange, priority: Priority):
+        """
+                Waits until the client may send one request.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The client that is about to send a request.
+                    priority (Priority): The priority class of the request.
+                """
+        enqueued_at = self.clock()
+        exchange_bucket, key_bucket = self._buckets(exchange)
+        waiting = self._waiting.setdefault(exchange.id, [])
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(waiting, (priority, next(self._sequence), key_bucket, future))
+        task = asyncio.current_task()
+        self._calls[task] = [exchange.id, priority, key_bucket, future]
+        self._dispatch(exchange.id)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the token was already granted; hand the turn to the next waiter
+                key_bucket.tokens += 1
+                exchange_bucket.tokens += 1
+            self._dispatch(exchange.id)
+            raise
+        finally:
+            priority = self._calls.pop(task)[1]
+        self.wait_times[priority].record(self.clock() - enqueued_at)
+
+    def promote(self, task: asyncio.Task, priority: Priority):
+        """
+                Raises the priority of the call a task is waiting for; calls that were already released are unchanged.
+
+                Args:
+                    task (asyncio.Task): The task that waits in `call` or `acquire`.
+                    priority (Priority): The new priority class.
+
+                Returns:
+                    bool: Whether a waiting call was promoted.
+                """
+        call = self._calls.get(task)
+        if call is None or call[3].done() or priority >= call[1]:
+            return False
+        exchange_id, _, key_bucket, future = call
+        call[1] = priority
+        # the old entry stays in the heap and is skipped once the future is done
+        heapq.heappush(self._waiting[exchange_id], (priority, next(self._sequence), key_bucket, future))
+        self._dispatch(exchange_id)
+        return True
+
+    def _dispatch(self, exchange_id: str):
+        """
+                Grants tokens to waiting calls of an exchange in priority order and schedules the next attempt.
+
+                A waiter whose API key has no token left is skipped, so other keys with lower priority calls are not
+                held back by it; once the exchange-wide bucket is empty, nobody is released.
+                """
+        timer = self._timers.pop(exchange_id, None)
+        if timer is not None:
+            timer.cancel()
+        now = self.clock()
+        exchange_bucket = self._exchange_buckets[exchange_id]
+        exchange_bucket.refill(now)
+        waiting = self._waiting[exchange_id]
+        remaining = []
+        next_attempt = None
+        while waiting:
+            entry = heapq.heappop(waiting)
+            future, key_bucket = entry[3], entry[2]
+            if future.done():
+                continue
+            key_bucket.refill(now)
+            if exchange_bucket.tokens >= 1 and key_bucket.tokens >= 1:
+                exchange_bucket.tokens -= 1
+                key_bucket.tokens -= 1
+                self.dispatched += 1
+                future.set_result(None)
+                continue
+            remaining.append(entry)
+            delay = max(exchange_bucket.seconds_until_token(), key_bucket.seconds_until_token())
+            next_attempt = delay if next_attempt is None else min(next_attempt, delay)
+            if exchange_bucket.tokens < 1:
+                remaining.extend(waiting)
+                break
+        heapq.heapify(remaining)
+        self._waiting[exchange_id] = remaining
+        if remaining:
+            self._timers[exchange_id] = asyncio.get_running_loop().call_later(
+                next_attempt, self._dispatch, exchange_id)
+
+    async def call(self, priority: Priority, method, *args, **kwargs):
+        """
+                Sends an exchange request once the rate limits allow it.
+
+                Args:
+                    priority (Priority): The priority class of the request.
+                    method: A bound method of a ccxt.async_support client, e.g. `exchange.fetch_ticker`.
+                    *args: Positional arguments of the method.
+                    **kwargs: Keyword arguments of the method.
+
+                Returns:
+                    The result of the exchange method.
+                """
+        await self.acquire(method.__self__, priority)
+        return await method(*args, **kwargs)
+
+    def stats(self):
+        """
+                Returns queue depths and wait times.
+
+                Returns:
+                    dict: Waiting calls per exchange and priority, dispatched calls and wait times per priority.
+                """
+        queue_depth = {}
+        for exchange_id, waiting in self._waiting.items():
+            # a promoted call has one entry per priority it had; it is counted at the highest
+            priorities = {}
+            for entry in waiting:
+                if not entry[3].done():
+                    priorities[entry[3]] = min(entry[0], priorities.get(entry[3], entry[0]))
+            depth = {}
+            for priority in priorities.values():
+                depth[priority.name] = depth.get(priority.name, 0) + 1
+            if depth:
+                queue_depth[exchange_id] = depth
+        return {
+            "queue_depth": queue_depth,
+            "dispatched": self.dispatched,
+            "wait_times": {priority.name: stats.snapshot() for priority, stats in self.wait_times.items()}
+        }
+
+
+request_scheduler = RequestScheduler()
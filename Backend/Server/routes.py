@@ -4,24 +4,37 @@ FastAPI Application File
 This file contains the main FastAPI application setup, including endpoint definitions and event handlers.
 """
 import asyncio
-import json
 from datetime import date, timedelta
 
 from fastapi import FastAPI, Depends, HTTPException, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
-from database import get_db, init_db
+from database import get_db, init_db, SessionLocal
 from fastapi.responses import JSONResponse, RedirectResponse
 from models import Account, Member, Api, AccountPages_Info, Trade, TakeProfit, Subscription
 from schemas import LoginCredentials, UserRegistration, PasswordResetRequest, ApiKeyCreation, OrderRequest, \
-    AddTakeProfitStopLossRequest, UpdateTradeRequest, Subscription_Info, SellRequest
+    BatchOrderRequest, AddTakeProfitStopLossRequest, UpdateTradeRequest, Subscription_Info, SellRequest
 from utils import get_hashed_password, verify_password, create_access_token, generate_reset_token, \
     send_password_reset_email, verify_reset_token, verify_access_token, find_mail, mailTheme, verify_trade_token
 from smtp import send_email
-from trade_service import TradeService
+from trade_service import TradeService, order_pipeline_latency, settle_triggered_trades
+from exchange_pool import exchange_pool
+from ticker_cache import ticker_cache
+from market_cache import market_cache
+from price_service import price_service
+from request_scheduler import request_scheduler, Priority
+from balance_ledger import balance_ledger
+from order_reconciler import order_reconciler
+from trigger_engine import trigger_engine
+from portfolio_pnl import portfolio_pnl
+from positions import position_store
+from pnl_stream import pnl_stream
 import ccxt
 from web_socket import websocket_endpoint
-from background_threading import background_threads
+from background_threading import register_jobs
+from job_scheduler import job_scheduler
+from lease_coordinator import lease_coordinator
+from job_queue import job_queue
 from web_socket import manager
 import logging
 from paypal import Paypal
@@ -39,7 +52,7 @@ app.add_middleware(
     allow_headers=["*"],  # HTTP-Header
 )
 
-background = background_threads()
+startup_tasks = []
 
 
 @app.on_event("startup")
@@ -48,15 +61,52 @@ async def on_startup():
         Event handler function called on application startup.
 
         This function is automatically called when the FastAPI application starts up.
-        It is decorated with `@app.on_event("startup")` to register it as an event handler for the application startup event.
-        Inside this function, it calls the `init_db()` function to initialize the database by creating all tables.
+        It is decorated with `@app.on_event("startup")` to register it as an event handler for the application
+        startup event. Inside this function, it calls the `init_db()` function to initialize the database by creating
+        all tables. It then builds the position table if it is still empty and starts loading the market metadata of
+        all connected exchanges, the limit order reconciliation and the take-profit/stop-loss trigger engine in the
+        background and feeds all prices to the live PnL stream. Finally it starts the job scheduler with the periodic
+        work of the server. Jobs that must run once across all server processes only run in the process holding their
+        lease, which is taken before the scheduler starts.
         """
     init_db()
 
-    # todo: Background async await
+    db = SessionLocal()
+    try:
+        exchange_names = [name for (name,) in db.query(Api.exchange_name).distinct()]
+        position_store.ensure_built(db)
+    finally:
+        db.close()
+    startup_tasks.append(asyncio.create_task(market_cache.warmup(exchange_names)))
+    # the limit orders and trigger levels of an account are handled by the process holding the account's bucket
+    lease_coordinator.want_accounts()
+    startup_tasks.append(asyncio.create_task(order_reconciler.run(lease_coordinator)))
+    startup_tasks.append(asyncio.create_task(trigger_engine.run(settle_triggered_trades, lease_coordinator)))
+    ticker_cache.add_listener(pnl_stream.on_ticker)
+    register_jobs()
+    await lease_coordinator.run_once()
+    job_scheduler.start()
+    job_queue.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    """
+        Event handler function called on application shutdown.
 
+        Stops the job scheduler, the job queue, the websocket publishers and background polling and closes the
+        sessions of all pooled exchange clients.
+        """
+    await job_scheduler.stop()
+    await job_queue.stop()
+    await manager.close()
+    lease_coordinator.release_all()
+    for task in startup_tasks:
+        task.cancel()
+    await exchange_pool.close_all()
 
-app.websocket("\ws\{user_id}")(websocket_endpoint)
+
+app.websocket("/ws")(websocket_endpoint)
 
 
 @app.post("/login/")
@@ -93,9 +143,6 @@ def login(credentials: LoginCredentials, db: Session = Depends(get_db)):
             #if mailAdress:
             #      send_email(mailAdress, mailTheme.login.name, db)
 
-            background.set_authorization(access_token)
-            background.start_background_tasks()
-
             return {"message": "Logged in successfully", "access_token": access_token, "token_type": "bearer"}
         else:
             raise HTTPException(status_code=401, detail="Incorrect username or password")
@@ -167,7 +214,7 @@ def register(user: UserRegistration, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def get_balance_and_currency_count(exchange):
+async def get_balance_and_currency_count(exchange):
     """
         Retrieve the balance and the number of non-zero currency balances from the exchange.
 
@@ -181,7 +228,7 @@ def get_balance_and_currency_count(exchange):
             An error message if there is an issue fetching the balance.
         """
     try:
-        balance = exchange.fetchBalance()
+        balance = await request_scheduler.call(Priority.DASHBOARD, exchange.fetch_balance)
         usdt_balance = balance['total'].get('USDT', -1)
         total_balances = balance['total']
         non_zero_currencies = {currency: amount for currency, amount in total_balances.items() if amount > 0}
@@ -193,7 +240,7 @@ def get_balance_and_currency_count(exchange):
 
 
 @app.post("/connect-exchange/")
-def connect_exchange(exchange_info: ApiKeyCreation, db: Session = Depends(get_db), authorization: str = Header(None)):
+async def connect_exchange(exchange_info: ApiKeyCreation, db: Session = Depends(get_db), authorization: str = Header(None)):
     """
         Connects a user's account to a cryptocurrency exchange using provided API keys.
 
@@ -223,14 +270,7 @@ def connect_exchange(exchange_info: ApiKeyCreation, db: Session = Depends(get_db
     if existing_user:
         raise HTTPException(status_code=400, detail="Exchange Connection already registered")
     try:
-        exchange_class = getattr(ccxt, exchange_info.exchange_name)
-        exchange_args = {
-            'apiKey': exchange_info.key,
-            'secret': exchange_info.secret_key
-        }
-        if exchange_info.passphrase:
-            exchange_args['password'] = exchange_info.passphrase
-        exchange = exchange_class(exchange_args)
+        getattr(ccxt, exchange_info.exchange_name)  # validates the exchange ID before anything is stored
 
         new_ApiKey = Api(
             exchange_name=exchange_info.exchange_name,
@@ -243,7 +283,8 @@ def connect_exchange(exchange_info: ApiKeyCreation, db: Session = Depends(get_db
         db.commit()
         db.refresh(new_ApiKey)
 
-        balance_of_account, number_of_currencies = get_balance_and_currency_count(exchange)
+        exchange = exchange_pool.get(new_ApiKey)
+        balance_of_account, number_of_currencies = await get_balance_and_currency_count(exchange)
 
         new_accountpages_info = AccountPages_Info(
             balance=balance_of_account,
@@ -265,7 +306,7 @@ def connect_exchange(exchange_info: ApiKeyCreation, db: Session = Depends(get_db
 
 
 @app.get("/dashboard/")
-def get_dashboard(db: Session = Depends(get_db), authorization: str = Header(None)):
+async def get_dashboard(db: Session = Depends(get_db), authorization: str = Header(None)):
     """
         Retrieves the dashboard data for the authenticated user.
 
@@ -292,25 +333,19 @@ def get_dashboard(db: Session = Depends(get_db), authorization: str = Header(Non
 
     try:
         api_keys = db.query(Api).filter(Api.accountID == account_id).all()
-        dashboard_data = []
         for api_key in api_keys:
-            if api_key and api_key.account_pages_info:
-                account_holder = api_key.account_pages_info.account_holder
-            else:
+            if not (api_key and api_key.account_pages_info):
                 raise HTTPException(status_code=403, detail="No account pages info available.")
-            exchange_class = getattr(ccxt, api_key.exchange_name)
-            exchange_args = {
-                'apiKey': api_key.key,
-                'secret': api_key.secret_Key
-            }
-            if api_key.passphrase:
-                exchange_args['password'] = api_key.passphrase
-            exchange = exchange_class(exchange_args)
-
-            balance_of_account, number_of_currencies = get_balance_and_currency_count(exchange)
+
+        # the balances of all connected exchanges are fetched concurrently
+        balances = await asyncio.gather(
+            *(get_balance_and_currency_count(exchange_pool.get(api_key)) for api_key in api_keys))
+
+        dashboard_data = []
+        for api_key, (balance_of_account, number_of_currencies) in zip(api_keys, balances):
             dashboard_data.append({
                 "exchange_name": api_key.exchange_name,
-                "account_holder": account_holder,
+                "account_holder": api_key.account_pages_info.account_holder,
                 "balance": balance_of_account,
                 "currency_count": number_of_currencies
             })
@@ -320,6 +355,61 @@ def get_dashboard(db: Session = Depends(get_db), authorization: str = Header(Non
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
 
+@app.get("/portfolio/pnl")
+async def get_portfolio_pnl(db: Session = Depends(get_db), authorization: str = Header(None)):
+    """
+        Retrieves the profit/loss of all open trades of the authenticated user.
+
+        All open trades are valued in one pass against one batched price fetch per exchange.
+
+        Parameters:
+            - db (Session, optional): The database session dependency obtained using `Depends(get_db)`.
+            - authorization (str): The authorization header containing the Bearer token.
+
+        Returns:
+            dict: Per-trade, per-symbol and total profit/loss.
+
+        Raises:
+            HTTPException: If the authorization header is missing or invalid, or the prices cannot be fetched.
+        """
+    if authorization is None or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authorization header missing or invalid.")
+
+    token = authorization.split(" ")[1]
+    payload = verify_trade_token(token)
+    if payload is None:
+        raise HTTPException(status_code=402, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
+
+    return await portfolio_pnl.compute(db, payload.get("account_id"))
+
+
+@app.get("/positions/")
+def get_positions(db: Session = Depends(get_db), authorization: str = Header(None)):
+    """
+        Retrieves the net positions of the authenticated user per exchange and symbol.
+
+        Parameters:
+            - db (Session, optional): The database session dependency obtained using `Depends(get_db)`.
+            - authorization (str): The authorization header containing the Bearer token.
+
+        Returns:
+            dict: A dictionary containing the open quantity, cost basis, average entry and realized profit/loss
+            per exchange and symbol.
+
+        Raises:
+            HTTPException: If the authorization header is missing or invalid.
+        """
+    if authorization is None or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authorization header missing or invalid.")
+
+    token = authorization.split(" ")[1]
+    payload = verify_trade_token(token)
+    if payload is None:
+        raise HTTPException(status_code=402, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
+
+    return {"positions": position_store.of_account(db, payload.get("account_id"))}
+
+
 @app.get("/trades/")
 def get_trade(db: Session = Depends(get_db), authorization: str = Header(None)):
     """
@@ -390,73 +480,60 @@ def get_trade(db: Session = Depends(get_db), authorization: str = Header(None)):
                     })
                 except Exception as e:
                     raise HTTPException(status_code=500, detail=f"Error processing trade data: {str(e)}")
-            # asyncio.create_task(send_real_time_updates(account_id, db, authorization))
         return {"trades": trades_data}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
 
-async def send_real_time_updates(account_id: int, db: Session, authorization: str):
+@app.post("/trades/create-order/")
+async def create_order(order: OrderRequest, db: Session = Depends(get_db), authorization: str = Header(None)):
     """
-        Sends real-time updates of trade prices and selling rates to clients.
+    Creates a market or limit order, optionally with take-profit and/or stop-loss.
 
-        Args:
-            account_id (int): The ID of the account.
-            db (Session): The database session.
-            authorization (str): The authorization token.
+    Parameters:
+        - order (OrderRequest): The order details.
+        - db (Session, optional): The database session dependency obtained using `Depends(get_db)`.
+        - authorization (str): The authorization header containing the Bearer token.
 
-        Returns:
-            None
-        """
-    trade_service = TradeService(db, authorization)
-    api_keys = db.query(Api).filter(Api.accountID == account_id).all()
+    Returns:
+        dict: A dictionary containing the order details if creation is successful.
 
-    while True:
-        for api_key in api_keys:
-            trades = db.query(Trade).filter(Trade.api_id == api_key.api_id).all()
-            exchange = trade_service._get_exchange_instance()
-            for trade in trades:
-                ticker = exchange.fetch_ticker(trade.currency_name)
-                current_price = ticker['last']
-                purchase_rate = trade.purchase_rate
-                selling_rate = (current_price - purchase_rate) * trade.currency_volume
+    Raises:
+        HTTPException: If the authorization header is missing or invalid, or an internal error occurs.
+    """
 
-                message = {
-                    "trade_id": trade.trade_id,
-                    "current_price": current_price,
-                    "purchase_rate": purchase_rate,
-                    "selling_rate": selling_rate
-                }
+    trade_service = TradeService(db, authorization)
 
-                await manager.broadcast(json.dumps(message), account_id)
-        await asyncio.sleep(10)  # Update every 10 seconds
+    return await trade_service.create_order(order)
 
 
-@app.post("/trades/create-order/")
-def create_order(order: OrderRequest, db: Session = Depends(get_db), authorization: str = Header(None)):
+@app.post("/trades/batch")
+async def create_orders(request: BatchOrderRequest, db: Session = Depends(get_db),
+                        authorization: str = Header(None)):
     """
-    Creates a market or limit order, optionally with take-profit and/or stop-loss.
+    Creates several market or limit orders at once, each optionally with take-profit and/or stop-loss.
+
+    All orders are validated before any of them is submitted. Orders are then placed concurrently and all
+    resulting trades are stored in a single transaction.
 
     Parameters:
-        - order (OrderRequest): The order details.
+        - request (BatchOrderRequest): The orders to place.
         - db (Session, optional): The database session dependency obtained using `Depends(get_db)`.
         - authorization (str): The authorization header containing the Bearer token.
 
     Returns:
-        dict: A dictionary containing the order details if creation is successful.
+        dict: A dictionary with one result per order, reporting whether it was created or why it failed.
 
     Raises:
-        HTTPException: If the authorization header is missing or invalid, or an internal error occurs.
+        HTTPException: If the authorization header is missing or invalid, or the trades cannot be stored.
     """
-
     trade_service = TradeService(db, authorization)
-
-    return trade_service.create_order(order)
+    return await trade_service.create_orders(request.orders)
 
 
 @app.post("/trades/add-take-profit-stop-loss/")
-def add_take_profit_stop_loss(request: AddTakeProfitStopLossRequest, db: Session = Depends(get_db),
-                              authorization: str = Header(None)):
+async def add_take_profit_stop_loss(request: AddTakeProfitStopLossRequest, db: Session = Depends(get_db),
+                                    authorization: str = Header(None)):
     """
     Adds take-profit and/or stop-loss orders to an existing trade.
 
@@ -472,12 +549,12 @@ def add_take_profit_stop_loss(request: AddTakeProfitStopLossRequest, db: Session
         HTTPException: If the authorization header is missing or invalid, or an internal error occurs.
     """
     trade_service = TradeService(db, authorization)
-    return trade_service.add_take_profit_and_stop_loss(request.trade_id, request.take_profit_prices,
-                                                       request.stop_loss_price, request.comment)
+    return await trade_service.add_take_profit_and_stop_loss(request.trade_id, request.take_profit_prices,
+                                                             request.stop_loss_price, request.comment)
 
 
 @app.post("/complete_trade/")
-def complete_trade(request: SellRequest, db: Session = Depends(get_db), authorization: str = Header(None)):
+async def complete_trade(request: SellRequest, db: Session = Depends(get_db), authorization: str = Header(None)):
     """
         Completes a trade based on the provided trade ID.
 
@@ -500,12 +577,12 @@ def complete_trade(request: SellRequest, db: Session = Depends(get_db), authoriz
                   }
         """
     trade_service = TradeService(db, authorization)
-    result = trade_service.complete_trade(request.trade_id)
+    result = await trade_service.complete_trade(request.trade_id)
     return result
 
 
 @app.put("/trades/update/")
-def update_trade(request: UpdateTradeRequest, db: Session = Depends(get_db), authorization: str = Header(None)):
+async def update_trade(request: UpdateTradeRequest, db: Session = Depends(get_db), authorization: str = Header(None)):
     """
     Updates the stop-loss and take-profit prices for an existing trade.
 
@@ -521,17 +598,19 @@ def update_trade(request: UpdateTradeRequest, db: Session = Depends(get_db), aut
         HTTPException: If the authorization header is missing or invalid, or an internal error occurs.
     """
     trade_service = TradeService(db, authorization)
-    return trade_service.update_stop_loss_and_take_profits(request.trade_id, request.new_stop_loss_price,
-                                                           request.new_take_profit_prices)
+    return await trade_service.update_stop_loss_and_take_profits(request.trade_id, request.new_stop_loss_price,
+                                                                 request.new_take_profit_prices)
 
 
 @app.delete("/cancel_order/{order_id}")
-def cancel_order(order_id: str, symbol: str, db: Session = Depends(get_db), authorization: str = Header(None)):
+async def cancel_order(order_id: str, symbol: str, db: Session = Depends(get_db), authorization: str = Header(None)):
     """
-        Cancels an order and removes it from the database.
+        Cancels an order. Cancelling the entry order of a trade removes the trade from the database, cancelling a
+        Stop-Loss or Take-Profit leg removes only that leg.
 
         Parameters:
-            - order_id (str): The ID of the order to cancel.
+            - order_id (str): The exchange ID of the order to cancel, or the ID of the trade whose entry order is
+              cancelled.
             - symbol (str): The symbol of the order to cancel.
             - db (Session, optional): The database session dependency obtained using `Depends(get_db)`.
             - authorization (str): The authorization header containing the Bearer token.
@@ -543,18 +622,70 @@ def cancel_order(order_id: str, symbol: str, db: Session = Depends(get_db), auth
             HTTPException: If the authorization header is missing or invalid, the order is not found, or an internal error occurs.
     """
     trade_service = TradeService(db, authorization)
-    # Storniere die Order auf der Börse
-    response = trade_service.cancel_order(order_id, symbol)
+    # the service resolves the trade and leg of the order and updates exactly that trade
+    return await trade_service.cancel_order(order_id, symbol)
 
-    # Entferne die Order aus der Datenbank
-    trade = db.query(Trade).filter(Trade.trade_id == order_id).first()
-    if not trade:
-        raise HTTPException(status_code=404, detail="Order not found")
 
-    db.delete(trade)
-    db.commit()
+@app.get("/metrics/")
+async def get_metrics(authorization: str = Header(None)):
+    """
+        Returns runtime counters of the shared exchange caches.
+
+        Parameters:
+            - authorization (str): The authorization header containing the Bearer token.
+
+        Returns:
+            dict: A dictionary containing the ticker cache and price service counters, the age of the cached
+            market metadata, the queue depths and wait times of the exchange request scheduler, the sizes of the
+            balance ledger and the trigger engine, the limit order reconciler, job
+            scheduler, lease coordinator and job queue counters, the websocket topics, the live PnL stream and
+            the stage latencies of the order pipeline.
+
+        Raises:
+            HTTPException: If the authorization header is missing or invalid.
+        """
+    if authorization is None or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authorization header missing or invalid.")
+
+    token = authorization.split(" ")[1]
+    if verify_trade_token(token) is None:
+        raise HTTPException(status_code=402, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
+
+    # the counters belong to the event loop and are read on it; only the ledger size is a database query
+    ledger = await asyncio.to_thread(balance_ledger.stats)
+    return {"ticker_cache": ticker_cache.stats(), "price_service": price_service.stats(),
+            "market_cache": market_cache.stats(), "request_scheduler": request_scheduler.stats(),
+            "balance_ledger": ledger, "order_reconciler": order_reconciler.stats(),
+            "trigger_engine": trigger_engine.stats(),
+            "job_scheduler": job_scheduler.stats(), "lease_coordinator": lease_coordinator.stats(),
+            "job_queue": job_queue.stats(), "websocket": manager.stats(), "pnl_stream": pnl_stream.stats(),
+            "order_pipeline": order_pipeline_latency.snapshot()}
+
+
+@app.get("/scheduler/jobs")
+async def get_scheduler_jobs(limit: int = 100, authorization: str = Header(None)):
+    """
+        Returns the state of the job scheduler.
+
+        Parameters:
+            - limit (int): Maximum number of pending jobs to list.
+            - authorization (str): The authorization header containing the Bearer token.
+
+        Returns:
+            dict: The scheduler counters and the running jobs and the pending jobs that are due next, with their
+            lateness, durations, timeouts and overruns.
+
+        Raises:
+            HTTPException: If the authorization header is missing or invalid.
+        """
+    if authorization is None or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Authorization header missing or invalid.")
+
+    token = authorization.split(" ")[1]
+    if verify_trade_token(token) is None:
+        raise HTTPException(status_code=402, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
 
-    return {"message": "Order canceled and removed from database successfully", "order": response}
+    return {"stats": job_scheduler.stats(), "jobs": job_scheduler.jobs(limit)}
 
 
 @app.post("/request-password-reset/")
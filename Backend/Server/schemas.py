@@ -258,6 +258,30 @@ class OrderRequest(BaseModel):
     exchangeName: str
 
 
+class BatchOrderRequest(BaseModel):
+    """
+        Model for placing several orders in one request.
+
+        All orders are checked before any of them is submitted: every order needs a known order type and side,
+        and limit orders need a price.
+
+        Attributes:
+            orders (List[OrderRequest]): The orders to place, at least one and at most 100.
+        """
+    orders: List[OrderRequest] = Field(..., min_items=1, max_items=100)
+
+    @validator('orders')
+    def validate_orders(cls, value):
+        for index, order in enumerate(value):
+            if order.order_type not in ('market', 'limit'):
+                raise ValueError(f"Order {index}: invalid order type '{order.order_type}'")
+            if order.side not in ('buy', 'sell'):
+                raise ValueError(f"Order {index}: invalid side '{order.side}'")
+            if order.order_type == 'limit' and order.price is None:
+                raise ValueError(f"Order {index}: limit orders need a price")
+        return value
+
+
 class AddTakeProfitStopLossRequest(BaseModel):
     """
        Model for adding take profit and stop loss to a trade.
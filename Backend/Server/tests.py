@@ -1,16 +1,52 @@
+import asyncio
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import StaticPool
 from sqlalchemy.exc import IntegrityError
 from datetime import date
 import unittest
 from pydantic import ValidationError
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 from models import Base, Member, Account, Login, Balance, Api, Trade, TakeProfit, Membership, Abo, \
-    Subscription
-from schemas import LoginCredentials, Token, TokenData, UserRegistration, PasswordResetRequest, ApiKeyCreation, AcoountPages_Info_Validate, TradeSchema, OrderRequest, AddTakeProfitStopLossRequest,UpdateTradeRequest, Subscription_Info, SellRequest
+    Subscription, OrderSyncCursor, Position, QueuedJob, DeadLetterJob
+from schemas import LoginCredentials, Token, TokenData, UserRegistration, PasswordResetRequest, ApiKeyCreation, AcoountPages_Info_Validate, TradeSchema, OrderRequest, BatchOrderRequest, AddTakeProfitStopLossRequest,UpdateTradeRequest, Subscription_Info, SellRequest
+from exchange_pool import ExchangePool, exchange_pool
+from ticker_cache import TickerCache
+import ticker_cache as ticker_cache_module
+from market_cache import MarketCache
+from price_service import PriceService
+from request_scheduler import RequestScheduler, Priority
+import balance_ledger as balance_ledger_module
+from balance_ledger import BalanceLedger
+from metrics import StageLatency
+from trade_service import TradeService
+import trade_service as trade_service_module
+from database import add_missing_columns
+import order_reconciler as order_reconciler_module
+import trigger_engine as trigger_engine_module
+from trigger_engine import TriggerEngine, trigger_engine, STOP_LOSS, TAKE_PROFIT
+from portfolio_pnl import compute_pnl
+from positions import PositionStore
+from job_scheduler import JobScheduler
+from lease_coordinator import LeaseCoordinator
+from job_queue import JobQueue
+from functools import partial
+import itertools
+import threading
+from types import SimpleNamespace
+import json
+import web_socket
+import msgpack
+import pnl_stream as pnl_stream_module
+import time
+from fastapi import WebSocketDisconnect, HTTPException
+import routes
+from utils import create_trade_token
+import numpy as np
+import ccxt.async_support as ccxt_async
 
 
 
@@ -39,6 +75,15 @@ def dbsession(engine, tables):
     connection.close()
 
 
+@pytest.fixture(scope='function')
+def session_factory():
+    # code that opens its own sessions in worker threads needs a database that every thread can reach
+    shared = create_engine('sqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+    Base.metadata.create_all(shared)
+    yield sessionmaker(bind=shared)
+    shared.dispose()
+
+
 def test_create_member(dbsession):
     member = Member(
         firstname="John",
@@ -332,3 +377,1119 @@ def test_order_request_invalid():
         assert False
 
 
+def test_batch_order_request_rejects_limit_order_without_price():
+    market = {"trade_price": 0, "symbol": "BTC/USDT", "side": "buy", "amount": 1.0, "order_type": "market",
+              "exchangeName": "binance"}
+    assert len(BatchOrderRequest(orders=[market, market]).orders) == 2
+    with pytest.raises(ValidationError):
+        BatchOrderRequest(orders=[market, dict(market, order_type="limit")])
+    with pytest.raises(ValidationError):
+        BatchOrderRequest(orders=[])
+
+
+
+
+def test_exchange_pool_reuses_client():
+    pool = ExchangePool()
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    api.api_id = 1
+    assert pool.get(api) is pool.get(api)
+    assert len(pool) == 1
+
+
+def test_exchange_pool_replaces_rotated_credentials():
+    pool = ExchangePool()
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    api.api_id = 1
+    first = pool.get(api)
+    api.secret_Key = "rotatedkey"
+    second = pool.get(api)
+    assert second is not first
+    assert second.secret == "rotatedkey"
+
+
+def test_exchange_pool_evicts_idle_clients():
+    now = [0.0]
+    pool = ExchangePool(max_idle_seconds=60, clock=lambda: now[0])
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    api.api_id = 1
+    pool.get(api)
+    now[0] = 61.0
+    assert asyncio.run(pool.evict_idle()) == 1
+    assert len(pool) == 0
+
+
+class FakeExchange:
+    """
+        Exchange client that answers every call from canned data at a last price of 100 and records it in `requests`.
+        """
+    apiKey = None
+    rateLimit = 10
+
+    def __init__(self, exchange_id="fake", delay=0.0, has=None, free=None, failing_types=(), open_orders=(),
+                 closed_orders=()):
+        self.id = exchange_id
+        self.delay = delay
+        self.has = dict(has or {})
+        self.options = {}
+        self.free = dict(free or {})
+        # order types whose next submission fails
+        self.failing_types = set(failing_types)
+        self.open_orders = list(open_orders)
+        self.closed_orders = list(closed_orders)
+        self.requests = []
+        self._order_ids = itertools.count(1)
+
+    def count(self, method):
+        return sum(name == method for name, _ in self.requests)
+
+    async def fetch_ticker(self, symbol):
+        self.requests.append(('fetch_ticker', symbol))
+        await asyncio.sleep(self.delay)
+        return {"symbol": symbol, "last": 100.0}
+
+    async def fetch_tickers(self, symbols):
+        self.requests.append(('fetch_tickers', len(symbols)))
+        return {symbol: {"symbol": symbol, "last": 100.0} for symbol in symbols}
+
+    async def fetch_balance(self):
+        self.requests.append(('fetch_balance', None))
+        return {"free": dict(self.free)}
+
+    async def create_order(self, symbol, type, side, amount, price=None, params={}):
+        self.requests.append(('create_order', type))
+        if type in self.failing_types:
+            self.failing_types.discard(type)
+            raise ccxt_async.NetworkError("timeout")
+        return self._order(symbol, type, side, amount, price, params)
+
+    async def create_market_order(self, symbol, side, amount, price=None, params={}):
+        return await self.create_order(symbol, 'market', side, amount, price, params)
+
+    async def create_limit_order(self, symbol, side, amount, price, params={}):
+        return await self.create_order(symbol, 'limit', side, amount, price, params)
+
+    async def create_orders(self, orders, params={}):
+        self.requests.append(('create_orders', len(orders)))
+        return [self._order(order['symbol'], order['type'], order['side'], order['amount'], order.get('price'),
+                            order.get('params', {})) for order in orders]
+
+    def _order(self, symbol, type, side, amount, price, params):
+        order = {'id': f'{self.id}-{next(self._order_ids)}', 'symbol': symbol, 'type': type, 'side': side,
+                 'amount': amount, 'price': price, 'stopPrice': params.get('stopPrice'), 'status': 'open',
+                 'filled': 0}
+        if type == 'market':
+            order.update(status='closed', filled=amount, average=100.0, cost=amount * 100.0)
+        return order
+
+    async def cancel_order(self, id, symbol=None, params={}):
+        self.requests.append(('cancel_order', id))
+        return {'id': id}
+
+    async def fetch_open_orders(self, symbol=None, since=None, limit=None, params={}):
+        self.requests.append(('fetch_open_orders', symbol))
+        return list(self.open_orders)
+
+    async def fetch_closed_orders(self, symbol=None, since=None, limit=None, params={}):
+        self.requests.append(('fetch_closed_orders', symbol))
+        return list(self.closed_orders)
+
+
+@pytest.fixture
+def pooled_exchange(monkeypatch):
+    # every module shares the pool, so all API entries get this client
+    exchange = FakeExchange()
+    monkeypatch.setattr(exchange_pool, "get", lambda api: exchange)
+    return exchange
+
+
+def test_ticker_cache_serves_fresh_entries():
+    now = [0.0]
+    cache = TickerCache(ttl_seconds=2, clock=lambda: now[0])
+    exchange = FakeExchange()
+
+    async def run():
+        await cache.get(exchange, "BTC/USDT")
+        await cache.get(exchange, "BTC/USDT")
+        now[0] = 3.0
+        await cache.get(exchange, "BTC/USDT")
+
+    asyncio.run(run())
+    assert exchange.count('fetch_ticker') == 2
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_ticker_cache_evicts_expired_entries():
+    now = [0.0]
+    cache = TickerCache(ttl_seconds=2, clock=lambda: now[0])
+    cache.put("binance", "BTC/USDT", {"last": 100.0})
+    cache.put("binance", "ETH/USDT", {"last": 10.0})
+    now[0] = 1.0
+    cache.put("binance", "SOL/USDT", {"last": 1.0})
+    now[0] = 2.5
+
+    assert cache.peek("binance", "BTC/USDT") is None
+    assert cache.evict() == 1
+    assert cache.peek("binance", "SOL/USDT") == {"last": 1.0}
+    assert cache.stats()["entries"] == 1
+
+
+def test_ticker_cache_coalesces_concurrent_requests():
+    cache = TickerCache(ttl_seconds=2)
+    exchange = FakeExchange(delay=0.05)
+
+    async def run():
+        return await asyncio.gather(*(cache.get_last_price(exchange, "BTC/USDT") for _ in range(50)))
+
+    prices = asyncio.run(run())
+    assert prices == [100.0] * 50
+    assert exchange.count('fetch_ticker') == 1
+    assert cache.stats()["coalesced"] == 49
+
+
+def test_market_cache_shares_metadata_from_disk(tmp_path):
+    markets = {"BTC/USDT": {"id": "BTCUSDT", "symbol": "BTC/USDT", "base": "BTC", "quote": "USDT",
+                            "baseId": "BTC", "quoteId": "USDT", "type": "spot", "spot": True, "active": True}}
+    writer = MarketCache(directory=str(tmp_path))
+    writer._write_file("binance", markets, {}, loaded_at=1000.0)
+
+    cache = MarketCache(directory=str(tmp_path), refresh_seconds=60, clock=lambda: 1030.0)
+    assert cache.load_from_disk("binance")
+    assert not cache.is_stale("binance")
+
+    first, second = ccxt_async.binance(), ccxt_async.binance()
+    assert cache.apply(first) and cache.apply(second)
+    assert first.markets["BTC/USDT"]["id"] == "BTCUSDT"
+    assert first.markets is second.markets
+
+
+def test_price_service_batches_symbols():
+    exchange = FakeExchange(has={"fetchTickers": True})
+    service = PriceService(cache=TickerCache())
+    symbols = [f"COIN{i}/USDT" for i in range(200)]
+    prices = asyncio.run(service.get_prices(exchange, symbols + symbols))
+    assert len(prices) == 200
+    assert exchange.requests == [('fetch_tickers', 200)]
+
+
+def test_price_service_falls_back_to_single_fetches():
+    exchange = FakeExchange(has={"fetchTickers": False})
+    service = PriceService(cache=TickerCache(), max_concurrency=4)
+    prices = asyncio.run(service.get_prices(exchange, ["BTC/USDT", "ETH/USDT"]))
+    assert prices == {"BTC/USDT": 100.0, "ETH/USDT": 100.0}
+    assert exchange.count('fetch_ticker') == 2
+
+
+def test_request_scheduler_serves_orders_before_polling():
+    exchange = FakeExchange()
+    scheduler = RequestScheduler(exchange_rates={"fake": 20}, key_rate=20, burst_seconds=0.05)
+    served = []
+
+    async def request(priority, name):
+        await scheduler.acquire(exchange, priority)
+        served.append(name)
+
+    async def run():
+        await scheduler.acquire(exchange, Priority.POLLING)  # drains the single burst token
+        await asyncio.gather(request(Priority.POLLING, "poll"), request(Priority.DASHBOARD, "dashboard"),
+                             request(Priority.ORDER, "order"))
+
+    asyncio.run(run())
+    assert served == ["order", "dashboard", "poll"]
+    assert scheduler.stats()["dispatched"] == 4
+
+
+def test_order_joining_a_valuation_fetch_promotes_it(monkeypatch):
+    exchange = FakeExchange()
+    scheduler = RequestScheduler(exchange_rates={"fake": 20}, key_rate=20, burst_seconds=0.05)
+    monkeypatch.setattr(ticker_cache_module, "request_scheduler", scheduler)
+    cache = TickerCache()
+    served = []
+
+    async def request(priority, name):
+        await scheduler.acquire(exchange, priority)
+        served.append(name)
+
+    async def price(priority, name):
+        await cache.get(exchange, "BTC/USDT", priority)
+        served.append(name)
+
+    async def run():
+        await scheduler.acquire(exchange, Priority.POLLING)  # drains the single burst token
+        valuations = [asyncio.ensure_future(request(Priority.VALUATION, f"valuation {i}")) for i in range(3)]
+        fetch = asyncio.ensure_future(price(Priority.VALUATION, "valuation fetch"))
+        await asyncio.sleep(0)
+        await asyncio.gather(price(Priority.ORDER, "order"), fetch, *valuations)
+
+    asyncio.run(run())
+    assert served[:2] == ["valuation fetch", "order"]
+    assert exchange.count('fetch_ticker') == 1
+
+
+def add_api(session_factory):
+    db = session_factory()
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    db.add(api)
+    db.commit()
+    api_id = api.api_id
+    db.close()
+    return api_id
+
+
+def test_balance_ledger_rejects_overdraw_of_all_processes_without_refetching(session_factory):
+    ledger, other_process = BalanceLedger(session_factory), BalanceLedger(session_factory)
+    exchange = FakeExchange(free={"USDT": 100.0})
+
+    async def run():
+        await ledger.ensure_seeded(1, exchange)
+        await other_process.ensure_seeded(1, exchange)
+        first = await ledger.reserve(1, "USDT", 60.0)
+        second = await other_process.reserve(1, "USDT", 60.0)
+        await ledger.commit(1, first)
+        return first, second, await other_process.available(1, "USDT")
+
+    first, second, available = asyncio.run(run())
+    assert first is not None
+    assert second is None
+    assert available == 40.0
+    assert exchange.count('fetch_balance') == 1
+
+
+def test_balance_ledger_applies_market_fills(session_factory, pooled_exchange):
+    api_id = add_api(session_factory)
+    exchange = pooled_exchange
+    exchange.free = {"USDT": 100.0}
+    ledger = BalanceLedger(session_factory, reconcile_seconds=60)
+
+    async def run():
+        await ledger.ensure_seeded(api_id, exchange)
+        reservation = await ledger.reserve(api_id, "USDT", 55.0)
+        await ledger.commit(api_id, reservation, {"symbol": "BTC/USDT", "side": "buy", "status": "closed",
+                                                  "filled": 0.5, "cost": 50.0})
+        balances = await ledger.available(api_id, "USDT"), await ledger.available(api_id, "BTC")
+        await ledger.reconcile_stale()
+        return balances
+
+    assert asyncio.run(run()) == (50.0, 0.5)
+    # the fill marked the balance stale, so the next pass reconciled it with the exchange
+    assert exchange.count('fetch_balance') == 2
+
+
+def test_balance_ledger_reconcile_keeps_open_reservations(session_factory, pooled_exchange):
+    api_id = add_api(session_factory)
+    exchange = pooled_exchange
+    exchange.free = {"USDT": 100.0}
+    now = [datetime(2024, 1, 1)]
+    ledger = BalanceLedger(session_factory, reservation_seconds=300, clock=lambda: now[0])
+
+    async def run():
+        await ledger.ensure_seeded(api_id, exchange)
+        reservation = await ledger.reserve(api_id, "USDT", 30.0)
+        exchange.free = {"USDT": 80.0}
+        await ledger.mark_stale(api_id)
+        await ledger.reconcile_stale()
+        reconciled = await ledger.available(api_id, "USDT")
+        # the request that took this reservation never finished
+        await ledger.reserve(api_id, "USDT", 20.0)
+        await ledger.release(api_id, reservation)
+        released = await ledger.available(api_id, "USDT")
+        now[0] += timedelta(seconds=301)
+        await ledger.reconcile_stale()
+        return reconciled, released, await ledger.available(api_id, "USDT")
+
+    assert asyncio.run(run()) == (50.0, 60.0, 80.0)
+    assert ledger.stats() == {"accounts": 1, "reservations": 0}
+
+
+def test_stage_latency_records_failed_stages():
+    now = [0.0]
+    latency = StageLatency(("submit", "persist"), clock=lambda: now[0])
+    with latency.measure("submit"):
+        now[0] = 0.25
+    with pytest.raises(RuntimeError):
+        with latency.measure("persist"):
+            now[0] = 0.5
+            raise RuntimeError("write failed")
+    snapshot = latency.snapshot()
+    assert snapshot["submit"] == {"count": 1, "mean_ms": 250.0, "p50_ms": 250.0, "p99_ms": 250.0, "max_ms": 250.0}
+    assert snapshot["persist"]["count"] == 1
+
+
+@pytest.mark.parametrize("native_batch, expected_requests", [(True, ['create_orders']), (False, ['create_order'] * 3)])
+def test_bracket_orders_use_native_batch_when_supported(native_batch, expected_requests):
+    exchange = FakeExchange(has={'createOrders': native_batch})
+    trade = Trade(trade_price=0, trade_type="market", currency_name="BTC/USDT", currency_volume=2.0,
+                  trade_status="open", date_create=date.today(), api_id=1)
+
+    take_profits, stop_loss = asyncio.run(
+        TradeService(None, None)._submit_bracket_orders(exchange, trade, [110.0, 120.0], 90.0))
+
+    assert [method for method, _ in exchange.requests] == expected_requests
+    assert [(order['type'], order['amount'], order['stopPrice']) for order in take_profits] == \
+        [('take_profit_market', 1.0, 110.0), ('take_profit_market', 1.0, 120.0)]
+    assert (stop_loss['type'], stop_loss['amount'], stop_loss['stopPrice']) == ('stop_market', 2.0, 90.0)
+
+
+def test_trade_orders_use_the_api_of_the_trade(dbsession, session_factory, monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    clients = {}
+    monkeypatch.setattr(trade_service_module.exchange_pool, "get",
+                        lambda api: clients.setdefault(api.api_id, FakeExchange(api.exchange_name)))
+    first = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    second = Api(exchange_name="kraken", key="apikey2", secret_Key="secretkey2", passphrase=None, accountID=1)
+    dbsession.add_all([first, second])
+    dbsession.flush()
+    trade = Trade(trade_price=0, trade_type="market", currency_name="BTC/USDT", currency_volume=1.0,
+                  trade_status="open", date_create=date.today(), api_id=second.api_id, purchase_rate=100.0)
+    dbsession.add(trade)
+    dbsession.commit()
+    service = TradeService(dbsession, None)
+    service.account_id = 1
+
+    async def run():
+        await service.add_stop_loss(trade.trade_id, 90.0)
+        await service.cancel_order(trade.stop_loss_order_id, "BTC/USDT")
+
+    asyncio.run(run())
+    trigger_engine.remove_trade(trade.trade_id)
+    assert first.api_id not in clients
+    assert clients[second.api_id].requests == [('create_order', 'stop_market'), ('cancel_order', 'kraken-1')]
+
+
+def test_take_profit_settles_its_share_and_the_stop_closes_the_rest(session_factory, pooled_exchange, monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    exchange = pooled_exchange
+    monkeypatch.setattr(trade_service_module, "SessionLocal", session_factory)
+    db = session_factory()
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    db.add(api)
+    db.flush()
+    trade = Trade(trade_price=0, trade_type="market", currency_name="BTC/USDT", currency_volume=2.0,
+                  trade_status="open", date_create=date.today(), api_id=api.api_id, date_bought=date.today(),
+                  purchase_rate=100.0, stop_loss_price=85.0, stop_loss_order_id="sl-1")
+    db.add(trade)
+    db.flush()
+    db.add_all([TakeProfit(trade.trade_id, 110.0, "tp-1"), TakeProfit(trade.trade_id, 120.0, "tp-2")])
+    PositionStore().apply(db, [PositionStore().fill(trade)])
+    db.commit()
+    trade_id = trade.trade_id
+
+    asyncio.run(trade_service_module.settle_triggered_trades({trade_id: [(TAKE_PROFIT, 110.0, 111.0)]}))
+    db.expire_all()
+    trade = db.query(Trade).filter(Trade.trade_id == trade_id).one()
+    assert trade.date_sale is None
+    assert (trade.currency_volume, trade.settled_volume, trade.selling_rate) == (1.0, 1.0, 11.0)
+    assert [take_profit.price for take_profit in trade.take_profits] == [120.0]
+    assert exchange.requests == []
+
+    # a stop reported twice closes the rest of the trade once
+    for _ in range(2):
+        asyncio.run(trade_service_module.settle_triggered_trades({trade_id: [(STOP_LOSS, 85.0, 85.0)]}))
+    db.expire_all()
+    trade = db.query(Trade).filter(Trade.trade_id == trade_id).one()
+    assert trade.date_sale is not None
+    assert (trade.selling_rate, trade.purchase_rate) == (-4.0, -2.0)
+    assert exchange.requests == [('cancel_order', 'tp-2')]
+    position = db.query(Position).one()
+    assert (position.quantity, position.realized_pnl, position.open_trades) == (0.0, -4.0, 0)
+    assert PositionStore().check(db) == []
+    db.close()
+
+
+def test_bracket_order_job_retries_only_the_failed_legs(session_factory, pooled_exchange, monkeypatch):
+    exchange = pooled_exchange
+    exchange.failing_types = {'stop_market'}
+    monkeypatch.setattr(trade_service_module, "SessionLocal", session_factory)
+    db = session_factory()
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    db.add(api)
+    db.flush()
+    trade = Trade(trade_price=0, trade_type="market", currency_name="BTC/USDT", currency_volume=2.0,
+                  trade_status="open", date_create=date.today(), api_id=api.api_id, date_bought=date.today(),
+                  purchase_rate=100.0)
+    db.add(trade)
+    db.commit()
+    payload = {"trade_id": trade.trade_id, "take_profit_prices": [110.0, 120.0], "stop_loss_price": 90.0}
+
+    with pytest.raises(ccxt_async.NetworkError):
+        asyncio.run(trade_service_module.place_bracket_orders(payload))
+    asyncio.run(trade_service_module.place_bracket_orders(payload))
+    asyncio.run(trade_service_module.place_bracket_orders(payload))
+
+    db.expire_all()
+    trade = db.query(Trade).filter(Trade.trade_id == payload["trade_id"]).one()
+    # the third run has nothing left to place
+    assert [order_type for _, order_type in exchange.requests] == ['take_profit_market', 'take_profit_market',
+                                                                  'stop_market', 'stop_market']
+    assert sorted(take_profit.price for take_profit in trade.take_profits) == [110.0, 120.0]
+    assert (trade.stop_loss_price, trade.stop_loss_order_id) == (90.0, 'fake-3')
+    trigger_engine.remove_trade(trade.trade_id)
+    db.close()
+
+
+def market_order(amount, exchange_name="binance", **levels):
+    return OrderRequest(trade_price=0, symbol="BTC/USDT", side="buy", amount=amount, order_type="market",
+                        exchangeName=exchange_name, **levels)
+
+
+def test_create_order_spends_the_shared_balance_and_queues_the_legs(session_factory, pooled_exchange, monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    pooled_exchange.free = {"USDT": 150.0}
+    api_id = add_api(session_factory)
+    db = session_factory()
+    authorization = f"Bearer {create_trade_token({'account_id': 1})}"
+
+    response = asyncio.run(TradeService(db, authorization).create_order(
+        market_order(1.0, take_profit_prices=[110.0], stop_loss_price=90.0)))
+    # the first order spent 100 of the 150 USDT
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(TradeService(db, authorization).create_order(market_order(1.0)))
+
+    assert response["bracket_orders"] == "queued"
+    assert (error.value.status_code, error.value.detail) == (400, "Insufficient USDT balance")
+    assert pooled_exchange.count('create_order') == 1
+    trade = db.query(Trade).one()
+    assert (trade.api_id, trade.currency_volume, trade.purchase_rate) == (api_id, 1.0, 100.0)
+    job = db.query(QueuedJob).one()
+    assert json.loads(job.payload) == {"trade_id": trade.trade_id, "entry_order_id": "fake-1",
+                                       "take_profit_prices": [110.0], "stop_loss_price": 90.0}
+    assert asyncio.run(balance_ledger_module.balance_ledger.available(api_id, "BTC")) == 1.0
+    trigger_engine.remove_trade(trade.trade_id)
+    db.close()
+
+
+def test_a_trade_reusing_a_deleted_trade_id_gets_its_own_legs(session_factory, pooled_exchange, monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    monkeypatch.setattr(trade_service_module, "SessionLocal", session_factory)
+    pooled_exchange.free = {"USDT": 1000.0}
+    add_api(session_factory)
+    db = session_factory()
+    authorization = f"Bearer {create_trade_token({'account_id': 1})}"
+
+    async def run():
+        await TradeService(db, authorization).create_order(market_order(1.0, stop_loss_price=80.0))
+        first_id = db.query(Trade).one().trade_id
+        await routes.cancel_order(str(first_id), "BTC/USDT", db, authorization)
+        await TradeService(db, authorization).create_order(market_order(1.0, stop_loss_price=90.0))
+        return first_id
+
+    first_id = asyncio.run(run())
+    trade = db.query(Trade).one()
+    # SQLite hands out the ID of the deleted trade again
+    assert trade.trade_id == first_id
+    job = db.query(QueuedJob).one()
+    assert json.loads(job.payload)["stop_loss_price"] == 90.0
+    asyncio.run(trade_service_module.place_bracket_orders(json.loads(job.payload)))
+    db.expire_all()
+    assert db.query(Trade).one().stop_loss_price == 90.0
+    trigger_engine.remove_trade(trade.trade_id)
+    db.close()
+
+
+def test_cancelling_a_take_profit_leg_keeps_the_trade(session_factory, pooled_exchange, monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    monkeypatch.setattr(trade_service_module, "SessionLocal", session_factory)
+    pooled_exchange.free = {"USDT": 1000.0}
+    add_api(session_factory)
+    db = session_factory()
+    authorization = f"Bearer {create_trade_token({'account_id': 1})}"
+    asyncio.run(TradeService(db, authorization).create_order(
+        market_order(1.0, take_profit_prices=[110.0, 120.0], stop_loss_price=90.0)))
+    asyncio.run(trade_service_module.place_bracket_orders(json.loads(db.query(QueuedJob).one().payload)))
+    db.expire_all()
+    trade = db.query(Trade).one()
+    take_profit = next(row for row in trade.take_profits if row.price == 110.0)
+
+    response = asyncio.run(routes.cancel_order(take_profit.exchange_order_id, "BTC/USDT", db, authorization))
+
+    assert response["leg"] == TAKE_PROFIT
+    assert pooled_exchange.requests[-1] == ('cancel_order', take_profit.exchange_order_id)
+    db.expire_all()
+    trade = db.query(Trade).one()
+    assert [row.price for row in trade.take_profits] == [120.0]
+    assert trade.stop_loss_price == 90.0
+    levels = [(entry[3], entry[0]) for _, entry in trigger_engine._by_trade[trade.trade_id]]
+    assert (TAKE_PROFIT, 110.0) not in levels and (TAKE_PROFIT, 120.0) in levels
+    trigger_engine.remove_trade(trade.trade_id)
+    db.close()
+
+
+def test_batch_route_creates_the_orders_that_fit_and_reports_the_others(session_factory, pooled_exchange,
+                                                                        monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    pooled_exchange.free = {"USDT": 250.0}
+    pooled_exchange.has = {'createOrders': True}
+    add_api(session_factory)
+    db = session_factory()
+    request = BatchOrderRequest(orders=[market_order(1.0), market_order(1.0, stop_loss_price=90.0),
+                                        market_order(1.0), market_order(1.0, exchange_name="kraken")])
+
+    response = asyncio.run(routes.create_orders(request, db, f"Bearer {create_trade_token({'account_id': 1})}"))
+
+    results = response["results"]
+    assert [result["status"] for result in results] == ["created", "created", "failed", "failed"]
+    assert results[1]["bracket_orders"] == "queued"
+    assert results[2]["detail"] == "Insufficient USDT balance"
+    assert results[3]["detail"] == "API named 'kraken' not found."
+    # both accepted orders went out in one native batch after a single balance fetch
+    assert (pooled_exchange.count('create_orders'), pooled_exchange.count('create_order')) == (1, 0)
+    assert pooled_exchange.count('fetch_balance') == 1
+    assert db.query(Trade).count() == 2 and db.query(QueuedJob).count() == 1
+    for result in results[:2]:
+        trigger_engine.remove_trade(result["trade_id"])
+    db.close()
+
+
+def test_replacing_bracket_orders_cancels_the_stored_legs(dbsession, pooled_exchange):
+    exchange = pooled_exchange
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    dbsession.add(api)
+    dbsession.flush()
+    # legs placed by another server process, this one never saw them
+    trade = Trade(trade_price=0, trade_type="market", currency_name="BTC/USDT", currency_volume=1.0,
+                  trade_status="closed", date_create=date.today(), api_id=api.api_id, date_bought=date.today(),
+                  purchase_rate=100.0, exchange_order_id="entry-1", stop_loss_price=90.0, stop_loss_order_id="sl-1")
+    dbsession.add(trade)
+    dbsession.flush()
+    dbsession.add_all([TakeProfit(trade.trade_id, 110.0, "tp-1"), TakeProfit(trade.trade_id, 120.0, "tp-2")])
+    dbsession.commit()
+
+    asyncio.run(TradeService(dbsession, None).update_stop_loss_and_take_profits(trade.trade_id, 85.0, [130.0]))
+    trigger_engine.remove_trade(trade.trade_id)
+    assert exchange.requests[:3] == [('cancel_order', 'sl-1'), ('cancel_order', 'tp-1'), ('cancel_order', 'tp-2')]
+    assert [order_type for _, order_type in exchange.requests[3:]] == ['take_profit_market', 'stop_market']
+
+
+def test_add_missing_columns_extends_existing_tables():
+    engine = create_engine('sqlite:///:memory:')
+    with engine.begin() as connection:
+        connection.exec_driver_sql('CREATE TABLE take_profit (takeprofit_id INTEGER PRIMARY KEY, price FLOAT, '
+                                   'trade_id INTEGER)')
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    assert 'exchange_order_id' in {column['name'] for column in inspect(engine).get_columns('take_profit')}
+
+
+def test_order_reconciler_updates_filled_trades_in_bulk(session_factory, pooled_exchange, monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    dbsession = session_factory()
+    exchange = pooled_exchange
+    exchange.open_orders = [{'id': 'o-2', 'status': 'open'}]
+    exchange.closed_orders = [{'id': 'o-1', 'status': 'closed', 'timestamp': 1700000000000,
+                               'lastTradeTimestamp': 1700000000000}]
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    dbsession.add(api)
+    dbsession.flush()
+    for order_id in ('o-1', 'o-2'):
+        dbsession.add(Trade(trade_price=5.0, trade_type="limit", currency_name="BTC/USDT", currency_volume=1.0,
+                            trade_status="open", date_create=date.today(), api_id=api.api_id,
+                            exchange_order_id=order_id))
+    dbsession.commit()
+
+    reconciler = order_reconciler_module.OrderReconciler(session_factory)
+    assert asyncio.run(reconciler.reconcile()) == 1
+    assert [method for method, _ in exchange.requests] == ['fetch_open_orders', 'fetch_closed_orders']
+    filled = dbsession.query(Trade).filter(Trade.exchange_order_id == 'o-1').one()
+    assert filled.date_bought == datetime.fromtimestamp(1700000000).date()
+    assert dbsession.query(OrderSyncCursor).filter(OrderSyncCursor.api_id == api.api_id).one() is not None
+    dbsession.close()
+
+
+def test_trigger_engine_fires_only_crossed_levels():
+    engine = TriggerEngine()
+    engine.add(1, "fake", "BTC/USDT", TAKE_PROFIT, 110.0)
+    engine.add(1, "fake", "BTC/USDT", STOP_LOSS, 90.0)
+    engine.add(2, "fake", "BTC/USDT", TAKE_PROFIT, 120.0)
+    engine.add(3, "fake", "BTC/USDT", STOP_LOSS, 95.0)
+    engine.remove_trade(2)
+
+    engine.on_ticker("fake", "BTC/USDT", {"last": 100.0})
+    assert engine.take_triggered() == {}
+    engine.on_ticker("fake", "BTC/USDT", {"last": 125.0})
+    assert engine.take_triggered() == {1: [(TAKE_PROFIT, 110.0, 125.0)]}
+    # the stop of trade 1 is still watched after its take-profit fired
+    assert engine.stats() == {"books": 1, "trades": 2, "levels": 2, "triggered": 1}
+    engine.on_ticker("fake", "BTC/USDT", {"last": 89.0})
+    assert engine.take_triggered() == {3: [(STOP_LOSS, 95.0, 89.0)], 1: [(STOP_LOSS, 90.0, 89.0)]}
+    assert engine.stats() == {"books": 0, "trades": 0, "levels": 0, "triggered": 3}
+
+
+def test_trigger_engine_watches_only_the_accounts_of_its_lease_buckets(session_factory, pooled_exchange, monkeypatch):
+    monkeypatch.setattr(trigger_engine_module, "ticker_cache", TickerCache())
+    db = session_factory()
+    trades = {}
+    for account_id in (1, 2):
+        api = Api(exchange_name="binance", key=f"apikey{account_id}", secret_Key=f"secretkey{account_id}",
+                  passphrase=None, accountID=account_id)
+        db.add(api)
+        db.flush()
+        # filled trades opened by another process and a limit trade whose order is still open
+        trades[account_id] = Trade(trade_price=0, trade_type="market", currency_name="BTC/USDT", currency_volume=1.0,
+                                   trade_status="open", date_create=date.today(), api_id=api.api_id,
+                                   purchase_rate=100.0, stop_loss_price=90.0)
+        db.add(trades[account_id])
+        db.add(Trade(trade_price=100.0, trade_type="limit", currency_name="BTC/USDT", currency_volume=1.0,
+                     trade_status="open", date_create=date.today(), api_id=api.api_id, stop_loss_price=95.0))
+    db.commit()
+    leases, other = (LeaseCoordinator(session_factory, worker_id=worker_id, ttl=30, account_buckets=2)
+                     for worker_id in ("a", "b"))
+    for coordinator in (leases, other):
+        coordinator.want_accounts()
+    engine = TriggerEngine(poll_seconds=0.01, reload_seconds=60, session_factory=session_factory)
+    settled = []
+
+    async def settle(triggered):
+        settled.append(triggered)
+
+    async def no_prices():
+        pass
+
+    engine.refresh_prices = no_prices
+
+    async def run():
+        task = asyncio.create_task(engine.run(settle, leases))
+        await asyncio.sleep(0.05)
+        engine.add(99, "fake", "BTC/USDT", STOP_LOSS, 200.0, account_id=2)
+        inactive = engine.stats()
+        # "a" takes both buckets, then hands the bucket of account 1 to "b"
+        for coordinator in (leases, other, leases, other):
+            coordinator.heartbeat(db)
+        await asyncio.sleep(0.05)
+        engine.add(98, "fake", "BTC/USDT", STOP_LOSS, 200.0, account_id=1)
+        active = engine.stats()
+        engine.on_ticker("fake", "BTC/USDT", {"last": 80.0})
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return inactive, active
+
+    inactive, active = asyncio.run(run())
+    assert leases.owned_buckets() == [0] and other.owned_buckets() == [1]
+    assert (inactive["trades"], active["trades"]) == (0, 1)
+    assert settled[0] == {trades[2].trade_id: [(STOP_LOSS, 90.0, 80.0)]}
+    db.close()
+
+
+def test_compute_pnl_aggregates_per_symbol():
+    result = compute_pnl(np.array([1.0, 2.0, 10.0]), np.array([100.0, 110.0, 0.0]), np.array([0, 0, 1]),
+                         np.array([120.0, 5.0]))
+    assert result["amount"].tolist() == [20.0, 20.0, 50.0]
+    assert result["percentage"][0] == 20.0
+    assert np.isnan(result["percentage"][2])
+    assert result["pair_volume"].tolist() == [3.0, 10.0]
+    assert result["pair_amount"].tolist() == [40.0, 50.0]
+    assert result["total_cost"] == 320.0
+    assert result["total_amount"] == 90.0
+
+
+def test_position_store_matches_rebuild(dbsession):
+    store = PositionStore()
+    api = Api(exchange_name="binance", key="apikey", secret_Key="secretkey", passphrase=None, accountID=1)
+    dbsession.add(api)
+    dbsession.flush()
+    trades = [Trade(trade_price=0, trade_type="market", currency_name="BTC/USDT", currency_volume=volume,
+                    trade_status="closed", date_create=date.today(), date_bought=date.today(), api_id=api.api_id,
+                    purchase_rate=rate) for volume, rate in ((1.0, 100.0), (3.0, 120.0))]
+    dbsession.add_all(trades)
+    dbsession.flush()
+    store.apply(dbsession, [store.fill(trade) for trade in trades])
+    entry = trades[0].purchase_rate
+    trades[0].selling_rate, trades[0].purchase_rate, trades[0].date_sale = 30.0, 30.0, date.today()
+    store.apply(dbsession, [store.close(trades[0], entry, 30.0)])
+    dbsession.commit()
+
+    position = dbsession.query(Position).one()
+    assert (position.quantity, position.average_entry, position.realized_pnl) == (3.0, 120.0, 30.0)
+    assert store.check(dbsession) == []
+    position.quantity = 5.0
+    assert len(store.check(dbsession)) == 1
+    assert store.rebuild(dbsession) == 1
+    assert store.check(dbsession) == []
+
+
+def test_job_scheduler_runs_jobs_on_bounded_workers():
+    running = []
+    runs = {}
+    peak = [0]
+
+    async def job(account_id):
+        running.append(account_id)
+        peak[0] = max(peak[0], len(running))
+        await asyncio.sleep(0.01)
+        running.remove(account_id)
+        runs[account_id] = runs.get(account_id, 0) + 1
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    async def run():
+        scheduler = JobScheduler(workers=2)
+        threads = threading.active_count()
+        scheduler.start()
+        for account_id in range(20):
+            scheduler.schedule(f"limit_orders:{account_id}", partial(job, account_id), 0.02, delay=0)
+        scheduler.schedule("slow", slow, 0.05, deadline=0.01, delay=0)
+        scheduler.schedule("cancelled", partial(job, -1), 0.02, delay=0.05)
+        scheduler.cancel("cancelled")
+        await asyncio.sleep(0.3)
+        assert threading.active_count() == threads
+        jobs = scheduler.jobs(limit=5)
+        await scheduler.stop()
+        return scheduler, jobs
+
+    scheduler, jobs = asyncio.run(run())
+    assert peak[0] == 2
+    assert len(runs) == 20 and min(runs.values()) >= 2 and -1 not in runs
+    stats = scheduler.stats()
+    assert stats["jobs"] == 21 and stats["timeouts"] >= 1
+    assert len(jobs) <= 7 and all("max_lateness" in job for job in jobs)
+
+
+def test_lease_coordinator_splits_keys_between_workers(dbsession):
+    now = [datetime(2024, 1, 1, 12, 0, 0)]
+    session_factory = lambda: dbsession
+    first = LeaseCoordinator(session_factory, worker_id="a", ttl=30, clock=lambda: now[0])
+    second = LeaseCoordinator(session_factory, worker_id="b", ttl=30, clock=lambda: now[0])
+    for coordinator in (first, second):
+        for account_id in range(4):
+            coordinator.want(f"account:{account_id}")
+
+    assert len(first.heartbeat(dbsession)) == 4
+    assert second.heartbeat(dbsession) == set()
+    assert len(first.heartbeat(dbsession)) == 2
+    assert len(second.heartbeat(dbsession)) == 2
+    assert not any(first.owns(f"account:{account_id}") and second.owns(f"account:{account_id}")
+                   for account_id in range(4))
+
+    now[0] = datetime(2024, 1, 1, 12, 1, 0)
+    assert len(second.heartbeat(dbsession)) == 4
+
+
+def test_job_queue_retries_and_dead_letters(session_factory):
+    dbsession = session_factory()
+    now = [datetime(2024, 1, 1, 12, 0, 0)]
+    queue = JobQueue(session_factory, workers=1, clock=lambda: now[0])
+    calls = []
+
+    @queue.handler("flaky")
+    def flaky(payload):
+        calls.append(payload["n"])
+        raise ValueError("unavailable")
+
+    queue.enqueue(dbsession, "flaky", {"n": 1}, idempotency_key="flaky:1", max_attempts=2)
+    queue.enqueue(dbsession, "flaky", {"n": 1}, idempotency_key="flaky:1", max_attempts=2)
+    dbsession.commit()
+    assert dbsession.query(QueuedJob).count() == 1
+
+    assert asyncio.run(queue.run_next()) is True
+    assert asyncio.run(queue.run_next()) is False
+    now[0] = datetime(2024, 1, 1, 12, 1, 0)
+    assert asyncio.run(queue.run_next()) is True
+
+    job = dbsession.query(QueuedJob).one()
+    assert calls == [1, 1]
+    assert (job.status, job.attempts, queue.retried, queue.dead) == ("dead", 2, 1, 1)
+    assert dbsession.query(DeadLetterJob).one().last_error == "ValueError('unavailable')"
+    dbsession.close()
+
+
+def test_poll_planner_checks_near_orders_more_often():
+    now = [0.0]
+    planner = order_reconciler_module.PollPlanner(5, 300, default_volatility=0.0002, clock=lambda: now[0])
+    planner.observe('binance', 'BTC/USDT', 100.0)
+    assert planner.delay('binance', 'BTC/USDT', 99.9) == 5
+    assert planner.delay('binance', 'BTC/USDT', 70.0) == 300
+    assert planner.delay('binance', 'ETH/USDT', 70.0) == 5
+
+    near = SimpleNamespace(trade_id=1, api_id=1, currency_name='BTC/USDT', trade_price=99.9)
+    far = SimpleNamespace(trade_id=2, api_id=2, currency_name='BTC/USDT', trade_price=70.0)
+    assert planner.plan([near, far], {1: 'binance', 2: 'binance'}) == [near, far]
+    planner.checked([near, far])
+    now[0] = 10.0
+    assert planner.plan([near, far], {1: 'binance', 2: 'binance'}) == [near]
+    planner.settled([near])
+    assert planner.detection_latency.count == 1 and planner.detection_latency.max == 10.0
+    assert planner.next_due() == 290.0
+
+    planner.observe('binance', 'BTC/USDT', 80.0)
+    assert planner.volatility('binance', 'BTC/USDT') > 0.0002
+
+
+class FakeWebSocket:
+    def __init__(self, subprotocols=(), token=None):
+        self.scope = {"subprotocols": list(subprotocols)}
+        self.query_params = {"token": token} if token else {}
+        self.headers = {}
+        self.sent = []
+        self.accepted = False
+        self.close_code = None
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+        self.accepted = True
+
+    async def close(self, code=1000):
+        self.close_code = code
+
+    async def send_text(self, message):
+        self.sent.append(json.loads(message))
+
+    async def send_bytes(self, message):
+        self.sent.append(msgpack.unpackb(message))
+
+
+def test_connection_manager_fans_out_one_fetch_per_topic(pooled_exchange, monkeypatch):
+    exchange = pooled_exchange
+    monkeypatch.setattr(web_socket, "ticker_cache", TickerCache(ttl_seconds=0))
+    manager = web_socket.ConnectionManager(publish_seconds=0.01)
+    sockets = [FakeWebSocket() for _ in range(100)]
+
+    async def run():
+        for websocket in sockets:
+            await manager.connect(websocket, 1)
+            manager.subscribe(websocket, None, "BTC/USDT")
+        await asyncio.sleep(0.035)
+        assert manager.stats()["topics"] == 1
+        for websocket in sockets:
+            manager.disconnect(websocket)
+        await asyncio.sleep(0.02)
+
+    asyncio.run(run())
+    assert manager.stats()["topics"] == 0
+    # one fetch per interval for all 100 subscribers; a fetch cut short by the disconnect is not published
+    assert manager.published >= 2 and exchange.count('fetch_ticker') - manager.published in (0, 1)
+    # the writer of a connection may not have flushed the last ticker before the disconnect
+    assert all(manager.published - 1 <= len(websocket.sent) <= manager.published for websocket in sockets)
+    assert sockets[0].sent[0]["ticker"]["last"] == 100.0
+
+
+def test_websocket_requests_keep_the_event_loop_responsive(monkeypatch):
+    def slow_loader(account_id, exchange_name):
+        time.sleep(0.2)
+        return SimpleNamespace(api_id=1)
+
+    monkeypatch.setattr(web_socket, "credential_cache", web_socket.CredentialCache(slow_loader))
+    monkeypatch.setattr(web_socket.exchange_pool, "get", lambda api: FakeExchange(delay=5))
+    monkeypatch.setattr(web_socket, "ticker_cache", TickerCache())
+    monkeypatch.setattr(web_socket, "WEBSOCKET_MESSAGE_TIMEOUT_SECONDS", 0.5)
+    websocket = FakeWebSocket(token=create_trade_token({"account_id": 1}))
+
+    async def run():
+        requests = iter([json.dumps({"exchange_name": "fake", "symbol": "BTC/USDT"})] * 3)
+
+        async def receive_text():
+            try:
+                return next(requests)
+            except StopIteration:
+                await asyncio.sleep(0.05)
+                raise WebSocketDisconnect()
+
+        websocket.receive_text = receive_text
+        endpoint = asyncio.create_task(web_socket.websocket_endpoint(websocket))
+        lags = []
+        while not endpoint.done():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+        return lags
+
+    lags = asyncio.run(run())
+    assert [response["status"] for response in websocket.sent] == ["error"] * 3
+    assert max(lags) < 0.1
+
+
+def test_websocket_answers_malformed_frames_and_keeps_the_connection(monkeypatch):
+    websocket = FakeWebSocket(token=create_trade_token({"account_id": 1}))
+    requests = iter(["{not json", "{}"])
+
+    async def receive_text():
+        try:
+            return next(requests)
+        except StopIteration:
+            # lets the outbox flush the responses before the connection closes
+            await asyncio.sleep(0.05)
+            raise WebSocketDisconnect()
+
+    websocket.receive_text = receive_text
+    asyncio.run(web_socket.websocket_endpoint(websocket))
+    assert [response["status"] for response in websocket.sent] == ["error", "error"]
+    assert websocket.sent[0]["message"].startswith("Invalid JSON")
+
+
+def test_websocket_rejects_connections_without_a_valid_token():
+    for websocket in (FakeWebSocket(), FakeWebSocket(token="forged")):
+        asyncio.run(web_socket.websocket_endpoint(websocket))
+        assert (websocket.accepted, websocket.close_code) == (False, 1008)
+
+    websocket = FakeWebSocket()
+    websocket.headers = {"authorization": f"Bearer {create_trade_token({'account_id': 7})}"}
+    assert web_socket.authenticate_websocket(websocket) == 7
+
+
+def test_connection_manager_conflates_and_drops_slow_clients():
+    manager = web_socket.ConnectionManager(queue_size=2, slow_seconds=0.05)
+    fast = FakeWebSocket()
+    slow = FakeWebSocket()
+    slow.closed = asyncio.Event()
+
+    async def stuck(message):
+        await asyncio.Event().wait()
+
+    async def close(code=1000):
+        slow.closed.set()
+
+    slow.send_text = stuck
+    slow.close = close
+
+    async def run():
+        await manager.connect(fast)
+        await manager.connect(slow)
+        for price in range(10):
+            manager._fan_out(json.dumps({"last": price}), [fast, slow], ("fake", "BTC/USDT"))
+            await manager.send_personal_message(json.dumps({"n": price}), slow)
+            await asyncio.sleep(0)
+        assert manager.stats()["max_queue_depth"] == 2
+        await asyncio.sleep(0.06)
+        manager._fan_out(json.dumps({"last": 10}), [fast, slow], ("fake", "BTC/USDT"))
+        await asyncio.wait_for(slow.closed.wait(), 1)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    stats = manager.stats()
+    assert [message["last"] for message in fast.sent] == list(range(11))
+    assert stats["connections"] == 1 and stats["slow_disconnects"] == 1
+    assert stats["conflated"] > 0 and stats["dropped"] > 0
+
+
+def test_connection_manager_sends_compact_snapshots_and_deltas():
+    manager = web_socket.ConnectionManager()
+    compact = FakeWebSocket(subprotocols=["msgpack"])
+    plain = FakeWebSocket()
+    topic = ("fake", "BTC/USDT")
+    ticker = {"symbol": "BTC/USDT", "timestamp": 1, "datetime": "1970-01-01T00:00:00.001Z", "last": 100.0,
+              "bid": 99.5, "ask": None, "info": {"raw": "response"}}
+
+    async def run():
+        await manager.connect(compact)
+        await manager.connect(plain)
+        manager.join(compact, topic)
+        manager.join(plain, topic)
+        manager._publish_ticker(topic, ticker)
+        await asyncio.sleep(0)
+        manager._publish_ticker(topic, dict(ticker, timestamp=2, last=101.5))
+        await asyncio.sleep(0)
+        # a delta that meets a pending frame is replaced by a snapshot
+        manager._publish_ticker(topic, dict(ticker, timestamp=3, bid=None))
+        manager._publish_ticker(topic, dict(ticker, timestamp=4, bid=None))
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert compact.subprotocol == "msgpack" and plain.subprotocol is None
+    assert compact.sent == [{"t": "snapshot", "e": "fake", "s": "BTC/USDT", "d": {"timestamp": 1, "last": 100,
+                                                                                   "bid": 99.5}},
+                            {"t": "delta", "e": "fake", "s": "BTC/USDT", "d": {"timestamp": 2, "last": 101.5}},
+                            {"t": "snapshot", "e": "fake", "s": "BTC/USDT", "d": {"timestamp": 4, "last": 100}}]
+    assert plain.sent[1]["ticker"]["info"] == {"raw": "response"}
+
+
+def test_connection_manager_keeps_pending_deltas_when_an_error_follows():
+    manager = web_socket.ConnectionManager()
+    compact = FakeWebSocket(subprotocols=["msgpack"])
+    topic = ("fake", "BTC/USDT")
+    ticker = {"symbol": "BTC/USDT", "timestamp": 1, "last": 100.0}
+
+    async def run():
+        await manager.connect(compact)
+        manager.join(compact, topic)
+        manager._publish_ticker(topic, ticker)
+        await asyncio.sleep(0)
+        manager._publish_ticker(topic, dict(ticker, timestamp=2, last=101.0))
+        manager._publish_error(topic, "unavailable")
+        await asyncio.sleep(0.01)
+        manager._publish_ticker(topic, dict(ticker, timestamp=3, last=102.0))
+        await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert [message["t"] for message in compact.sent] == ["snapshot", "delta", "error", "delta"]
+    assert compact.sent[1]["d"] == {"timestamp": 2, "last": 101.0}
+
+
+class FakeConnections:
+    def __init__(self):
+        self.topics = {}
+        self.published = []
+
+    def publish(self, topic, payload, key=None):
+        self.published.append((topic, payload))
+
+
+def test_pnl_stream_recomputes_only_the_ticked_pair(pooled_exchange):
+    connections = FakeConnections()
+    stream = pnl_stream_module.PnLStream(connections=connections)
+    trades = {1: [(1, 1, "BTC/USDT", 2.0, 100.0), (2, 1, "ETH/USDT", 10.0, 5.0)],
+              2: [(3, 2, "BTC/USDT", 1.0, 120.0)]}
+    stream._load = lambda account_id: (trades[account_id], [SimpleNamespace(api_id=account_id)])
+
+    async def run():
+        await stream.reload(1)
+        await stream.reload(2)
+        stream.apply_price(("fake", "ETH/USDT"), 6.0)
+        stream.apply_price(("fake", "BTC/USDT"), 110.0)
+        stream.apply_price(("fake", "BTC/USDT"), 110.0)
+        stream.apply_price(("fake", "BTC/USDT"), 130.0)
+
+    asyncio.run(run())
+    assert stream.updated_trades == 1 + 2 + 2
+    (topic, update), = [(topic, payload) for topic, payload in connections.published[-2:] if topic == ("pnl", 1)]
+    assert [trade["trade_id"] for trade in update["trades"]] == [1]
+    assert update["trades"][0]["profit_loss_amount"] == 60.0
+    assert update["total"] == pytest.approx({"cost_basis": 250.0, "market_value": 320.0, "profit_loss_amount": 70.0,
+                                             "profit_loss_percentage": 28.0})
+    assert stream.totals(2)["profit_loss_amount"] == 10.0
+    assert len(stream.snapshot(1)["trades"]) == 2
+    # the pair was priced with the API entry of account 1 and moves to the one of account 2
+    assert stream._api_ids[("fake", "BTC/USDT")] == 1
+    stream._drop(1)
+    assert stream._api_ids == {("fake", "BTC/USDT"): 2}
+    assert stream._clients == {("fake", "BTC/USDT"): pooled_exchange}
+
+
+def test_pnl_stream_prices_are_fetched_once_for_all_processes(session_factory, pooled_exchange, monkeypatch):
+    api_id = add_api(session_factory)
+    monkeypatch.setattr(pnl_stream_module.price_service, "get_prices_for_pairs",
+                        lambda pairs, priority: asyncio.sleep(0, {("fake", symbol): 110.0 for _, symbol in pairs}))
+    streams = [pnl_stream_module.PnLStream(session_factory, connections=FakeConnections()) for _ in range(2)]
+    for stream in streams:
+        stream._load = lambda account_id: ([(account_id, api_id, "BTC/USDT", 1.0, 100.0)],
+                                           [SimpleNamespace(api_id=api_id)])
+    lease_holder = streams[0]
+
+    async def run():
+        for account_id, stream in enumerate(streams, start=1):
+            stream.connections.topics[stream.topic(account_id)] = set()
+            await stream.reload(account_id)
+            await stream.run_once()
+        stored = await lease_holder.fetch_wanted_prices()
+        for stream in streams:
+            await stream.run_once()
+        return stored
+
+    # both processes watch the pair, the lease holder fetches it once and both apply the stored price
+    assert asyncio.run(run()) == 1
+    assert [stream.totals(account_id)["profit_loss_amount"] for account_id, stream in enumerate(streams, start=1)] \
+        == [10.0, 10.0]
+
+
+def test_monitoring_routes_require_a_token(session_factory, monkeypatch):
+    monkeypatch.setattr(balance_ledger_module.balance_ledger, "session_factory", session_factory)
+    for route in (routes.get_metrics, routes.get_scheduler_jobs):
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(route(authorization=None))
+        assert error.value.status_code == 401
+        with pytest.raises(HTTPException) as error:
+            asyncio.run(route(authorization="Bearer forged"))
+        assert error.value.status_code == 402
+    token = create_trade_token({"account_id": 1})
+    assert "jobs" in asyncio.run(routes.get_scheduler_jobs(authorization=f"Bearer {token}"))
+    metrics = asyncio.run(routes.get_metrics(authorization=f"Bearer {token}"))
+    assert metrics["balance_ledger"] == {"accounts": 0, "reservations": 0}
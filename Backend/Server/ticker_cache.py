@@ -0,0 +1,196 @@
+"""
+Ticker Cache
+
+This module provides a process-wide cache for exchange tickers. Each (exchange, symbol) pair is fetched at most
+once per freshness window; concurrent requests for a pair that is already being fetched wait for the same
+upstream call instead of issuing their own, and a waiter with a higher priority promotes that call. Expired entries
+are dropped when they are read and by a periodic sweep, so the cache only holds pairs that are still requested.
+"""
+import asyncio
+import os
+import time
+from request_scheduler import request_scheduler, Priority
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+TICKER_CACHE_TTL_SECONDS = float(os.getenv("TICKER_CACHE_TTL_SECONDS", "2"))
+TICKER_CACHE_EVICT_SECONDS = float(os.getenv("TICKER_CACHE_EVICT_SECONDS", "60"))
+
+
+class TickerCache:
+    """
+        Caches tickers per (exchange, symbol) and coalesces concurrent fetches.
+
+        Attributes:
+            ttl_seconds (float): Seconds a fetched ticker is served from the cache.
+            clock (callable): Monotonic time source, replaceable for tests.
+            hits (int): Requests answered from a fresh cache entry.
+            misses (int): Requests that triggered an upstream fetch.
+            coalesced (int): Requests that joined an upstream fetch already in flight.
+        """
+
+    def __init__(self, ttl_seconds: float = TICKER_CACHE_TTL_SECONDS, clock=time.monotonic):
+        """
+                Initializes an empty TickerCache.
+
+                Args:
+                    ttl_seconds (float): Seconds a fetched ticker is served from the cache.
+                    clock (callable): Monotonic time source.
+                """
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = {}
+        self._in_flight = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+                Registers a callable that is called with (exchange ID, symbol, ticker) for every stored ticker.
+
+                Args:
+                    listener (callable): The callback; it must not block.
+                """
+        self._listeners.append(listener)
+
+    def peek(self, exchange_id: str, symbol: str):
+        """
+                Returns the cached ticker of a pair if it is still fresh, without fetching.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange (e.g. 'binance').
+                    symbol (str): The trading pair symbol (e.g. 'BTC/USDT').
+
+                Returns:
+                    dict or None: The cached ticker, or None if there is no fresh entry.
+                """
+        entry = self._entries.get((exchange_id, symbol))
+        if entry is None:
+            return None
+        if self.clock() - entry[0] < self.ttl_seconds:
+            return entry[1]
+        del self._entries[(exchange_id, symbol)]
+        return None
+
+    def evict(self):
+        """
+                Drops all expired entries; registered as a periodic job.
+
+                Returns:
+                    int: Number of dropped entries.
+                """
+        now = self.clock()
+        expired = [key for key, (stored_at, _) in self._entries.items() if now - stored_at >= self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        return len(expired)
+
+    def put(self, exchange_id: str, symbol: str, ticker: dict):
+        """
+                Stores a ticker that was fetched elsewhere, e.g. as part of a batch request.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+                    symbol (str): The trading pair symbol.
+                    ticker (dict): The ticker returned by the exchange.
+                """
+        self._entries[(exchange_id, symbol)] = (self.clock(), ticker)
+        for listener in self._listeners:
+            try:
+                listener(exchange_id, symbol, ticker)
+            except Exception as e:
+                logger.warning(f"Ticker listener failed for {exchange_id} {symbol}: {str(e)}")
+
+    async def get(self, exchange, symbol: str, priority: Priority = Priority.VALUATION):
+        """
+                Returns the ticker of a pair, fetching it through the given client only if the cache is stale.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The client used for an upstream fetch.
+                    symbol (str): The trading pair symbol.
+                    priority (Priority): Scheduling priority of an upstream fetch.
+
+                Returns:
+                    dict: The ticker of the pair.
+                """
+        ticker = self.peek(exchange.id, symbol)
+        if ticker is not None:
+            self.hits += 1
+            return ticker
+
+        key = (exchange.id, symbol)
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(exchange, symbol, priority))
+            self._in_flight[key] = [task, priority]
+        else:
+            self.coalesced += 1
+            task = in_flight[0]
+            if priority < in_flight[1]:
+                # an order must not wait behind the backlog of the valuation that started the fetch
+                in_flight[1] = priority
+                request_scheduler.promote(task, priority)
+        # shielded so that a cancelled caller does not cancel the fetch other callers are waiting for
+        return await asyncio.shield(task)
+
+    async def get_last_price(self, exchange, symbol: str, priority: Priority = Priority.VALUATION) -> float:
+        """
+                Returns the last traded price of a pair.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The client used for an upstream fetch.
+                    symbol (str): The trading pair symbol.
+                    priority (Priority): Scheduling priority of an upstream fetch.
+
+                Returns:
+                    float: The last price of the pair.
+                """
+        ticker = await self.get(exchange, symbol, priority)
+        return ticker['last']
+
+    async def _fetch(self, exchange, symbol: str, priority: Priority):
+        """
+                Performs the single upstream fetch for a pair and stores the result.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The client used for the fetch.
+                    symbol (str): The trading pair symbol.
+                    priority (Priority): Scheduling priority of the fetch.
+
+                Returns:
+                    dict: The fetched ticker.
+                """
+        in_flight = self._in_flight.get((exchange.id, symbol))
+        if in_flight is not None:
+            # waiters that joined before the fetch started may have raised its priority
+            priority = in_flight[1]
+        try:
+            ticker = await request_scheduler.call(priority, exchange.fetch_ticker, symbol)
+            self.put(exchange.id, symbol, ticker)
+            return ticker
+        finally:
+            self._in_flight.pop((exchange.id, symbol), None)
+
+    def stats(self):
+        """
+                Returns the cache counters.
+
+                Returns:
+                    dict: Freshness window, number of entries and hit/miss/coalesced counters.
+                """
+        return {
+            "ttl_seconds": self.ttl_seconds,
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced
+        }
+
+
+ticker_cache = TickerCache()
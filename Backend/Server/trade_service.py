@@ -1,19 +1,38 @@
-import ccxt
-from sqlalchemy.orm import Session
+import asyncio
+import uuid
+from sqlalchemy import or_
+from sqlalchemy.orm import Session, joinedload, selectinload
 from models import Api, Trade, TakeProfit
+from exchange_pool import exchange_pool
+from ticker_cache import ticker_cache
+from price_service import price_service
+from request_scheduler import request_scheduler, Priority
+from balance_ledger import balance_ledger
+from order_reconciler import order_reconciler
+from trigger_engine import trigger_engine, ENTRY, STOP_LOSS, TAKE_PROFIT
+from positions import position_store
+from job_queue import job_queue
 from utils import verify_trade_token
+from metrics import StageLatency
+from database import SessionLocal
 from fastapi import HTTPException, FastAPI
+from ccxt.base.errors import OrderNotFound
 from datetime import datetime
 import logging
 
 logging.basicConfig(filename='trade_debug.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
 
+# latency of the stages of TradeService.create_order, reported through /metrics/
+order_pipeline_latency = StageLatency(("resolve", "prepare", "submit", "persist", "total"))
+
 
 class TradeService:
     """
         Service class to handle trade-related operations.
 
+        Exchange calls are coroutines backed by pooled ccxt.async_support clients, so callers must await them.
+
         Args:
             db (Session): Database session.
             authorization (str): Authorization token.
@@ -52,6 +71,52 @@ class TradeService:
                                 headers={"WWW-Authenticate": "Bearer"})
         return payload.get("account_id")
 
+    def _get_account_id(self):
+        """
+                Get the account ID of the request, decoding the authorization token only once.
+
+                Returns:
+                    int: Account ID.
+                """
+        if self.account_id is None:
+            self.account_id = self._get_account_id_from_token(self.authorization)
+        return self.account_id
+
+    def _resolve_api(self, exchange_name: str):
+        """
+                Resolve the account's API entry for an exchange and use it for all following exchange calls.
+
+                Args:
+                    exchange_name (str): The name of the exchange.
+
+                Raises:
+                    HTTPException: If the account has no API for the exchange.
+
+                Returns:
+                    Api: API key object.
+                """
+        self.api_key = self._find_api(exchange_name)
+        return self.api_key
+
+    def _find_api(self, exchange_name: str):
+        """
+                Look up the account's API entry for an exchange.
+
+                Args:
+                    exchange_name (str): The name of the exchange.
+
+                Raises:
+                    HTTPException: If the account has no API for the exchange.
+
+                Returns:
+                    Api: API key object.
+                """
+        api_key = self.db.query(Api).filter(Api.accountID == self._get_account_id(),
+                                            Api.exchange_name == exchange_name).first()
+        if not api_key:
+            raise HTTPException(status_code=404, detail=f"API named '{exchange_name}' not found.")
+        return api_key
+
     def get_api_id(self, order):
         """
                 Get the API ID for a given order.
@@ -65,61 +130,76 @@ class TradeService:
                 Returns:
                     int: API ID.
                 """
-        apiID = None
-        api_name = order.exchangeName
-        account_id = self._get_account_id_from_token(self.authorization)
-        account_apis = self.db.query(Api).filter(Api.accountID == account_id).all()
-        for a in account_apis:
-            if a.exchange_name == api_name:
-                apiID = a.api_id
-                return apiID
-        raise HTTPException(status_code=404, detail=f"API named '{api_name}' not found.")
+        api_id = self.db.query(Api.api_id).filter(Api.accountID == self._get_account_id(),
+                                                  Api.exchange_name == order.exchangeName).scalar()
+        if api_id is None:
+            raise HTTPException(status_code=404, detail=f"API named '{order.exchangeName}' not found.")
+        return api_id
 
-    def _get_api_key(self):
+    def _get_exchange_instance(self, trade=None):
         """
-               Get the API key for the account.
+                Get the pooled exchange instance of a trade's API entry, or of the API entry resolved for the request.
 
-               Raises:
-                   HTTPException: If the API key is not found for the account.
+                A trade's API entry is used for all following exchange calls of the service instance, so orders of a
+                trade always go to the exchange and key that placed it.
 
-               Returns:
-                   Api: API key object.
-               """
-
-        account_id = self._get_account_id_from_token(self.authorization)
-
-        api_key = self.db.query(Api).filter(Api.accountID == account_id).first()
-
-        if not api_key:
-            raise HTTPException(status_code=404, detail="API key not found for the account")
-        return api_key
+                Args:
+                    trade (Trade, optional): The trade whose orders are sent.
 
-    def _get_exchange_instance(self):
-        """
-                Get the exchange instance using ccxt.
+                Raises:
+                    HTTPException: If neither a trade nor an API entry is given.
 
                 Returns:
-                    ccxt.Exchange: Exchange instance.
+                    ccxt.async_support.Exchange: Exchange instance.
                 """
+        if trade is not None:
+            self.api_key = trade.api
+        if self.api_key is None:
+            raise HTTPException(status_code=400, detail="No exchange selected for the request")
 
-        self.api_key = self._get_api_key()
+        return exchange_pool.get(self.api_key)
 
-        exchange_class = getattr(ccxt, self.api_key.exchange_name)
+    def _find_trade_of_order(self, order_id: str):
+        """
+                Find the account's trade that an exchange order belongs to, and the leg of the trade it is.
 
-        exchange_args = {
-            'apiKey': self.api_key.key,
-            'secret': self.api_key.secret_Key
-        }
+                The order is matched by its exchange order ID (entry, Stop-Loss or Take-Profit leg) and, as the
+                cancel route passes trade IDs as well, by trade ID; a trade ID stands for the entry order.
 
-        if self.api_key.passphrase:
-            exchange_args['password'] = self.api_key.passphrase
+                Args:
+                    order_id (str): The order ID.
 
-        return exchange_class(exchange_args)
+                Raises:
+                    HTTPException: If the order does not belong to a trade of the account.
 
-    def has_sufficient_usdt_balance(self, required_amount):
+                Returns:
+                    tuple: The trade, the leg (ENTRY, STOP_LOSS or TAKE_PROFIT) and the matched Take-Profit row, or
+                    None for the other legs.
+                """
+        own_trades = self.db.query(Trade).join(Api, Trade.api_id == Api.api_id).filter(
+            Api.accountID == self._get_account_id())
+        trade = own_trades.filter(or_(Trade.exchange_order_id == order_id, Trade.stop_loss_order_id == order_id,
+                                      Trade.take_profits.any(TakeProfit.exchange_order_id == order_id))).first()
+        if trade is None and order_id.isdigit():
+            trade = own_trades.filter(Trade.trade_id == int(order_id)).first()
+            if trade is not None:
+                return trade, ENTRY, None
+        if trade is None:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if trade.exchange_order_id == order_id:
+            return trade, ENTRY, None
+        if trade.stop_loss_order_id == order_id:
+            return trade, STOP_LOSS, None
+        take_profit = next(row for row in trade.take_profits if row.exchange_order_id == order_id)
+        return trade, TAKE_PROFIT, take_profit
+
+    async def has_sufficient_usdt_balance(self, required_amount):
         """
                 Check if the account has sufficient USDT balance.
 
+                The check runs against the local balance ledger; the exchange is only asked when the ledger has not
+                been seeded for the API key yet.
+
                 Args:
                     required_amount (float): The required amount of USDT.
 
@@ -129,22 +209,340 @@ class TradeService:
                 Returns:
                     bool: True if sufficient balance, otherwise False.
                 """
-        try:
-            exchange = self._get_exchange_instance()
+        await self._seed_balance_ledger()
 
-            balance = exchange.fetch_balance()
+        return await balance_ledger.available(self.api_key.api_id, 'USDT') >= required_amount
 
-            usdt_balance = balance['free'].get('USDT', 0)
+    async def _seed_balance_ledger(self):
+        """
+                Seed the balance ledger of the account's API key if necessary.
 
-            return usdt_balance >= required_amount
+                Raises:
+                    HTTPException: If there's an error fetching the balance.
+                """
+        try:
+            exchange = self._get_exchange_instance()
+
+            await balance_ledger.ensure_seeded(self.api_key.api_id, exchange)
+        except HTTPException as e:
+            raise e
         except Exception as e:
 
             raise HTTPException(status_code=500, detail=f"Error fetching balance: {str(e)}")
 
-    def create_order(self, order):
+    @staticmethod
+    async def _reserve_order_funds(api_id, order, current_price):
+        """
+                Reserve the funds an order spends in the balance ledger.
+
+                Buy orders spend the quote currency (amount times price), sell orders spend the base currency.
+
+                Args:
+                    api_id (int): The ID of the API entry that places the order.
+                    order: The order object containing order details.
+                    current_price (float): The current market price, used when the order has no price.
+
+                Raises:
+                    HTTPException: If the order would overdraw the balance.
+
+                Returns:
+                    str: The reservation ID.
+                """
+        base, quote = order.symbol.split(':')[0].split('/')
+        if order.side == 'sell':
+            spent_currency, spent_amount = base, order.amount
+        else:
+            spent_currency, spent_amount = quote, order.amount * (order.price or current_price)
+
+        reservation = await balance_ledger.reserve(api_id, spent_currency, spent_amount)
+        if reservation is None:
+            raise HTTPException(status_code=400, detail=f"Insufficient {spent_currency} balance")
+        return reservation
+
+    async def _submit_order(self, exchange, order):
+        """
+                Submit a market or limit order to the exchange.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The pooled client of the account.
+                    order: The order object containing order details.
+
+                Raises:
+                    HTTPException: If the order type is invalid.
+
+                Returns:
+                    tuple: The created order and the date bought (None for limit orders).
+                """
+        order_params = {
+            'order_type': order.order_type
+        }
+        if order.order_type == 'market':
+            additional_params = {
+                'symbol': order.symbol,
+                'side': order.side,
+                'amount': order.amount,
+                # 'take_profit_price': order.take_profit_prices,
+                # 'stop_loss_price': order.stop_loss_prices,
+                # 'params': {'timeInForce': 'GTC'}
+            }
+            order_params.update(additional_params)
+
+            created_order = await request_scheduler.call(Priority.ORDER, exchange.create_market_order,
+                                                         **additional_params)
+
+            return created_order, datetime.now().date()
+
+        elif order.order_type == 'limit':
+
+            additional_params = {
+                'symbol': order.symbol,
+                'side': order.side,
+                'amount': order.amount,
+                'price': order.price,
+                # 'stop_price': order.stop_price,
+                # 'take_profit_price': order.take_profit_prices,
+                # 'stop_loss_price': order.stop_loss_prices,
+                # 'params': {'timeInForce': 'GTC'}
+            }
+
+            order_params.update(additional_params)
+
+            created_order = await request_scheduler.call(Priority.ORDER, exchange.create_limit_order,
+                                                         **additional_params)
+
+            return created_order, None
+
+        else:
+            raise HTTPException(status_code=400, detail="Invalid order type")
+
+    @staticmethod
+    async def _submit_bracket_orders(exchange, trade, take_profit_prices, stop_loss_price, take_profit_count=None):
+        """
+                Submit the take-profit and stop-loss legs of a trade at once.
+
+                The legs are sent as one batch request if the exchange supports it, otherwise concurrently. A failing
+                leg does not cancel the others; its exception is returned in place of the order.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The pooled client of the account.
+                    trade (Trade): The trade the legs protect; it does not need to be persisted yet.
+                    take_profit_prices (list): List of Take-Profit prices, may be empty.
+                    stop_loss_price (float): The Stop-Loss price, or None.
+                    take_profit_count (int, optional): Number of Take-Profit legs the volume is split into, if some
+                        of them were already placed.
+
+                Returns:
+                    tuple: The take-profit results in price order and the stop-loss result (None if not requested).
+                """
+        side = 'sell' if trade.trade_status == 'open' else 'buy'
+        legs = [{
+            'symbol': trade.currency_name,
+            'type': 'take_profit_market',
+            'side': side,
+            'amount': trade.currency_volume / (take_profit_count or len(take_profit_prices)),  # Aufteilen des Volumens
+            'params': {'stopPrice': price, 'reduceOnly': True}
+        } for price in take_profit_prices]
+        if stop_loss_price:
+            legs.append({
+                'symbol': trade.currency_name,
+                'type': 'stop_market',
+                'side': side,
+                'amount': trade.currency_volume,
+                'params': {'stopPrice': stop_loss_price, 'reduceOnly': True}
+            })
+
+        if len(legs) > 1 and exchange.has.get('createOrders'):
+            try:
+                results = await request_scheduler.call(Priority.ORDER, exchange.create_orders, legs)
+            except Exception as e:
+                results = [e] * len(legs)
+        else:
+            results = await asyncio.gather(*(request_scheduler.call(Priority.ORDER, exchange.create_order, **leg)
+                                             for leg in legs), return_exceptions=True)
+        results = list(results)
+        stop_loss_result = results.pop() if stop_loss_price else None
+        return results, stop_loss_result
+
+    @staticmethod
+    async def _cancel_orders(exchange, order_ids, symbol, ignore_missing=False):
+        """
+                Cancel several orders of one symbol at once, as a single batch request if the exchange supports it.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The pooled client of the account.
+                    order_ids (list): The exchange order IDs.
+                    symbol (str): The trading pair symbol.
+                    ignore_missing (bool): Whether orders the exchange no longer knows, because they were filled or
+                        cancelled already, count as cancelled.
+
+                Raises:
+                    Exception: The first error of a failed cancellation, after all cancellations have finished.
+                """
+        if not order_ids:
+            return
+        if len(order_ids) > 1 and exchange.has.get('cancelOrders') and not ignore_missing:
+            await request_scheduler.call(Priority.ORDER, exchange.cancel_orders, order_ids, symbol)
+            return
+        results = await asyncio.gather(*(request_scheduler.call(Priority.ORDER, exchange.cancel_order,
+                                                                order_id, symbol)
+                                         for order_id in order_ids), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not (ignore_missing and isinstance(result, OrderNotFound)):
+                raise result
+
+    def _insert_take_profits(self, trade_id, take_profit_prices, take_profit_results):
+        """
+                Write the Take-Profit rows of the accepted legs of a trade with one bulk insert.
+
+                Args:
+                    trade_id (int): The trade ID.
+                    take_profit_prices (list): List of Take-Profit prices.
+                    take_profit_results (list): The submission result of each price.
+                """
+        rows = [{'trade_id': trade_id, 'price': price, 'exchange_order_id': result.get('id')}
+                for price, result in zip(take_profit_prices, take_profit_results)
+                if not isinstance(result, Exception)]
+        if rows:
+            self.db.bulk_insert_mappings(TakeProfit, rows)
+
+    @staticmethod
+    def _watch_levels(exchange, trade_id, symbol, take_profit_prices, take_profit_results, stop_loss_price,
+                      stop_loss_result, filled=True, account_id=None):
+        """
+                Add the accepted levels of a trade to the trigger engine.
+
+                A new Stop-Loss replaces the watched stop level of the trade; Take-Profit levels are added. The levels
+                of a trade whose entry order is still open are watched once it fills.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The pooled client of the API entry.
+                    trade_id (int): The trade ID.
+                    symbol (str): The trading pair symbol.
+                    take_profit_prices (list): List of Take-Profit prices.
+                    take_profit_results (list): The submission result of each Take-Profit leg.
+                    stop_loss_price (float): The Stop-Loss price, or None.
+                    stop_loss_result: The submission result of the Stop-Loss leg, or None.
+                    filled (bool): Whether the entry order of the trade was filled.
+                    account_id (int, optional): The account of the trade.
+                """
+        if not filled:
+            return
+        for price, result in zip(take_profit_prices, take_profit_results):
+            if not isinstance(result, Exception):
+                trigger_engine.add(trade_id, exchange.id, symbol, TAKE_PROFIT, price, exchange, account_id)
+        if stop_loss_result is not None and not isinstance(stop_loss_result, Exception):
+            trigger_engine.remove_trade(trade_id, STOP_LOSS)
+            trigger_engine.add(trade_id, exchange.id, symbol, STOP_LOSS, stop_loss_price, exchange, account_id)
+
+    @staticmethod
+    def _build_trade(order, created_order, date_bought, api_id, current_price):
+        """
+                Build the Trade row of an order the exchange accepted.
+
+                Args:
+                    order: The order object containing order details.
+                    created_order (dict): The order returned by the exchange.
+                    date_bought (date): The date bought (None for limit orders).
+                    api_id (int): The ID of the API entry that placed the order.
+                    current_price (float): The market price at submission, stored as purchase rate of market orders.
+
+                Returns:
+                    Trade: The unsaved trade.
+                """
+        return Trade(
+            trade_price=order.price if order.order_type == 'limit' else 0,
+            trade_type=order.order_type,
+            currency_name=order.symbol,
+            currency_volume=order.amount,
+            trade_status=created_order['status'],
+            date_create=datetime.now().date(),
+            date_bought=date_bought,
+            api_id=api_id,
+            purchase_rate=current_price if order.order_type == 'market' else None,
+            exchange_order_id=created_order.get('id')
+        )
+
+    def _stage_trades(self, entries):
+        """
+                Add trades, the Take-Profit rows of their accepted legs and the positions of filled trades to the
+                session without committing.
+
+                Args:
+                    entries (list): Tuples of (trade, order, take-profit results, stop-loss result).
+
+                Returns:
+                    list: Per trade the arguments of `_watch_levels` after the client, read before the commit expires
+                    the trade.
+                """
+        trades = [entry[0] for entry in entries]
+        self.db.add_all(trades)
+        self.db.flush()
+        rows = []
+        staged = []
+        for trade, order, take_profit_results, stop_loss_result in entries:
+            rows.extend({'trade_id': trade.trade_id, 'price': price, 'exchange_order_id': result.get('id')}
+                        for price, result in zip(order.take_profit_prices or [], take_profit_results)
+                        if not isinstance(result, Exception))
+            if stop_loss_result is not None and not isinstance(stop_loss_result, Exception):
+                trade.stop_loss_price = order.stop_loss_price
+                trade.stop_loss_order_id = stop_loss_result.get('id')
+            staged.append((trade.trade_id, trade.currency_name, order.take_profit_prices or [], take_profit_results,
+                           order.stop_loss_price, stop_loss_result, position_store.is_filled(trade)))
+        if rows:
+            self.db.bulk_insert_mappings(TakeProfit, rows)
+        position_store.apply(self.db, [position_store.fill(trade) for trade in trades if trade.date_bought is not None])
+        return staged
+
+    @staticmethod
+    def bracket_orders_key(trade):
+        """
+                Return the idempotency key of the job that places the bracket legs of a trade.
+
+                SQLite hands the ID of a deleted trade to the next one, so the key is built from the exchange order ID
+                of the entry, which is never reused.
+
+                Args:
+                    trade (Trade): The trade.
+
+                Returns:
+                    str: The idempotency key.
+                """
+        return f"bracket_orders:{trade.api_id}:{trade.exchange_order_id or uuid.uuid4().hex}"
+
+    def _enqueue_bracket_orders(self, trade, order):
+        """
+                Queue the placement of the Take-Profit and Stop-Loss legs of a new trade in the current transaction.
+
+                Args:
+                    trade (Trade): The flushed trade.
+                    order: The order object containing the requested levels.
+
+                Returns:
+                    bool: Whether a job was queued.
+                """
+        if not order.take_profit_prices and not order.stop_loss_price:
+            return False
+        job_queue.enqueue(self.db, "place_bracket_orders", {
+            "trade_id": trade.trade_id,
+            "entry_order_id": trade.exchange_order_id,
+            "take_profit_prices": order.take_profit_prices or [],
+            "stop_loss_price": order.stop_loss_price
+        }, idempotency_key=self.bracket_orders_key(trade))
+        return True
+
+    @staticmethod
+    def _failed_legs(take_profit_results, stop_loss_result):
+        return [result for result in take_profit_results + [stop_loss_result] if isinstance(result, Exception)]
+
+    async def create_order(self, order):
         """
                 Create a new order.
 
+                The request is handled in one pass: the API entry is resolved once, the same pooled client serves
+                every exchange call and independent calls run concurrently. The trade is written together with a job
+                that places its Take-Profit and Stop-Loss legs in a single transaction; the job queue submits the legs
+                after the response and retries failed ones. Stage latencies are recorded in `order_pipeline_latency`.
+
                 Args:
                     order: The order object containing order details.
 
@@ -154,102 +552,181 @@ class TradeService:
                 Returns:
                     dict: The created order details.
                 """
-        try:
+        with order_pipeline_latency.measure("total"):
+            try:
+                with order_pipeline_latency.measure("resolve"):
+                    api_key = self._resolve_api(order.exchangeName)
+                    exchange = exchange_pool.get(api_key)
+
+                with order_pipeline_latency.measure("prepare"):
+                    # seeding the ledger (once per API key) and the ticker are independent
+                    _, current_price = await asyncio.gather(
+                        self._seed_balance_ledger(),
+                        self._get_current_market_price(order.symbol, Priority.ORDER))
+                    reservation = await self._reserve_order_funds(api_key.api_id, order, current_price)
+
+                with order_pipeline_latency.measure("submit"):
+                    try:
+                        created_order, date_bought = await self._submit_order(exchange, order)
+                    except Exception:
+                        await balance_ledger.release(api_key.api_id, reservation)
+                        raise
+                    await balance_ledger.commit(api_key.api_id, reservation, created_order)
 
-            if not self.has_sufficient_usdt_balance(order.amount * order.price):
-                raise HTTPException(status_code=400, detail="Insufficient USDT balance")
+                new_trade = self._build_trade(order, created_order, date_bought, api_key.api_id, current_price)
 
-            exchange = self._get_exchange_instance()
+                with order_pipeline_latency.measure("persist"):
+                    staged = self._stage_trades([(new_trade, order, [], None)])
+                    bracket_queued = self._enqueue_bracket_orders(new_trade, order)
+                    self.db.commit()
+                    self._watch_levels(exchange, *staged[0], account_id=api_key.accountID)
+                if order.order_type == 'limit':
+                    order_reconciler.wake()
 
-            order_params = {
-                'order_type': order.order_type
-            }
-            currency = order.symbol
-            created_order = None
-            if order.order_type == 'market':
-                additional_params = {
-                    'symbol': order.symbol,
-                    'side': order.side,
-                    'amount': order.amount,
-                    # 'take_profit_price': order.take_profit_prices,
-                    # 'stop_loss_price': order.stop_loss_prices,
-                    # 'params': {'timeInForce': 'GTC'}
-                }
-                order_params.update(additional_params)
+                response = {"message": "Order created successfully", "order": created_order}
+                if bracket_queued:
+                    response["bracket_orders"] = "queued"
+                return response
+            except HTTPException as e:
 
-                created_order = exchange.create_market_order(**additional_params)
+                raise e
+            except Exception as e:
+                self.db.rollback()
 
-                date_bought = datetime.now().date()
+                raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
+    async def _submit_orders(self, exchange, orders):
+        """
+                Submit several orders of one client, as a single batch request if the exchange supports it.
 
-            elif order.order_type == 'limit':
+                Args:
+                    exchange (ccxt.async_support.Exchange): The pooled client of the API entry.
+                    orders (list): The order objects.
 
-                additional_params = {
+                Returns:
+                    list: Per order a tuple of (created order, date bought) or the exception of a failed submission.
+                """
+        if len(orders) > 1 and exchange.has.get('createOrders'):
+            try:
+                created_orders = await request_scheduler.call(Priority.ORDER, exchange.create_orders, [{
                     'symbol': order.symbol,
+                    'type': order.order_type,
                     'side': order.side,
                     'amount': order.amount,
-                    'price': order.price,
-                    # 'stop_price': order.stop_price,
-                    # 'take_profit_price': order.take_profit_prices,
-                    # 'stop_loss_price': order.stop_loss_prices,
-                    # 'params': {'timeInForce': 'GTC'}
-                }
+                    'price': order.price if order.order_type == 'limit' else None
+                } for order in orders])
+            except Exception as e:
+                return [e] * len(orders)
+            return [(created_order, datetime.now().date() if order.order_type == 'market' else None)
+                    for order, created_order in zip(orders, created_orders)]
 
-                order_params.update(additional_params)
+        return await asyncio.gather(*(self._submit_order(exchange, order) for order in orders),
+                                    return_exceptions=True)
 
-                created_order = exchange.create_limit_order(**additional_params)
+    async def create_orders(self, orders):
+        """
+                Create several orders at once.
 
-                date_bought = None
+                Each exchange is resolved, seeded and priced once for the whole batch. The orders of every exchange
+                are submitted concurrently (or as one native batch) and all trades are written in a single
+                transaction, together with the jobs that place the bracket legs of the accepted orders.
 
-            else:
-                raise HTTPException(status_code=400, detail="Invalid order type")
-            new_trade = None
-            api_id = self.get_api_id(order)
-
-            current_price = self._get_current_market_price(currency)
-            if order.order_type == 'market':
-                new_trade = Trade(
-                    trade_price=0,
-                    trade_type=order.order_type,
-                    currency_name=order.symbol,
-                    currency_volume=order.amount,
-                    trade_status=created_order['status'],
-                    date_create=datetime.now().date(),
-                    date_bought=date_bought,
-                    api_id=api_id,
-                    purchase_rate=current_price
-                )
-            if order.order_type == 'limit':
-                new_trade = Trade(
-                    trade_price=order.price,
-                    trade_type=order.order_type,
-                    currency_name=order.symbol,
-                    currency_volume=order.amount,
-                    trade_status=created_order['status'],
-                    date_create=datetime.now().date(),
-                    date_bought=None,
-                    api_id=api_id
-                )
-            self.db.add(new_trade)
-            self.db.commit()
-            self.db.refresh(new_trade)
-
-            # Optionally add Take-Profit and Stop-Loss orders
-            if order.take_profit_prices:
-                self.add_take_profits(new_trade.trade_id, order.take_profit_prices)
+                Args:
+                    orders (list): The order objects.
 
-            if order.stop_loss_price:
-                self.add_stop_loss(new_trade.trade_id, order.stop_loss_price)
+                Raises:
+                    HTTPException: If the trades cannot be stored.
 
-            return {"message": "Order created successfully", "order": created_order}
-        except HTTPException as e:
+                Returns:
+                    dict: One result per order, in request order, with status 'created' or 'failed'.
+                """
+        self._get_account_id()
+        results = [None] * len(orders)
 
-            raise e
+        # resolve every exchange once; orders of an unknown exchange fail without touching the others
+        clients = {}
+        for exchange_name in dict.fromkeys(order.exchangeName for order in orders):
+            try:
+                api_key = self._find_api(exchange_name)
+                clients[exchange_name] = (api_key, exchange_pool.get(api_key))
+            except HTTPException as e:
+                clients[exchange_name] = e
+
+        pending = [index for index, order in enumerate(orders)
+                   if not isinstance(clients[order.exchangeName], HTTPException)]
+        for index, order in enumerate(orders):
+            if isinstance(clients[order.exchangeName], HTTPException):
+                results[index] = {"index": index, "status": "failed",
+                                  "detail": clients[order.exchangeName].detail}
+
+        seeded = [client for client in clients.values() if not isinstance(client, HTTPException)]
+        seed_results = await asyncio.gather(*(balance_ledger.ensure_seeded(api_key.api_id, exchange)
+                                              for api_key, exchange in seeded), return_exceptions=True)
+        try:
+            prices = await price_service.get_prices_for_pairs(
+                [(clients[orders[index].exchangeName][1], orders[index].symbol) for index in pending], Priority.ORDER)
         except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error fetching prices: {str(e)}")
+        seed_errors = {api_key.api_id: result for (api_key, _), result in zip(seeded, seed_results)
+                       if isinstance(result, Exception)}
+
+        groups = {}
+        reservations = {}
+        for index in pending:
+            order = orders[index]
+            api_key, exchange = clients[order.exchangeName]
+            if api_key.api_id in seed_errors:
+                results[index] = {"index": index, "status": "failed",
+                                  "detail": f"Error fetching balance: {str(seed_errors[api_key.api_id])}"}
+                continue
+            try:
+                reservations[index] = await self._reserve_order_funds(api_key.api_id, order,
+                                                                      prices[(exchange.id, order.symbol)])
+            except HTTPException as e:
+                results[index] = {"index": index, "status": "failed", "detail": e.detail}
+                continue
+            groups.setdefault(order.exchangeName, []).append(index)
+
+        submissions = await asyncio.gather(*(self._submit_orders(clients[exchange_name][1],
+                                                                 [orders[index] for index in indices])
+                                             for exchange_name, indices in groups.items()))
+
+        accepted = []
+        for (exchange_name, indices), submitted in zip(groups.items(), submissions):
+            api_key, exchange = clients[exchange_name]
+            for index, result in zip(indices, submitted):
+                if isinstance(result, Exception):
+                    await balance_ledger.release(api_key.api_id, reservations[index])
+                    results[index] = {"index": index, "status": "failed", "detail": str(result)}
+                    continue
+                order = orders[index]
+                created_order, date_bought = result
+                await balance_ledger.commit(api_key.api_id, reservations[index], created_order)
+                trade = self._build_trade(order, created_order, date_bought, api_key.api_id,
+                                          prices[(exchange.id, order.symbol)])
+                accepted.append((index, exchange, trade, created_order))
 
+        try:
+            staged = self._stage_trades([(trade, orders[index], [], None) for index, _, trade, _ in accepted])
+            bracket_queued = [self._enqueue_bracket_orders(trade, orders[index])
+                              for index, _, trade, _ in accepted]
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-    def add_take_profits(self, trade_id, take_profit_prices):
+        for (index, exchange, _, created_order), trade_orders, queued in zip(accepted, staged, bracket_queued):
+            self._watch_levels(exchange, *trade_orders, account_id=self._get_account_id())
+            results[index] = {"index": index, "status": "created", "trade_id": trade_orders[0],
+                              "order": created_order}
+            if queued:
+                results[index]["bracket_orders"] = "queued"
+
+        if any(orders[index].order_type == 'limit' for index, _, _, _ in accepted):
+            order_reconciler.wake()
+        return {"message": f"{len(accepted)} of {len(orders)} orders created", "results": results}
+
+    async def add_take_profits(self, trade_id, take_profit_prices):
         """
                 Add Take-Profit orders.
 
@@ -268,27 +745,23 @@ class TradeService:
             if not trade:
                 raise HTTPException(status_code=404, detail="Trade not found")
 
-            exchange = self._get_exchange_instance()
-
-            response = []
-            for price in take_profit_prices:
-                take_profit_order = exchange.create_order(
-                    symbol=trade.currency_name,
-                    type='take_profit_market',
-                    side='sell' if trade.trade_status == 'open' else 'buy',
-                    amount=trade.currency_volume / len(take_profit_prices),  # Aufteilen des Volumens
-                    params={'stopPrice': price, 'reduceOnly': True}
-                )
-                new_take_profit = TakeProfit(trade_id=trade_id, price=price)
-                self.db.add(new_take_profit)
-                response.append(take_profit_order)
+            exchange = self._get_exchange_instance(trade)
 
+            response, _ = await self._submit_bracket_orders(exchange, trade, take_profit_prices, None)
+            self._insert_take_profits(trade_id, take_profit_prices, response)
+            symbol, filled = trade.currency_name, position_store.is_filled(trade)
             self.db.commit()
+            self._watch_levels(exchange, trade_id, symbol, take_profit_prices, response, None, None, filled,
+                               self.api_key.accountID)
+
+            failed_legs = self._failed_legs(response, None)
+            if failed_legs:
+                raise failed_legs[0]
             return {"message": "Take-Profit orders added successfully", "take_profit_orders": response}
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-    def add_stop_loss(self, trade_id, stop_loss_price):
+    async def add_stop_loss(self, trade_id, stop_loss_price):
         """
                 Add Stop-Loss order.
 
@@ -307,9 +780,10 @@ class TradeService:
             if not trade:
                 raise HTTPException(status_code=404, detail="Trade not found")
 
-            exchange = self._get_exchange_instance()
+            exchange = self._get_exchange_instance(trade)
 
-            stop_loss_order = exchange.create_order(
+            stop_loss_order = await request_scheduler.call(
+                Priority.ORDER, exchange.create_order,
                 symbol=trade.currency_name,
                 type='stop_market',
                 side='sell' if trade.trade_status == 'open' else 'buy',
@@ -318,13 +792,17 @@ class TradeService:
             )
 
             trade.stop_loss_price = stop_loss_price
+            trade.stop_loss_order_id = stop_loss_order.get('id')
+            symbol, filled = trade.currency_name, position_store.is_filled(trade)
             self.db.commit()
+            self._watch_levels(exchange, trade_id, symbol, [], [], stop_loss_price, stop_loss_order, filled,
+                               self.api_key.accountID)
 
             return {"message": "Stop-Loss order added successfully", "stop_loss_order": stop_loss_order}
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Server Error: {str(e)}")
 
-    def add_take_profit_and_stop_loss(self, trade_id, take_profit_prices, stop_loss_price, comment):
+    async def add_take_profit_and_stop_loss(self, trade_id, take_profit_prices, stop_loss_price, comment):
         """
             Add Take-Profit and Stop-Loss orders and update trade with a comment.
 
@@ -341,18 +819,32 @@ class TradeService:
                 dict: Success message.
             """
         try:
+            trade = self.db.query(Trade).filter(Trade.trade_id == trade_id).first()
+            if not trade:
+                raise HTTPException(status_code=404, detail="Trade not found")
 
-            if take_profit_prices:
-                self.add_take_profits(trade_id, take_profit_prices)
-
-            if stop_loss_price:
-                self.add_stop_loss(trade_id, stop_loss_price)
-
+            take_profit_prices = take_profit_prices or []
+            take_profit_results, stop_loss_result = [], None
+            if take_profit_prices or stop_loss_price:
+                exchange = self._get_exchange_instance(trade)
+                take_profit_results, stop_loss_result = await self._submit_bracket_orders(
+                    exchange, trade, take_profit_prices, stop_loss_price)
+
+            self._insert_take_profits(trade_id, take_profit_prices, take_profit_results)
+            if stop_loss_result is not None and not isinstance(stop_loss_result, Exception):
+                trade.stop_loss_price = stop_loss_price
+                trade.stop_loss_order_id = stop_loss_result.get('id')
             if comment:
-                trade = self.db.query(Trade).filter(Trade.trade_id == trade_id).first()
                 trade.comment = comment
-                self.db.commit()
-                self.db.refresh(trade)
+            symbol, filled = trade.currency_name, position_store.is_filled(trade)
+            self.db.commit()
+            if take_profit_results or stop_loss_result is not None:
+                self._watch_levels(exchange, trade_id, symbol, take_profit_prices, take_profit_results,
+                                   stop_loss_price, stop_loss_result, filled, self.api_key.accountID)
+
+            failed_legs = self._failed_legs(take_profit_results, stop_loss_result)
+            if failed_legs:
+                raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(failed_legs[0])}")
 
             return {"message": "Take-profit, stop-loss orders and Comment added successfully"}
         except HTTPException as e:
@@ -360,7 +852,7 @@ class TradeService:
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-    def calculate_profit_loss_amount(self, trade_id: int) -> float:
+    async def calculate_profit_loss_amount(self, trade_id: int) -> float:
         """
             Calculate the profit or loss amount for a trade.
 
@@ -379,20 +871,19 @@ class TradeService:
         if not trade:
             raise HTTPException(status_code=404, detail="Trade not found")
 
-        current_price = self._get_current_market_price(trade.currency_name)
+        current_price = await self._get_current_market_price(trade.currency_name, trade=trade)
 
         profit_loss_amount = (current_price - trade.purchase_rate) * trade.currency_volume
         return profit_loss_amount
 
-    def _get_current_market_price(self, currncy_name: str) -> float:
+    async def _get_current_market_price(self, currncy_name: str, priority: Priority = Priority.VALUATION,
+                                        trade=None) -> float:
 
-        exchange = self._get_exchange_instance()
+        exchange = self._get_exchange_instance(trade)
 
-        ticker = exchange.fetch_ticker(currncy_name)
+        return await ticker_cache.get_last_price(exchange, currncy_name, priority)
 
-        return ticker['last']
-
-    def calculate_profit_loss_percentage(self, trade_id: int) -> float:
+    async def calculate_profit_loss_percentage(self, trade_id: int) -> float:
         """
             Calculate the profit or loss percentage for a trade.
 
@@ -410,12 +901,45 @@ class TradeService:
         if not trade:
             raise HTTPException(status_code=404, detail="Trade not found")
 
-        current_price = self._get_current_market_price(trade.currency_name)
+        current_price = await self._get_current_market_price(trade.currency_name, trade=trade)
 
         profit_loss_percentage = ((current_price - trade.purchase_rate) / trade.purchase_rate) * 100
         return profit_loss_percentage
 
-    def complete_trade(self, trade_id: int):
+    async def calculate_profit_loss_for_trades(self, trade_ids: list) -> dict:
+        """
+            Calculate the profit or loss of several trades with one batched price lookup per exchange.
+
+            Args:
+                trade_ids (list): The trade IDs.
+
+            Raises:
+                HTTPException: If one of the trades is not found.
+
+            Returns:
+                dict: Profit/loss amount and percentage by trade ID; both are None for trades without purchase rate.
+            """
+        trades = self.db.query(Trade).filter(Trade.trade_id.in_(trade_ids)).all()
+        if len(trades) != len(set(trade_ids)):
+            raise HTTPException(status_code=404, detail="Trade not found")
+
+        clients = {trade.trade_id: exchange_pool.get(trade.api) for trade in trades}
+        prices = await price_service.get_prices_for_pairs(
+            (clients[trade.trade_id], trade.currency_name) for trade in trades)
+
+        result = {}
+        for trade in trades:
+            current_price = prices[(clients[trade.trade_id].id, trade.currency_name)]
+            if not trade.purchase_rate:
+                result[trade.trade_id] = {"profit_loss_amount": None, "profit_loss_percentage": None}
+                continue
+            result[trade.trade_id] = {
+                "profit_loss_amount": (current_price - trade.purchase_rate) * trade.currency_volume,
+                "profit_loss_percentage": ((current_price - trade.purchase_rate) / trade.purchase_rate) * 100
+            }
+        return result
+
+    async def complete_trade(self, trade_id: int):
         """
             Complete a trade by canceling open orders and calculating profit/loss.
 
@@ -432,7 +956,7 @@ class TradeService:
         if not trade:
             raise HTTPException(status_code=404, detail="Trade not found")
 
-        exchange = self._get_exchange_instance()
+        exchange = self._get_exchange_instance(trade)
 
         apiTrade = self.db.query(Trade).filter(Trade.trade_id == trade_id and Trade.api_id == trade.api_id).first()
 
@@ -443,21 +967,27 @@ class TradeService:
                 'amount': trade.currency_volume,
             }
 
-            created_order = exchange.create_market_order(**additional_params)
+            created_order = await request_scheduler.call(Priority.ORDER, exchange.create_market_order,
+                                                         **additional_params)
+            await balance_ledger.mark_stale(trade.api_id)
 
 
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error cancelling Take-Profit order: {str(e)}")
 
         # Calculate profit/loss
-        profit_loss_amount = self.calculate_profit_loss_amount(trade_id)
-
-        profit_loss_percentage = self.calculate_profit_loss_percentage(trade_id)
+        profit_loss_amount, profit_loss_percentage = await asyncio.gather(
+            self.calculate_profit_loss_amount(trade_id),
+            self.calculate_profit_loss_percentage(trade_id))
 
-        trade.selling_rate = profit_loss_amount
+        entry = position_store.entry_price(trade)
+        # Take-Profit legs may have realized profit/loss on part of the volume already
+        trade.selling_rate = (trade.selling_rate or 0.0) + profit_loss_amount
         trade.date_sale = datetime.now()
         trade.purchase_rate = profit_loss_percentage
+        position_store.apply(self.db, [position_store.close(trade, entry, profit_loss_amount)])
         self.db.commit()
+        trigger_engine.remove_trade(trade_id)
 
         return {
             "message": "Trade completed successfully",
@@ -465,27 +995,46 @@ class TradeService:
             "profit_loss_percentage": profit_loss_percentage
         }
 
-    def check_and_update_limit_orders(self):
+    async def check_and_update_limit_orders(self):
         """
             Check and update limit orders by setting the date bought if closed.
 
+            The account's API keys are reconciled in bulk by the order reconciler.
+
             Returns:
-                None
+                int: Number of updated trades.
             """
-        trades = self.db.query(Trade).filter(Trade.trade_type == 'limit', Trade.date_bought == None).all()
-        exchange = self._get_exchange_instance()
+        return await order_reconciler.reconcile(self._get_account_id())
 
-        for trade in trades:
-            try:
-                order = exchange.fetch_order(trade.trade_id, trade.currency_name)
-                if order['status'] == 'closed':
-                    trade.date_bought = datetime.now()
-                    self.db.commit()
-            except Exception as e:
-                print(f"Error checking order {trade.trade_id}: {str(e)}")
+    @staticmethod
+    async def _find_untracked_bracket_orders(exchange, trade, stop_loss, take_profits):
+        """
+                Find the open bracket legs of a trade created before exchange order IDs were stored.
 
-    def update_stop_loss_and_take_profits(self, trade_id: int, new_stop_loss_price: float,
-                                          new_take_profit_prices: list):
+                The legs are matched by type and price against the open orders of the trade's symbol.
+
+                Args:
+                    exchange (ccxt.async_support.Exchange): The pooled client of the account.
+                    trade (Trade): The trade.
+                    stop_loss (bool): Whether to look for the Stop-Loss leg.
+                    take_profits (bool): Whether to look for the Take-Profit legs.
+
+                Returns:
+                    list: The exchange order IDs.
+                """
+        old_take_profit_prices = {tp.price for tp in trade.take_profits}
+        open_orders = await request_scheduler.call(Priority.ORDER, exchange.fetch_open_orders,
+                                                   symbol=trade.currency_name)
+        order_ids = []
+        for order in open_orders:
+            if stop_loss and order['type'] == 'stop_market' and order['price'] == trade.stop_loss_price:
+                order_ids.append(order['id'])
+            elif take_profits and order['type'] == 'take_profit_market' and order['price'] in old_take_profit_prices:
+                order_ids.append(order['id'])
+        return order_ids
+
+    async def update_stop_loss_and_take_profits(self, trade_id: int, new_stop_loss_price: float,
+                                                new_take_profit_prices: list):
         """
             Update Stop-Loss and Take-Profit orders for a trade.
 
@@ -505,60 +1054,50 @@ class TradeService:
             if not trade:
                 raise HTTPException(status_code=404, detail="Trade not found")
 
-            exchange = self._get_exchange_instance()
-
-            # Update Stop-Loss order
-            if new_stop_loss_price:
-                # Cancel existing Stop-Loss order if it exists
-                if trade.stop_loss_price:
-                    try:
-                        open_orders = exchange.fetch_open_orders(symbol=trade.currency_name)
-                        for order in open_orders:
-                            if order['type'] == 'stop_market' and order['price'] == trade.stop_loss_price:
-                                exchange.cancel_order(order['id'], trade.currency_name)
-                    except Exception as e:
-                        raise HTTPException(status_code=500,
-                                            detail=f"Error cancelling existing Stop-Loss order: {str(e)}")
-
-                # Create new Stop-Loss order
-                stop_loss_order = exchange.create_order(
-                    symbol=trade.currency_name,
-                    type='stop_market',
-                    side='sell' if trade.trade_status == 'open' else 'buy',
-                    amount=trade.currency_volume,
-                    params={'stopPrice': new_stop_loss_price, 'reduceOnly': True}
-                )
-                trade.stop_loss_price = new_stop_loss_price
+            exchange = self._get_exchange_instance(trade)
+            replace_stop_loss = bool(new_stop_loss_price)
+            new_take_profit_prices = new_take_profit_prices or []
 
-            # Update Take-Profit orders
-            if new_take_profit_prices:
-                # Cancel existing Take-Profit orders if they exist
+            # Cancel the legs that are replaced, all in one round
+            if (replace_stop_loss and trade.stop_loss_price) or new_take_profit_prices:
                 try:
-                    open_orders = exchange.fetch_open_orders(symbol=trade.currency_name)
-                    for order in open_orders:
-                        if order['type'] == 'take_profit_market' and order['price'] in [tp.price for tp in
-                                                                                        trade.take_profits]:
-                            exchange.cancel_order(order['id'], trade.currency_name)
-                    for take_profit in trade.take_profits:
-                        self.db.delete(take_profit)
+                    if trade.exchange_order_id is not None:
+                        # the IDs of the legs are stored with the trade, whichever server process placed them
+                        cancel_ids = []
+                        if replace_stop_loss and trade.stop_loss_order_id:
+                            cancel_ids.append(trade.stop_loss_order_id)
+                        if new_take_profit_prices:
+                            cancel_ids += [take_profit.exchange_order_id for take_profit in trade.take_profits
+                                           if take_profit.exchange_order_id]
+                    else:
+                        cancel_ids = await self._find_untracked_bracket_orders(
+                            exchange, trade, replace_stop_loss, bool(new_take_profit_prices))
+                    # legs that were filled or cancelled in the meantime are gone already
+                    await self._cancel_orders(exchange, cancel_ids, trade.currency_name, ignore_missing=True)
                 except Exception as e:
                     raise HTTPException(status_code=500,
-                                        detail=f"Error cancelling existing Take-Profit orders: {str(e)}")
-
-                # Create new Take-Profit orders
-                for price in new_take_profit_prices:
-                    take_profit_order = exchange.create_order(
-                        symbol=trade.currency_name,
-                        type='take_profit_market',
-                        side='sell' if trade.trade_status == 'open' else 'buy',
-                        amount=trade.currency_volume / len(new_take_profit_prices),  # Aufteilen des Volumens
-                        params={'stopPrice': price, 'reduceOnly': True}
-                    )
-                    new_take_profit = TakeProfit(trade_id=trade_id, price=price)
-                    self.db.add(new_take_profit)
+                                        detail=f"Error cancelling existing Stop-Loss/Take-Profit orders: {str(e)}")
+
+            # Create the new legs concurrently
+            take_profit_results, stop_loss_result = await self._submit_bracket_orders(
+                exchange, trade, new_take_profit_prices, new_stop_loss_price if replace_stop_loss else None)
+            failed_legs = self._failed_legs(take_profit_results, stop_loss_result)
+            if failed_legs:
+                raise failed_legs[0]
+
+            if replace_stop_loss:
+                trade.stop_loss_price = new_stop_loss_price
+                trade.stop_loss_order_id = stop_loss_result.get('id')
+            if new_take_profit_prices:
+                self.db.query(TakeProfit).filter(TakeProfit.trade_id == trade_id).delete(synchronize_session=False)
+                self._insert_take_profits(trade_id, new_take_profit_prices, take_profit_results)
 
+            symbol, filled = trade.currency_name, position_store.is_filled(trade)
             self.db.commit()
-            self.db.refresh(trade)
+            if new_take_profit_prices:
+                trigger_engine.remove_trade(trade_id, TAKE_PROFIT)
+            self._watch_levels(exchange, trade_id, symbol, new_take_profit_prices, take_profit_results,
+                               new_stop_loss_price, stop_loss_result, filled, self.api_key.accountID)
 
             return {"message": "Stop-Loss and Take-Profit orders updated successfully"}
         except HTTPException as e:
@@ -566,7 +1105,42 @@ class TradeService:
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-    def update_trade_with_profit_loss(self, trade_id: int):
+    @staticmethod
+    def _record_profit_loss(trade, current_price: float):
+        """
+            Close a trade whose Take-Profit or Stop-Loss was reached and store its profit/loss.
+
+            The profit/loss that Take-Profit legs already realized on part of the volume is included.
+
+            Args:
+                trade (Trade): The trade.
+                current_price (float): The price at which the level was reached.
+
+            Raises:
+                ValueError: If the purchase rate is zero.
+
+            Returns:
+                tuple: The profit/loss amount and percentage of the whole trade.
+            """
+        entry = position_store.entry_price(trade)
+        if not entry:
+            raise ValueError("Purchase rate cannot be zero")
+
+        # Calculate profit/loss amount
+        profit_loss_amount = (current_price - entry) * trade.currency_volume + (trade.selling_rate or 0.0)
+        trade.selling_rate = profit_loss_amount
+
+        # Calculate profit/loss percentage
+        volume = trade.currency_volume + (trade.settled_volume or 0.0)
+        profit_loss_percentage = profit_loss_amount / (entry * volume) * 100
+        trade.purchase_rate = profit_loss_percentage
+
+        # Update trade status and date_sale
+        trade.trade_status = 'closed'
+        trade.date_sale = datetime.now()
+        return profit_loss_amount, profit_loss_percentage
+
+    async def update_trade_with_profit_loss(self, trade_id: int):
         """
             Update trade with profit/loss information if Take-Profit or Stop-Loss is reached.
 
@@ -588,31 +1162,20 @@ class TradeService:
             if trade.purchase_rate is None:
                 raise HTTPException(status_code=400, detail="Purchase rate not set for the trade")
 
-            exchange = self._get_exchange_instance()
-            ticker = exchange.fetch_ticker(trade.currency_name)
-            current_price = ticker['last']
+            current_price = await self._get_current_market_price(trade.currency_name, trade=trade)
 
             # Check if Take-Profit or Stop-Loss was reached
             take_profit_reached = any(tp.price <= current_price for tp in trade.take_profits)
             stop_loss_reached = trade.stop_loss_price and trade.stop_loss_price >= current_price
 
             if take_profit_reached or stop_loss_reached:
-                # Calculate profit/loss amount
-                profit_loss_amount = (current_price - trade.purchase_rate) * trade.currency_volume
-                trade.selling_rate = profit_loss_amount
-
-                # Calculate profit/loss percentage
-                if trade.purchase_rate == 0:
-                    raise ValueError("Purchase rate cannot be zero")
-                profit_loss_percentage = ((current_price - trade.purchase_rate) / trade.purchase_rate) * 100
-                trade.purchase_rate = profit_loss_percentage
-
-                # Update trade status and date_sale
-                trade.trade_status = 'closed'
-                trade.date_sale = datetime.now()
+                entry, realized = trade.purchase_rate, trade.selling_rate or 0.0
+                profit_loss_amount, profit_loss_percentage = self._record_profit_loss(trade, current_price)
+                position_store.apply(self.db, [position_store.close(trade, entry, profit_loss_amount - realized)])
 
                 self.db.commit()
                 self.db.refresh(trade)
+                trigger_engine.remove_trade(trade_id)
 
                 return {
                     "message": "Trade updated with profit/loss successfully",
@@ -626,25 +1189,279 @@ class TradeService:
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
-    def cancel_order(self, order_id: str, symbol: str):
+    async def cancel_order(self, order_id: str, symbol: str):
         """
-            Cancel an open order.
+            Cancel an open order and update its trade.
+
+            The order is given by its exchange order ID or by the ID of its trade. Cancelling the entry order removes
+            the trade; cancelling a Stop-Loss or Take-Profit leg only removes that leg from the trade.
 
             Args:
-                order_id (str): The order ID.
+                order_id (str): The exchange order ID or the trade ID.
                 symbol (str): The trading pair symbol.
 
             Raises:
-                HTTPException: If there's an error canceling the order.
+                HTTPException: If the order is not found or there's an error canceling the order.
 
             Returns:
-                dict: Success message with order details.
+                dict: Success message with order details, the trade ID and the cancelled leg.
             """
         try:
-            exchange = self._get_exchange_instance()
-            canceled_order = exchange.cancel_order(order_id, symbol)
-            return {"message": "Order canceled successfully", "order": canceled_order}
+            trade, leg, take_profit = self._find_trade_of_order(order_id)
+            exchange_order_id = {ENTRY: trade.exchange_order_id, STOP_LOSS: trade.stop_loss_order_id,
+                                 TAKE_PROFIT: take_profit.exchange_order_id if take_profit else None}[leg]
+            if exchange_order_id is None:
+                raise HTTPException(status_code=404, detail="The trade has no order on the exchange")
+            exchange = self._get_exchange_instance(trade)
+            canceled_order = await request_scheduler.call(Priority.ORDER, exchange.cancel_order, exchange_order_id,
+                                                          symbol)
+
+            trade_id = trade.trade_id
+            if leg == ENTRY:
+                if trade.date_sale is None and position_store.is_filled(trade):
+                    position_store.apply(self.db, [position_store.close(trade, position_store.entry_price(trade))])
+                # a job that still waits to place the legs of the trade would otherwise keep its key
+                job_queue.discard(self.db, self.bracket_orders_key(trade))
+                for row in trade.take_profits:
+                    self.db.delete(row)
+                self.db.delete(trade)
+            elif leg == STOP_LOSS:
+                trade.stop_loss_price = None
+                trade.stop_loss_order_id = None
+            else:
+                self.db.delete(take_profit)
+            self.db.commit()
+
+            if leg == ENTRY:
+                trigger_engine.remove_trade(trade_id)
+            elif leg == STOP_LOSS:
+                trigger_engine.remove_trade(trade_id, STOP_LOSS)
+            else:
+                trigger_engine.remove_trade(trade_id, TAKE_PROFIT, take_profit.price)
+            await balance_ledger.mark_stale(self.api_key.api_id)
+            return {"message": "Order canceled successfully", "order": canceled_order, "trade_id": trade_id,
+                    "leg": leg}
         except HTTPException as e:
             raise e
         except Exception as e:
+            self.db.rollback()
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
+
+
+def _load_triggered_trades(trade_ids):
+    """
+        Load the open, filled trades among the given IDs with their API entry and Take-Profit rows.
+
+        Args:
+            trade_ids (list): The trade IDs.
+
+        Returns:
+            list: The trades, detached from their session.
+        """
+    db = SessionLocal()
+    try:
+        return db.query(Trade).options(joinedload(Trade.api), selectinload(Trade.take_profits)).filter(
+            Trade.trade_id.in_(trade_ids), Trade.date_sale.is_(None), position_store.filled_filter()).all()
+    finally:
+        db.close()
+
+
+def _store_settlements(settlements):
+    """
+        Store settled trades in one transaction.
+
+        Every update is conditional on the trade being open with the volume it was read with, so a trade that was
+        settled or sold elsewhere in the meantime is skipped instead of being settled twice.
+
+        Args:
+            settlements (list): Tuples of (detached trade with its new values, volume it was read with, settled
+                Take-Profit rows, position deltas).
+
+        Returns:
+            set: The IDs of the stored trades.
+        """
+    db = SessionLocal()
+    try:
+        stored = set()
+        deltas = []
+        for trade, read_volume, settled_take_profits, trade_deltas in settlements:
+            updated = db.query(Trade).filter(
+                Trade.trade_id == trade.trade_id, Trade.date_sale.is_(None),
+                Trade.currency_volume == read_volume).update({
+                    'currency_volume': trade.currency_volume,
+                    'settled_volume': trade.settled_volume,
+                    'selling_rate': trade.selling_rate,
+                    'purchase_rate': trade.purchase_rate,
+                    'trade_status': trade.trade_status,
+                    'date_sale': trade.date_sale
+                }, synchronize_session=False)
+            if not updated:
+                continue
+            if settled_take_profits:
+                db.query(TakeProfit).filter(TakeProfit.takeprofit_id.in_(
+                    [take_profit.takeprofit_id for take_profit in settled_take_profits])).delete(
+                    synchronize_session=False)
+            deltas.extend(trade_deltas)
+            stored.add(trade.trade_id)
+        position_store.apply(db, deltas)
+        db.commit()
+        return stored
+    finally:
+        db.close()
+
+
+async def settle_triggered_trades(triggered: dict):
+    """
+        Settle the Take-Profit and Stop-Loss levels the trigger engine reported.
+
+        A Take-Profit level that leaves other Take-Profit legs open sells only its share of the trade: the share is
+        booked as realized profit/loss and the trade stays open with the rest of its volume. A Stop-Loss or the last
+        Take-Profit level closes the trade, after its remaining bracket orders were cancelled on the exchange; if they
+        cannot be cancelled, the trade stays open and its level is watched again. Trades that are already sold or
+        not filled are skipped.
+
+        Args:
+            triggered (dict): Lists of (kind, level, price) by trade ID.
+        """
+    trades = await asyncio.to_thread(_load_triggered_trades, list(triggered))
+    settlements = []
+    closed = {}
+    for trade in trades:
+        entry = position_store.entry_price(trade)
+        if not entry:
+            continue
+        exchange = exchange_pool.get(trade.api)
+        read_volume = trade.currency_volume
+        take_profits = list(trade.take_profits)
+        settled_take_profits, deltas = [], []
+        for kind, level, price in triggered[trade.trade_id]:
+            take_profit = None
+            if kind == TAKE_PROFIT:
+                take_profit = next((row for row in take_profits if row.price == level), None)
+                if take_profit is None:
+                    # replaced since the level was added
+                    continue
+                if len(take_profits) > 1:
+                    share = trade.currency_volume / len(take_profits)
+                    realized = (price - entry) * share
+                    deltas.append(position_store.reduce(trade, share, entry, realized))
+                    trade.currency_volume -= share
+                    trade.settled_volume = (trade.settled_volume or 0.0) + share
+                    trade.selling_rate = (trade.selling_rate or 0.0) + realized
+                    take_profits.remove(take_profit)
+                    settled_take_profits.append(take_profit)
+                    continue
+
+            filled_order_id = take_profit.exchange_order_id if take_profit is not None else trade.stop_loss_order_id
+            cancel_ids = [order_id for order_id in [row.exchange_order_id for row in take_profits]
+                          + [trade.stop_loss_order_id] if order_id and order_id != filled_order_id]
+            try:
+                await TradeService._cancel_orders(exchange, cancel_ids, trade.currency_name, ignore_missing=True)
+            except Exception as e:
+                logger.warning(f"Trade {trade.trade_id} stays open, its bracket orders could not be cancelled: "
+                               f"{str(e)}")
+                trigger_engine.add(trade.trade_id, exchange.id, trade.currency_name, kind, level, exchange,
+                                   trade.api.accountID)
+                break
+            realized = trade.selling_rate or 0.0
+            profit_loss_amount, _ = TradeService._record_profit_loss(trade, price)
+            deltas.append(position_store.close(trade, entry, profit_loss_amount - realized))
+            closed[trade.trade_id] = trade
+            break
+        if deltas:
+            settlements.append((trade, read_volume, settled_take_profits, deltas))
+
+    stored = await asyncio.to_thread(_store_settlements, settlements)
+    for trade, _, _, _ in settlements:
+        if trade.trade_id in stored:
+            await balance_ledger.mark_stale(trade.api_id)
+        if trade.trade_id in closed:
+            trigger_engine.remove_trade(trade.trade_id)
+
+
+def _load_bracket_trade(trade_id: int, entry_order_id: str = None):
+    """
+        Load an open trade with its API entry and Take-Profit rows.
+
+        Args:
+            trade_id (int): The trade ID.
+            entry_order_id (str, optional): The exchange order ID of the entry; a trade that reuses the ID of a
+                deleted one does not match it.
+
+        Returns:
+            Trade: The trade, detached from its session, or None if it was sold or removed.
+        """
+    db = SessionLocal()
+    try:
+        query = db.query(Trade).options(joinedload(Trade.api), selectinload(Trade.take_profits)).filter(
+            Trade.trade_id == trade_id, Trade.date_sale.is_(None))
+        if entry_order_id is not None:
+            query = query.filter(Trade.exchange_order_id == entry_order_id)
+        return query.first()
+    finally:
+        db.close()
+
+
+def _store_bracket_orders(trade_id, take_profit_prices, take_profit_results, stop_loss_price, stop_loss_result):
+    """
+        Store the accepted bracket legs of a trade in one transaction.
+
+        Args:
+            trade_id (int): The trade ID.
+            take_profit_prices (list): List of Take-Profit prices.
+            take_profit_results (list): The submission result of each price.
+            stop_loss_price (float): The Stop-Loss price, or None.
+            stop_loss_result: The submission result of the Stop-Loss leg, or None.
+        """
+    db = SessionLocal()
+    try:
+        rows = [{'trade_id': trade_id, 'price': price, 'exchange_order_id': result.get('id')}
+                for price, result in zip(take_profit_prices, take_profit_results)
+                if not isinstance(result, Exception)]
+        if rows:
+            db.bulk_insert_mappings(TakeProfit, rows)
+        if stop_loss_result is not None and not isinstance(stop_loss_result, Exception):
+            db.query(Trade).filter(Trade.trade_id == trade_id).update({
+                'stop_loss_price': stop_loss_price,
+                'stop_loss_order_id': stop_loss_result.get('id')
+            }, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+@job_queue.handler("place_bracket_orders")
+async def place_bracket_orders(payload: dict):
+    """
+        Job queue handler that places the Take-Profit and Stop-Loss legs of a new trade.
+
+        Legs that were placed by an earlier attempt are skipped, so a retry only submits the missing ones. Trades that
+        were sold or removed in the meantime are left alone. The database is read and written in a thread.
+
+        Args:
+            payload (dict): The 'trade_id', the 'entry_order_id', 'take_profit_prices' and 'stop_loss_price'.
+
+        Raises:
+            Exception: The error of the first failed leg, after the accepted legs have been stored.
+        """
+    trade = await asyncio.to_thread(_load_bracket_trade, payload["trade_id"], payload.get("entry_order_id"))
+    if trade is None:
+        return
+    placed = {take_profit.price for take_profit in trade.take_profits}
+    take_profit_prices = [price for price in payload["take_profit_prices"] if price not in placed]
+    stop_loss_price = payload["stop_loss_price"] if trade.stop_loss_order_id is None else None
+    if not take_profit_prices and not stop_loss_price:
+        return
+
+    exchange = exchange_pool.get(trade.api)
+    take_profit_results, stop_loss_result = await TradeService._submit_bracket_orders(
+        exchange, trade, take_profit_prices, stop_loss_price, len(payload["take_profit_prices"]))
+
+    await asyncio.to_thread(_store_bracket_orders, trade.trade_id, take_profit_prices, take_profit_results,
+                            stop_loss_price, stop_loss_result)
+    TradeService._watch_levels(exchange, trade.trade_id, trade.currency_name, take_profit_prices, take_profit_results,
+                               stop_loss_price, stop_loss_result, position_store.is_filled(trade), trade.api.accountID)
+
+    failed_legs = TradeService._failed_legs(take_profit_results, stop_loss_result)
+    if failed_legs:
+        raise failed_legs[0]
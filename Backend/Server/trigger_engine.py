@@ -0,0 +1,392 @@
+"""
+Trigger Engine
+
+This module watches the take-profit and stop-loss levels of all open trades in memory. The levels of every
+(exchange, symbol) pair are kept in a trigger book made of two heaps: take-profit levels fire once the price rises to
+them, stop levels once the price falls to them. Every ticker that passes through the ticker cache is offered to the
+book of its pair, which pops exactly the levels that price has crossed, so the cost of a price update does not depend
+on the number of watched trades. Only trades whose entry order was filled are watched; a limit trade is added once its
+order fills. A trade stays watched until it is settled: a take-profit level that fires leaves the other levels of its
+trade in place. Triggered levels are handed to a settlement callback in batches.
+
+Every server process only watches the levels and settles the trades of the accounts whose lease bucket it holds (see
+lease_coordinator). It rebuilds its books from the database every TRIGGER_RELOAD_SECONDS and whenever its buckets
+change, so trades opened by other processes are picked up; a process that holds no bucket keeps no books.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from sqlalchemy.orm import joinedload, selectinload
+from database import SessionLocal
+from models import Trade
+from exchange_pool import exchange_pool
+from ticker_cache import ticker_cache
+from price_service import price_service
+from request_scheduler import Priority
+from positions import position_store
+import logging
+
+logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
+logger = logging.getLogger(__name__)
+
+TRIGGER_POLL_SECONDS = float(os.getenv("TRIGGER_POLL_SECONDS", "2"))
+TRIGGER_RELOAD_SECONDS = float(os.getenv("TRIGGER_RELOAD_SECONDS", "30"))
+
+ENTRY = 'entry'
+STOP_LOSS = 'stop_loss'
+TAKE_PROFIT = 'take_profit'
+
+
+class TriggerBook:
+    """
+        The take-profit and stop levels of one (exchange, symbol) pair.
+
+        Removed levels stay in their heap, marked as dead, until they reach the top; insert, remove and pop are
+        therefore O(log n).
+        """
+
+    def __init__(self):
+        """
+                Initializes an empty TriggerBook.
+                """
+        self._take_profits = []
+        self._stops = []
+        self._sequence = itertools.count()
+        self.live = 0
+
+    def add(self, trade_id: int, kind: str, level: float):
+        """
+                Adds a level.
+
+                Args:
+                    trade_id (int): The trade the level belongs to.
+                    kind (str): TAKE_PROFIT or STOP_LOSS.
+                    level (float): The trigger price.
+
+                Returns:
+                    list: The heap entry, used to remove the level again.
+                """
+        if kind == TAKE_PROFIT:
+            entry = [level, next(self._sequence), trade_id, kind, True]
+            heapq.heappush(self._take_profits, entry)
+        else:
+            # stored negated, so the highest stop is on top of the min-heap
+            entry = [-level, next(self._sequence), trade_id, kind, True]
+            heapq.heappush(self._stops, entry)
+        self.live += 1
+        return entry
+
+    def remove(self, entry):
+        """
+                Marks a level as removed.
+
+                Args:
+                    entry (list): The entry returned by `add`.
+                """
+        if entry[4]:
+            entry[4] = False
+            self.live -= 1
+            if len(self._take_profits) + len(self._stops) > 2 * self.live + 64:
+                self._compact()
+
+    def _compact(self):
+        """
+                Drops removed levels that are not on top of their heap yet.
+                """
+        self._take_profits = [entry for entry in self._take_profits if entry[4]]
+        self._stops = [entry for entry in self._stops if entry[4]]
+        heapq.heapify(self._take_profits)
+        heapq.heapify(self._stops)
+
+    def update(self, price: float):
+        """
+                Pops all levels the price has reached.
+
+                Args:
+                    price (float): The new price.
+
+                Returns:
+                    list: Tuples of (trade ID, kind, level) of the triggered levels.
+                """
+        triggered = []
+        while self._take_profits and self._take_profits[0][0] <= price:
+            entry = heapq.heappop(self._take_profits)
+            if entry[4]:
+                entry[4] = False
+                self.live -= 1
+                triggered.append((entry[2], entry[3], entry[0]))
+        while self._stops and -self._stops[0][0] >= price:
+            entry = heapq.heappop(self._stops)
+            if entry[4]:
+                entry[4] = False
+                self.live -= 1
+                triggered.append((entry[2], entry[3], -entry[0]))
+        return triggered
+
+
+class TriggerEngine:
+    """
+        Trigger books of all watched pairs and the levels registered per trade.
+
+        Attributes:
+            poll_seconds (float): Interval at which the prices of all watched pairs are refreshed.
+            reload_seconds (float): Interval at which the books are rebuilt from the database while running.
+            active (bool): Whether this process watches levels; levels added while it does not are ignored.
+            triggered (int): Number of levels that fired.
+        """
+
+    def __init__(self, poll_seconds: float = TRIGGER_POLL_SECONDS, reload_seconds: float = TRIGGER_RELOAD_SECONDS,
+                 session_factory=SessionLocal, clock=time.monotonic):
+        """
+                Initializes an empty TriggerEngine.
+
+                Args:
+                    poll_seconds (float): Interval at which the prices of all watched pairs are refreshed.
+                    reload_seconds (float): Interval at which the books are rebuilt from the database while running.
+                    session_factory (callable): Creates the database sessions that load the trades.
+                    clock (callable): Monotonic time source.
+                """
+        self.poll_seconds = poll_seconds
+        self.reload_seconds = reload_seconds
+        self.session_factory = session_factory
+        self.clock = clock
+        self.active = True
+        self._owns_account = None
+        self.triggered = 0
+        self._books = {}
+        self._by_trade = {}
+        self._clients = {}
+        self._pending = {}
+        self._wake = None
+
+    def add(self, trade_id: int, exchange_id: str, symbol: str, kind: str, level: float, exchange=None,
+            account_id: int = None):
+        """
+                Watches a take-profit or stop level of a trade.
+
+                Args:
+                    trade_id (int): The trade ID.
+                    exchange_id (str): The ccxt ID of the exchange.
+                    symbol (str): The trading pair symbol.
+                    kind (str): TAKE_PROFIT or STOP_LOSS.
+                    level (float): The trigger price.
+                    exchange (ccxt.async_support.Exchange, optional): A client used to refresh the pair's price.
+                    account_id (int, optional): The account of the trade; levels of accounts this process does not
+                        own are ignored.
+                """
+        if level is None or not self.active:
+            return
+        if account_id is not None and self._owns_account is not None and not self._owns_account(account_id):
+            return
+        key = (exchange_id, symbol)
+        book = self._books.get(key)
+        if book is None:
+            book = self._books[key] = TriggerBook()
+        self._by_trade.setdefault(trade_id, []).append((key, book.add(trade_id, kind, level)))
+        if exchange is not None:
+            self._clients[exchange_id] = exchange
+
+    def remove_trade(self, trade_id: int, kind: str = None, level: float = None):
+        """
+                Stops watching the levels of a trade.
+
+                Args:
+                    trade_id (int): The trade ID.
+                    kind (str, optional): Only remove levels of this kind.
+                    level (float, optional): Only remove the level at this price.
+                """
+        kept = []
+        for key, entry in self._by_trade.pop(trade_id, []):
+            # stop levels are stored negated
+            entry_level = entry[0] if entry[3] == TAKE_PROFIT else -entry[0]
+            if (kind is not None and entry[3] != kind) or (level is not None and entry_level != level):
+                kept.append((key, entry))
+                continue
+            book = self._books.get(key)
+            if book is not None:
+                book.remove(entry)
+                if not book.live:
+                    del self._books[key]
+        if kept:
+            self._by_trade[trade_id] = kept
+
+    def on_ticker(self, exchange_id: str, symbol: str, ticker: dict):
+        """
+                Checks a new ticker against the book of its pair; registered as ticker cache listener.
+
+                Args:
+                    exchange_id (str): The ccxt ID of the exchange.
+                    symbol (str): The trading pair symbol.
+                    ticker (dict): The ticker.
+                """
+        book = self._books.get((exchange_id, symbol))
+        price = ticker.get('last')
+        if book is None or price is None:
+            return
+        for trade_id, kind, level in book.update(price):
+            self.triggered += 1
+            self._pending.setdefault(trade_id, []).append((kind, level, price))
+            levels = [(key, entry) for key, entry in self._by_trade.get(trade_id, ()) if entry[4]]
+            if levels:
+                self._by_trade[trade_id] = levels
+            else:
+                self._by_trade.pop(trade_id, None)
+        if not book.live:
+            self._books.pop((exchange_id, symbol), None)
+        if self._pending and self._wake is not None:
+            self._wake.set()
+
+    def watch(self, trade, exchange):
+        """
+                Watches all take-profit and stop levels of a trade whose entry order was filled.
+
+                Args:
+                    trade (Trade): The trade, with its take profits loaded.
+                    exchange (ccxt.async_support.Exchange): The client of the trade's API.
+                """
+        if not position_store.is_filled(trade):
+            return
+        account_id = trade.api.accountID
+        for take_profit in trade.take_profits:
+            self.add(trade.trade_id, exchange.id, trade.currency_name, TAKE_PROFIT, take_profit.price, exchange,
+                     account_id)
+        self.add(trade.trade_id, exchange.id, trade.currency_name, STOP_LOSS, trade.stop_loss_price, exchange,
+                 account_id)
+
+    @staticmethod
+    def _watched_trades(db, accounts=None):
+        """
+                Loads the open, filled trades that have a take-profit or stop level.
+
+                Args:
+                    db (Session): Database session.
+                    accounts (optional): Only load the trades whose API entry matches this filter.
+                """
+        query = db.query(Trade).options(joinedload(Trade.api), selectinload(Trade.take_profits)).filter(
+            Trade.date_sale.is_(None), position_store.filled_filter(),
+            Trade.stop_loss_price.isnot(None) | Trade.take_profits.any())
+        if accounts is not None:
+            query = query.filter(Trade.api.has(accounts))
+        return query.all()
+
+    def _load_detached(self, accounts=None):
+        """
+                Loads the watched trades in a new session; blocking, runs in a worker thread.
+                """
+        db = self.session_factory()
+        try:
+            return self._watched_trades(db, accounts)
+        finally:
+            db.close()
+
+    def clear(self):
+        """
+                Forgets all books and triggered levels.
+                """
+        self._books.clear()
+        self._by_trade.clear()
+        self._pending.clear()
+
+    def _rebuild(self, trades):
+        self._books.clear()
+        self._by_trade.clear()
+        for trade in trades:
+            self.watch(trade, exchange_pool.get(trade.api))
+
+    def load(self, db):
+        """
+                Rebuilds all trigger books from the open, filled trades in the database.
+
+                Args:
+                    db (Session): Database session.
+                """
+        self._rebuild(self._watched_trades(db))
+
+    def take_triggered(self):
+        """
+                Returns the levels that fired since the last call and forgets them.
+
+                Returns:
+                    dict: Lists of (kind, level, price) by trade ID.
+                """
+        pending, self._pending = self._pending, {}
+        return pending
+
+    async def refresh_prices(self):
+        """
+                Refreshes the prices of all watched pairs with one batched request per exchange.
+
+                The prices reach the books through the ticker cache listener.
+                """
+        pairs = [(self._clients[exchange_id], symbol) for exchange_id, symbol in self._books
+                 if exchange_id in self._clients]
+        if pairs:
+            await price_service.get_prices_for_pairs(pairs, Priority.POLLING)
+
+    async def run(self, settle, leases=None):
+        """
+                Refreshes prices and settles triggered trades until cancelled.
+
+                Args:
+                    settle (callable): Coroutine function called with a dict of trade ID to a list of the
+                        (kind, level, price) tuples of its triggered levels.
+                    leases (LeaseCoordinator, optional): Only the trades of the accounts whose lease bucket this process
+                        holds are watched, and no books are kept while it holds none; all accounts by default.
+                """
+        self._wake = asyncio.Event()
+        ticker_cache.add_listener(self.on_ticker)
+        if leases is not None:
+            self._owns_account = leases.owns_account
+        loaded_at = None
+        loaded_buckets = None
+        while True:
+            timed_out = False
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_seconds)
+            except asyncio.TimeoutError:
+                timed_out = True
+            self._wake.clear()
+            buckets = leases.owned_buckets() if leases is not None else None
+            self.active = leases is None or bool(buckets)
+            if not self.active:
+                self.clear()
+                loaded_at = None
+                continue
+            if loaded_at is None or buckets != loaded_buckets or self.clock() - loaded_at >= self.reload_seconds:
+                try:
+                    self._rebuild(await asyncio.to_thread(
+                        self._load_detached, leases.accounts_filter() if leases is not None else None))
+                    loaded_at = self.clock()
+                    loaded_buckets = buckets
+                except Exception as e:
+                    logger.warning(f"Error loading trigger levels: {str(e)}")
+            if timed_out:
+                try:
+                    await self.refresh_prices()
+                except Exception as e:
+                    logger.warning(f"Error refreshing trigger prices: {str(e)}")
+            pending = self.take_triggered()
+            if pending:
+                try:
+                    await settle(pending)
+                except Exception as e:
+                    logger.warning(f"Error settling triggered trades {list(pending)}: {str(e)}")
+
+    def stats(self):
+        """
+                Returns the size of the engine.
+
+                Returns:
+                    dict: Number of watched pairs, watched trades, live levels and fired levels.
+                """
+        return {
+            "books": len(self._books),
+            "trades": len(self._by_trade),
+            "levels": sum(book.live for book in self._books.values()),
+            "triggered": self.triggered
+        }
+
+
+trigger_engine = TriggerEngine()
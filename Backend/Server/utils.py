@@ -339,6 +339,7 @@ def get_api_credentials(account_id: int, exchange_name: str, db: Session):
 
         Returns:
             dict: A dictionary containing API credentials:
+                - "api_id" (int): The ID of the stored API entry.
                 - "api_key" (str): The API key for the specified exchange and account.
                 - "secret" (str): The secret key for the specified exchange and account.
                 - "passphrase" (str, optional): The passphrase for the specified exchange and account, if available.
@@ -346,12 +347,32 @@ def get_api_credentials(account_id: int, exchange_name: str, db: Session):
         Raises:
             ValueError: If no API credentials are found for the specified account and exchange.
         """
+    api_data = get_api_entry(account_id, exchange_name, db)
+    return {
+        "api_id": api_data.api_id,
+        "api_key": api_data.key,
+        "secret": api_data.secret_Key,
+        "passphrase": api_data.passphrase
+    }
+
+
+def get_api_entry(account_id: int, exchange_name: str, db: Session):
+    """
+        Retrieves the stored API entry for a specific account and exchange from the database.
+
+        Args:
+            account_id (int): The ID of the account for which the API entry is requested.
+            exchange_name (str): The name of the cryptocurrency exchange.
+            db (Session): The SQLAlchemy database session.
+
+        Returns:
+            Api: The API entry of the account for the exchange.
+
+        Raises:
+            ValueError: If no API entry is found for the specified account and exchange.
+        """
     api_data = db.query(Api).filter(Api.accountID == account_id, Api.exchange_name == exchange_name).first()
     if api_data:
-        return {
-            "api_key": api_data.key,
-            "secret": api_data.secret_Key,
-            "passphrase": api_data.passphrase
-        }
+        return api_data
     else:
         raise ValueError(f"No API credentials found for user {account_id} and exchange {exchange_name}")
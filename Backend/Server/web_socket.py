@@ -1,64 +1,610 @@
-from typing import List
-from database import get_db
-from sqlalchemy.orm import Session
-from fastapi import WebSocket, Depends, WebSocketDisconnect
+"""
+WebSocket
+
+This module serves live ticker data over websockets. Clients subscribe to topics, i.e. (exchange, symbol) pairs; the
+connection manager runs one publisher task per topic with subscribers, which fetches the ticker once per interval
+through the ticker cache and fans it out to every subscriber, so the upstream cost follows the number of distinct
+symbols instead of the number of sockets. A topic is torn down when its last subscriber leaves. Messages without an
+action are answered once with the current ticker, as before.
+
+Nothing on this path blocks the event loop: exchanges are called through the asynchronous pooled clients, the API
+entries of users are loaded in a worker thread and cached, and every request is bounded by a timeout. Messages are not
+sent inline either: every connection has a bounded outbox drained by its own writer task. Tickers of a topic that are
+still waiting in an outbox are replaced by newer ones, so a slow client only receives the latest price, and a client
+that makes no progress for WEBSOCKET_SLOW_SECONDS is disconnected.
+
+Connections are authenticated before they are accepted: the client passes its access token in the 'token' query
+parameter or as Bearer token in the Authorization header, and the account of the connection is the one in the
+verified token.
+
+Clients that request the 'msgpack' subprotocol on connect receive binary MessagePack frames instead of JSON: a
+snapshot of the compacted ticker when they subscribe to a topic and afterwards only the fields that changed. Requests
+are JSON text on both protocols.
+"""
+import asyncio
+import itertools
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple
+from database import SessionLocal
+from fastapi import WebSocket, WebSocketDisconnect, status
 import json
-import ccxt
-from utils import get_api_credentials
+import msgpack
+from utils import get_api_entry, verify_trade_token
+from exchange_pool import exchange_pool
+from ticker_cache import ticker_cache
+from request_scheduler import Priority
 import logging
 
 logging.basicConfig(filename='debugAll.log', level=logging.WARNING, format='%(asctime)s %(levelname)s:%(message)s')
 logger = logging.getLogger(__name__)
 
+WEBSOCKET_TICKER_SECONDS = float(os.getenv("WEBSOCKET_TICKER_SECONDS", "2"))
+WEBSOCKET_MESSAGE_TIMEOUT_SECONDS = float(os.getenv("WEBSOCKET_MESSAGE_TIMEOUT_SECONDS", "5"))
+WEBSOCKET_CREDENTIAL_SECONDS = float(os.getenv("WEBSOCKET_CREDENTIAL_SECONDS", "60"))
+WEBSOCKET_QUEUE_SIZE = int(os.getenv("WEBSOCKET_QUEUE_SIZE", "64"))
+WEBSOCKET_SLOW_SECONDS = float(os.getenv("WEBSOCKET_SLOW_SECONDS", "30"))
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+# not sent on the compact protocol: the raw exchange response and fields the client knows or can derive
+COMPACT_SKIPPED_FIELDS = ('info', 'symbol', 'datetime')
+
+QUEUED = 'queued'
+CONFLATED = 'conflated'
+DROPPED = 'dropped'
+
+
+def compact_ticker(ticker: dict):
+    """
+        Returns the fields of a ticker that are sent on the compact protocol.
+
+        Empty fields are left out and integral floats become integers, which MessagePack encodes in fewer bytes.
+
+        Args:
+            ticker (dict): The ccxt ticker.
+
+        Returns:
+            dict: The compacted fields.
+        """
+    fields = {}
+    for key, value in ticker.items():
+        if key in COMPACT_SKIPPED_FIELDS or value is None:
+            continue
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        fields[key] = value
+    return fields
+
+
+def ticker_delta(previous: dict, current: dict):
+    """
+        Returns the fields of a compacted ticker that changed; fields that disappeared are None.
+        """
+    delta = {key: value for key, value in current.items() if previous.get(key) != value}
+    delta.update((key, None) for key in previous if key not in current)
+    return delta
+
+
+class Outbox:
+    """
+        The bounded queue of outgoing messages of one connection.
+
+        Messages with a key replace a pending message of the same key in place; other messages are appended. When
+        the outbox is full, new messages are dropped.
+
+        Attributes:
+            websocket (WebSocket): The connection the messages are written to.
+            max_messages (int): Maximum number of pending messages.
+            last_progress (float): Time of the last completed send, or when the outbox last became non-empty.
+        """
+
+    def __init__(self, websocket: WebSocket, max_messages: int = WEBSOCKET_QUEUE_SIZE, clock=time.monotonic):
+        """
+                Initializes an empty Outbox.
+
+                Args:
+                    websocket (WebSocket): The connection the messages are written to.
+                    max_messages (int): Maximum number of pending messages.
+                    clock (callable): Monotonic time source.
+                """
+        self.websocket = websocket
+        self.max_messages = max_messages
+        self.clock = clock
+        self.last_progress = clock()
+        self.task = None
+        self._pending = OrderedDict()
+        self._sequence = itertools.count()
+        self._ready = asyncio.Event()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def put(self, message, key=None, replacement=None):
+        """
+                Adds a message without waiting.
+
+                Args:
+                    message (str or bytes): The serialized message; bytes are sent as binary frame.
+                    key (hashable, optional): Messages of the same key are conflated, e.g. the topic of a ticker.
+                    replacement (str or bytes, optional): Replaces a pending message of the same key instead of
+                        `message`, e.g. a snapshot instead of a delta that does not apply to the pending one.
+
+                Returns:
+                    str: QUEUED, CONFLATED or DROPPED.
+                """
+        if key is not None and key in self._pending:
+            self._pending[key] = message if replacement is None else replacement
+            return CONFLATED
+        if len(self._pending) >= self.max_messages:
+            return DROPPED
+        if not self._pending:
+            self.last_progress = self.clock()
+        self._pending[key if key is not None else next(self._sequence)] = message
+        self._ready.set()
+        return QUEUED
+
+    def behind(self, seconds: float):
+        """
+                Returns whether messages have been waiting without any send completing for longer than `seconds`.
+                """
+        return bool(self._pending) and self.clock() - self.last_progress > seconds
+
+    async def run(self):
+        """
+                Writes the pending messages in order until cancelled.
+                """
+        while True:
+            await self._ready.wait()
+            while self._pending:
+                _, message = self._pending.popitem(last=False)
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                else:
+                    await self.websocket.send_text(message)
+                self.last_progress = self.clock()
+            self._ready.clear()
+
 
 class ConnectionManager:
     """
-        Manages WebSocket connections.
+        Manages WebSocket connections and their topic subscriptions.
 
         Attributes:
             active_connections (List[WebSocket]): List to store active WebSocket connections.
+            topics (Dict[Tuple[str, str], Set[WebSocket]]): Subscribers by (exchange ID, symbol).
+            publish_seconds (float): Seconds between two tickers of a topic.
+            queue_size (int): Maximum number of pending messages per connection.
+            slow_seconds (float): Seconds a connection may make no progress before it is disconnected.
         """
 
-    def __init__(self):
+    def __init__(self, publish_seconds: float = WEBSOCKET_TICKER_SECONDS, queue_size: int = WEBSOCKET_QUEUE_SIZE,
+                 slow_seconds: float = WEBSOCKET_SLOW_SECONDS):
         """
                 Initializes a ConnectionManager object.
+
+                Args:
+                    publish_seconds (float): Seconds between two tickers of a topic.
+                    queue_size (int): Maximum number of pending messages per connection.
+                    slow_seconds (float): Seconds a connection may make no progress before it is disconnected.
                 """
         self.active_connections: List[WebSocket] = []
+        self.topics: Dict[Tuple[str, str], Set[WebSocket]] = {}
+        self.publish_seconds = publish_seconds
+        self.queue_size = queue_size
+        self.slow_seconds = slow_seconds
+        self.published = 0
+        self.conflated = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+        self._outboxes: Dict[WebSocket, Outbox] = {}
+        self._protocols: Dict[WebSocket, str] = {}
+        self._accounts: Dict[WebSocket, int] = {}
+        self._subscriptions: Dict[WebSocket, Set[Tuple[str, str]]] = {}
+        self._publishers: Dict[Tuple[str, str], asyncio.Task] = {}
+        # the last compacted ticker of each topic and the compact subscribers that hold it
+        self._tickers: Dict[Tuple[str, str], dict] = {}
+        self._synced: Dict[Tuple[str, str], Set[WebSocket]] = {}
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, account_id: int = None):
         """
                Accepts a WebSocket connection and adds it to the active connections list.
 
+               The connection uses the compact protocol if the client requested the 'msgpack' subprotocol.
+
                Args:
                    websocket (WebSocket): WebSocket connection object to accept.
+                   account_id (int, optional): The account the connection belongs to.
                """
-        await websocket.accept()
+        protocol = MSGPACK if MSGPACK in websocket.scope.get('subprotocols', ()) else JSON
+        await websocket.accept(subprotocol=MSGPACK if protocol == MSGPACK else None)
+        self._protocols[websocket] = protocol
         self.active_connections.append(websocket)
+        self._accounts[websocket] = account_id
+        self._subscriptions[websocket] = set()
+        outbox = Outbox(websocket, self.queue_size)
+        outbox.task = asyncio.create_task(self._write(outbox))
+        self._outboxes[websocket] = outbox
 
     def disconnect(self, websocket: WebSocket):
         """
-                Disconnects a WebSocket connection and removes it from the active connections list.
+                Disconnects a WebSocket connection, removes it from the active connections list and ends its
+                subscriptions.
 
                 Args:
                     websocket (WebSocket): WebSocket connection object to disconnect.
                 """
-        self.active_connections.remove(websocket)
+        for topic in list(self._subscriptions.pop(websocket, ())):
+            self._leave(websocket, topic)
+        self._accounts.pop(websocket, None)
+        self._protocols.pop(websocket, None)
+        outbox = self._outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.task.cancel()
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
+
+    async def _write(self, outbox: Outbox):
+        """
+                Runs the writer of a connection and disconnects the connection when a send fails.
+                """
+        try:
+            await outbox.run()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Dropping websocket after failed send: {str(e)}")
+            self.disconnect(outbox.websocket)
+
+    @staticmethod
+    async def _close(websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception as e:
+            logger.warning(f"Error closing slow websocket: {str(e)}")
+
+    def _enqueue(self, websocket: WebSocket, message, key=None, replacement=None):
+        """
+                Adds a message to the outbox of a connection and disconnects the connection if it stays behind.
+
+                Returns:
+                    str: QUEUED, CONFLATED or DROPPED.
+                """
+        outbox = self._outboxes.get(websocket)
+        if outbox is None:
+            return DROPPED
+        result = outbox.put(message, key, replacement)
+        if result == CONFLATED:
+            self.conflated += 1
+        elif result == DROPPED:
+            self.dropped += 1
+        if outbox.behind(self.slow_seconds):
+            self.slow_disconnects += 1
+            logger.warning(f"Disconnecting websocket that made no progress for {self.slow_seconds}s")
+            self.disconnect(websocket)
+            asyncio.create_task(self._close(websocket))
+        return result
+
+    def _encode(self, websocket: WebSocket, payload: dict):
+        """
+                Serializes a message in the protocol of a connection.
+                """
+        if self._protocols.get(websocket) == MSGPACK:
+            return msgpack.packb(payload)
+        return json.dumps(payload)
+
+    def subscribe(self, websocket: WebSocket, api, symbol: str):
+        """
+                Subscribes a connection to the tickers of a symbol and starts the publisher of a new topic.
+
+                A compact subscriber of a running topic receives the snapshot of the last ticker at once.
+
+                Args:
+                    websocket (WebSocket): The subscribing connection.
+                    api (Api): The API entry whose pooled client fetches the tickers of a new topic.
+                    symbol (str): The trading pair symbol.
+
+                Returns:
+                    tuple: The topic as (exchange ID, symbol).
+                """
+        topic = (exchange_pool.get(api).id, symbol)
+        subscribers = self.topics.setdefault(topic, set())
+        subscribers.add(websocket)
+        self._subscriptions.setdefault(websocket, set()).add(topic)
+        if topic not in self._publishers:
+            self._publishers[topic] = asyncio.create_task(self._publish(topic, api))
+        elif self._protocols.get(websocket) == MSGPACK and topic in self._tickers:
+            snapshot = msgpack.packb({"t": "snapshot", "e": topic[0], "s": symbol, "d": self._tickers[topic]})
+            if self._enqueue(websocket, snapshot, topic) != DROPPED:
+                self._synced.setdefault(topic, set()).add(websocket)
+        return topic
+
+    def join(self, websocket: WebSocket, topic: tuple):
+        """
+                Adds a connection to a topic that is published by another component, without a ticker publisher.
+
+                Args:
+                    websocket (WebSocket): The subscribing connection.
+                    topic (tuple): The topic, e.g. ("pnl", account ID).
+                """
+        self.topics.setdefault(topic, set()).add(websocket)
+        self._subscriptions.setdefault(websocket, set()).add(topic)
+
+    def publish(self, topic: tuple, payload: dict, key=None):
+        """
+                Adds a message to the outboxes of the subscribers of a topic, serialized once per protocol.
+
+                Args:
+                    topic (tuple): The topic.
+                    payload (dict): Message to send.
+                    key (hashable, optional): Conflation key of the message.
+                """
+        encoded = {}
+        for websocket in list(self.topics.get(topic, ())):
+            protocol = self._protocols.get(websocket)
+            if protocol not in encoded:
+                encoded[protocol] = self._encode(websocket, payload)
+            self._enqueue(websocket, encoded[protocol], key)
+
+    def unsubscribe(self, websocket: WebSocket, topic: Tuple[str, str]):
+        """
+                Ends the subscription of a connection to a topic.
+
+                Args:
+                    websocket (WebSocket): The subscribed connection.
+                    topic (tuple): The topic as (exchange ID, symbol).
+                """
+        self._subscriptions.get(websocket, set()).discard(topic)
+        self._leave(websocket, topic)
+
+    def _leave(self, websocket: WebSocket, topic: Tuple[str, str]):
+        """
+                Removes a subscriber from a topic and tears the topic down when it was the last one.
+                """
+        subscribers = self.topics.get(topic)
+        if subscribers is None:
+            return
+        subscribers.discard(websocket)
+        self._synced.get(topic, set()).discard(websocket)
+        if not subscribers:
+            del self.topics[topic]
+            self._tickers.pop(topic, None)
+            self._synced.pop(topic, None)
+            publisher = self._publishers.pop(topic, None)
+            if publisher is not None:
+                publisher.cancel()
+
+    async def _publish(self, topic: Tuple[str, str], api):
+        """
+                Fetches the ticker of a topic once per interval and sends it to all subscribers until cancelled.
+
+                Args:
+                    topic (tuple): The topic as (exchange ID, symbol).
+                    api (Api): The API entry whose pooled client fetches the tickers.
+                """
+        exchange_id, symbol = topic
+        while topic in self.topics:
+            try:
+                ticker = await asyncio.wait_for(ticker_cache.get(exchange_pool.get(api), symbol, Priority.DASHBOARD),
+                                                WEBSOCKET_MESSAGE_TIMEOUT_SECONDS)
+                self._publish_ticker(topic, ticker)
+            except asyncio.TimeoutError:
+                self._publish_error(topic, f"No ticker within {WEBSOCKET_MESSAGE_TIMEOUT_SECONDS} seconds")
+            except Exception as e:
+                self._publish_error(topic, str(e))
+            self.published += 1
+            await asyncio.sleep(self.publish_seconds)
+
+    def _publish_ticker(self, topic: Tuple[str, str], ticker: dict):
+        """
+                Adds a ticker to the outboxes of the subscribers of a topic.
+
+                JSON subscribers get the whole ticker. Compact subscribers get a snapshot first and deltas afterwards;
+                a delta that would be conflated with a pending frame is replaced by a snapshot, and a subscriber whose
+                delta was dropped gets a snapshot next time. Every frame is serialized once for all subscribers.
+                """
+        exchange_id, symbol = topic
+        fields = compact_ticker(ticker)
+        previous = self._tickers.get(topic)
+        self._tickers[topic] = fields
+        synced = self._synced.setdefault(topic, set())
+        text = snapshot = delta = None
+        for websocket in list(self.topics.get(topic, ())):
+            if self._protocols.get(websocket) != MSGPACK:
+                if text is None:
+                    text = json.dumps({"status": "ok", "exchange": exchange_id, "symbol": symbol, "ticker": ticker})
+                self._enqueue(websocket, text, topic)
+                continue
+            if snapshot is None:
+                snapshot = msgpack.packb({"t": "snapshot", "e": exchange_id, "s": symbol, "d": fields})
+            if websocket in synced and previous is not None:
+                if delta is None:
+                    delta = msgpack.packb({"t": "delta", "e": exchange_id, "s": symbol,
+                                           "d": ticker_delta(previous, fields)})
+                if self._enqueue(websocket, delta, topic, snapshot) == DROPPED:
+                    synced.discard(websocket)
+            elif self._enqueue(websocket, snapshot, topic) != DROPPED:
+                synced.add(websocket)
+
+    def _publish_error(self, topic: Tuple[str, str], message: str):
+        """
+                Adds an error of a topic to the outboxes of its subscribers.
+
+                Errors are conflated under a key of their own, so they never replace a pending snapshot or delta of
+                a compact subscriber that is counted as synced.
+                """
+        exchange_id, symbol = topic
+        for websocket in list(self.topics.get(topic, ())):
+            if self._protocols.get(websocket) == MSGPACK:
+                payload = {"t": "error", "e": exchange_id, "s": symbol, "m": message}
+            else:
+                payload = {"status": "error", "exchange": exchange_id, "symbol": symbol, "message": message}
+            self._enqueue(websocket, self._encode(websocket, payload), ("error",) + topic)
+
+    def _fan_out(self, message: str, websockets, key=None):
+        """
+                Adds one serialized message to the outboxes of several connections.
+
+                Args:
+                    message (str): The serialized message.
+                    websockets (iterable): The receiving connections.
+                    key (hashable, optional): Conflation key of the message.
+                """
+        for websocket in list(websockets):
+            self._enqueue(websocket, message, key)
+
+    async def broadcast(self, message: str, account_id: int = None):
+        """
+                Sends a message to all connections of an account, or to all connections.
+
+                Args:
+                    message (str): Message to send.
+                    account_id (int, optional): Only send to the connections of this account.
+                """
+        self._fan_out(message, [websocket for websocket in self.active_connections
+                                if account_id is None or self._accounts.get(websocket) == account_id])
+
+    async def close(self):
+        """
+                Stops all publishers, e.g. on shutdown.
+                """
+        publishers = list(self._publishers.values())
+        self._publishers = {}
+        self.topics = {}
+        for publisher in publishers:
+            publisher.cancel()
+        await asyncio.gather(*publishers, return_exceptions=True)
+
+    def stats(self):
+        """
+                Returns the size of the connection manager.
+
+                Returns:
+                    dict: Number of connections, topics and subscriptions, the number of published tickers, the
+                    total and largest outbox depth, the number of compact connections, conflated and dropped messages
+                    and slow disconnects.
+                """
+        depths = [outbox.depth for outbox in self._outboxes.values()]
+        return {
+            "connections": len(self.active_connections),
+            "topics": len(self.topics),
+            "subscriptions": sum(len(subscribers) for subscribers in self.topics.values()),
+            "published": self.published,
+            "queued_messages": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "compact_connections": sum(protocol == MSGPACK for protocol in self._protocols.values()),
+            "conflated": self.conflated,
+            "dropped": self.dropped,
+            "slow_disconnects": self.slow_disconnects
+        }
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         """
-                Sends a personal message to a specific WebSocket connection.
+                Sends a personal message to a specific WebSocket connection through its outbox.
 
                 Args:
                     message (str): Message to send.
                     websocket (WebSocket): WebSocket connection object to send the message to.
                 """
-        await websocket.send_text(message)
+        self._enqueue(websocket, message)
+
+    async def send(self, payload: dict, websocket: WebSocket):
+        """
+                Sends a message to a specific WebSocket connection in the protocol of the connection.
+
+                Args:
+                    payload (dict): Message to send.
+                    websocket (WebSocket): WebSocket connection object to send the message to.
+                """
+        self._enqueue(websocket, self._encode(websocket, payload))
+
+
+class CredentialCache:
+    """
+        Caches the API entries of websocket users, so the event loop does not wait for the database.
+
+        Entries are loaded in a worker thread and kept for `ttl_seconds`; concurrent lookups of the same entry share
+        one load. Entries are detached from their session, so they can be used after it was closed.
+
+        Attributes:
+            ttl_seconds (float): Seconds an entry is served from the cache.
+        """
+
+    def __init__(self, loader=None, ttl_seconds: float = WEBSOCKET_CREDENTIAL_SECONDS, clock=time.monotonic):
+        """
+                Initializes an empty CredentialCache.
+
+                Args:
+                    loader (callable, optional): Blocking function that returns the API entry of an account and
+                        exchange name; reads the database by default.
+                    ttl_seconds (float): Seconds an entry is served from the cache.
+                    clock (callable): Monotonic time source.
+                """
+        self.loader = loader or self._load
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries = {}
+        self._in_flight = {}
+
+    @staticmethod
+    def _load(account_id: int, exchange_name: str):
+        db = SessionLocal()
+        try:
+            api = get_api_entry(account_id, exchange_name, db)
+            db.expunge(api)
+            return api
+        finally:
+            db.close()
+
+    async def get(self, account_id: int, exchange_name: str):
+        """
+                Returns the API entry of an account for an exchange.
+
+                Raises:
+                    ValueError: If the account has no API entry for the exchange.
+                """
+        key = (account_id, exchange_name)
+        entry = self._entries.get(key)
+        if entry is not None and self.clock() - entry[0] < self.ttl_seconds:
+            return entry[1]
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(asyncio.to_thread(self.loader, account_id, exchange_name))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._store(key, done))
+        return await asyncio.shield(task)
+
+    def _store(self, key, task):
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._entries[key] = (self.clock(), task.result())
 
 
 manager = ConnectionManager()
+credential_cache = CredentialCache()
+_actions = {}
+
 
+def websocket_action(name: str):
+    """
+        Registers the handler of a websocket action; used as decorator by other modules.
+
+        The handler is a coroutine function called with the connection, the user ID and the decoded request and
+        returns the response.
+
+        Args:
+            name (str): The value of the request's 'action' field.
+        """
+    def register(func):
+        _actions[name] = func
+        return func
+
+    return register
 
-async def fetch_infos(exchange_name: str, symbol: str, account_id: int, db: Session):
+
+async def fetch_infos(exchange_name: str, symbol: str, account_id: int):
     """
         Fetches ticker information from a cryptocurrency exchange.
 
@@ -66,7 +612,6 @@ async def fetch_infos(exchange_name: str, symbol: str, account_id: int, db: Sess
             exchange_name (str): Name of the cryptocurrency exchange (e.g., 'binance', 'kraken').
             symbol (str): Symbol of the cryptocurrency pair (e.g., 'BTC/USDT').
             account_id (int): ID of the user account for which API credentials are retrieved.
-            db (Session): SQLAlchemy database session.
 
         Returns:
             dict: Dictionary containing ticker information retrieved from the exchange.
@@ -74,48 +619,108 @@ async def fetch_infos(exchange_name: str, symbol: str, account_id: int, db: Sess
         Raises:
             Exception: If there's an error fetching ticker information from the exchange.
         """
-    creds = get_api_credentials(account_id, exchange_name, db)
-    exchange_class = getattr(ccxt, exchange_name)
-    exchange = exchange_class({
-        'apiKey': creds['api_Key'],
-        'secret': creds['secret'],
-        'passphrase': creds['passphrase']
-    })
+    api = await credential_cache.get(account_id, exchange_name)
+    exchange = exchange_pool.get(api)
 
-    ticker = exchange.fetch_ticker(symbol)
+    ticker = await ticker_cache.get(exchange, symbol, Priority.VALUATION)
     return ticker
 
 
-async def websocket_endpoint(websocket: WebSocket, user_id: int, db: Session = Depends(get_db)):
+async def handle_message(websocket: WebSocket, user_id: int, info_request: dict):
     """
-        WebSocket endpoint for handling real-time data requests.
+        Handles one request of a websocket client.
 
         Args:
             websocket (WebSocket): WebSocket connection object.
             user_id (int): ID of the user making the WebSocket connection.
-            db (Session, optional): SQLAlchemy database session. Defaults to Depends(get_db).
+            info_request (dict): The decoded message.
+
+        Returns:
+            dict: The response to send.
         """
+    action = info_request.get('action')
+    if action in _actions:
+        return await _actions[action](websocket, user_id, info_request)
+    exchange_name = info_request['exchange_name']
+    symbol = info_request['symbol']
+
+    if action == 'subscribe':
+        exchange_id, symbol = manager.subscribe(websocket, await credential_cache.get(user_id, exchange_name), symbol)
+        return {"status": "subscribed", "exchange": exchange_id, "symbol": symbol}
+    if action == 'unsubscribe':
+        exchange_id = exchange_pool.get(await credential_cache.get(user_id, exchange_name)).id
+        manager.unsubscribe(websocket, (exchange_id, symbol))
+        return {"status": "unsubscribed", "exchange": exchange_id, "symbol": symbol}
+    ticker = await fetch_infos(exchange_name, symbol, user_id)
+    return {
+        "status": "ok",
+        "ticker": ticker
+    }
 
-    await manager.connect(websocket)
+
+def authenticate_websocket(websocket: WebSocket):
+    """
+        Verifies the access token of a websocket connection.
+
+        Args:
+            websocket (WebSocket): WebSocket connection object.
+
+        Returns:
+            int: The account ID of the verified token, or None if the token is missing or invalid.
+        """
+    token = websocket.query_params.get("token")
+    authorization = websocket.headers.get("authorization")
+    if token is None and authorization is not None and authorization.startswith("Bearer "):
+        token = authorization.split(" ")[1]
+    payload = verify_trade_token(token) if token else None
+    return payload.get("account_id") if payload else None
+
+
+async def websocket_endpoint(websocket: WebSocket):
+    """
+        WebSocket endpoint for handling real-time data requests.
+
+        The connection is closed without being accepted unless it carries a valid access token; all requests are
+        served for the account of that token. Ticker messages name an 'exchange_name' and a 'symbol'. With the action
+        'subscribe' the connection receives the tickers of the symbol until it sends the action 'unsubscribe' or
+        disconnects; without an action the current ticker is sent once. Other actions are served by the handlers
+        registered with `websocket_action`. A message that is not answered within WEBSOCKET_MESSAGE_TIMEOUT_SECONDS
+        gets an error response, so a stuck exchange does not stall the connection. Responses and tickers are
+        MessagePack frames if the client connected with the 'msgpack' subprotocol.
+
+        Args:
+            websocket (WebSocket): WebSocket connection object.
+        """
+    user_id = authenticate_websocket(websocket)
+    if user_id is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    await manager.connect(websocket, user_id)
     try:
         while True:
             data = await websocket.receive_text()
-            info_request = json.loads(data)
-            exchange_name = info_request['exchange_name']
-            symbol = info_request['symbol']
 
             try:
-                ticker = await fetch_infos(exchange_name, symbol, user_id, db)
-                response = {
-                    "status": "ok",
-                    "ticker": ticker
-                }
+                info_request = json.loads(data)
+                response = await asyncio.wait_for(handle_message(websocket, user_id, info_request),
+                                                   WEBSOCKET_MESSAGE_TIMEOUT_SECONDS)
+            except json.JSONDecodeError as e:
+                response = {"status": "error",
+                            "message": f"Invalid JSON: {str(e)}"}
+            except asyncio.TimeoutError:
+                response = {"status": "error",
+                            "message": f"No response within {WEBSOCKET_MESSAGE_TIMEOUT_SECONDS} seconds"}
             except Exception as e:
                 response = {"status": "error",
                             "message": str(e)}
 
-            await manager.send_personal_message(json.dumps(response), websocket)
+            await manager.send(response, websocket)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
     except Exception as e:
-        await manager.send_personal_message(json.dumps({"status": "error", "message": str(e)}), websocket)
+        manager.disconnect(websocket)
+        try:
+            await websocket.send_text(json.dumps({"status": "error", "message": str(e)}))
+        except Exception as send_error:
+            logger.warning(f"Error sending to closing websocket: {str(send_error)}")